@@ -0,0 +1,448 @@
+#!/usr/bin/python
+
+# Copyright: (c) 2018, Bruno Meneguello
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+import threading
+
+import ansible.module_utils.libvirt_utils as util
+import libvirt
+from ansible.module_utils.basic import AnsibleModule
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.1',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+DOCUMENTATION = '''
+---
+module: libvirt_block_job
+
+short_description: Copy, pull, commit and rebase the disks of running domains
+
+version_added: "2.7"
+
+description:
+    - "https://libvirt.org/html/libvirt-libvirt-domain.html#virDomainBlockCopy"
+    - Starts a block job on each disk and waits for it through the block job events, polling C(blockJobInfo)
+      for the progress. A job already running on a disk is waited for instead of started again.
+    - A job is not started when the definition of the disk shows its work done, the disk already being on the
+      copy destination, or on I(base) after a rebase or an active commit, pulled down to I(base) or without
+      backing chain after a pull, or without I(top) in its backing chain after a commit. A copy aborted with
+      C(pivot: false) leaves no such trace and is started again.
+    - C(copy) and active C(commit) jobs keep mirroring once ready, they are then pivoted to the new image or
+      aborted, see I(pivot).
+
+options:
+    job:
+        description:
+            - C(copy) mirrors the disk to I(destination), C(pull) merges the backing chain, down to I(base) when set,
+              into the disk, C(commit) merges I(top), or the active image, into I(base), and C(rebase) copies the
+              disk onto I(base) through blockRebase.
+        choices: [ copy, pull, commit, rebase ]
+        required: true
+    domain:
+        description:
+            - Name of the domain.
+    disk:
+        description:
+            - Target device of the disk, like C(vda).
+    jobs:
+        description:
+            - Jobs to run concurrently instead of I(domain) and I(disk), each a dict with C(domain) and C(disk) and
+              optionally C(base), C(top), C(destination) and C(bandwidth) overriding the options of the module.
+    base:
+        description:
+            - Path of the backing image to pull down to, commit into or rebase onto.
+    top:
+        description:
+            - Path of the image to commit, the active one when not set.
+    destination:
+        description:
+            - Disk definition in dict form of the copy, like C({_type: file, source: {_file: /new/vda.qcow2}}).
+    bandwidth:
+        description:
+            - Bandwidth cap of the job in bytes per second, unlimited when not set.
+    shallow:
+        description:
+            - Only copy, commit or rebase the top image, keeping the rest of the backing chain.
+        default: false
+    reuse_ext:
+        description:
+            - Reuse the destination file instead of creating it.
+        default: false
+    relative:
+        description:
+            - Keep the backing chain references relative.
+        default: false
+    delete:
+        description:
+            - Delete the committed images once the commit completes.
+        default: false
+    pivot:
+        description:
+            - Switch the domain to the copy or the committed image once the job is ready, otherwise the job is
+              aborted then, leaving a point in time copy and the domain on its current image.
+        default: true
+    wait:
+        description:
+            - Wait for the jobs to complete.
+        default: true
+    timeout:
+        description:
+            - Seconds after which a job still running is aborted and reported as failed.
+    poll_interval:
+        description:
+            - Seconds between the progress polls, events end the waits earlier.
+        default: 1
+    max_workers:
+        description:
+            - Maximum number of jobs run at the same time.
+        default: 4
+
+author:
+    - Bruno Meneguello (@bkmeneguello)
+'''
+
+EXAMPLES = '''
+- name: Move the disk of web to the fast pool, at most 100 MiB/s
+  libvirt_block_job:
+    job: copy
+    domain: web
+    disk: vda
+    destination:
+      _type: file
+      source:
+        _file: /var/lib/libvirt/fast/web.qcow2
+      driver:
+        _type: qcow2
+    bandwidth: 104857600
+
+- name: Flatten the overlays of several domains, 2 at a time
+  libvirt_block_job:
+    job: pull
+    jobs:
+      - domain: web
+        disk: vda
+      - domain: db
+        disk: vda
+      - domain: db
+        disk: vdb
+        bandwidth: 10485760
+    bandwidth: 52428800
+    max_workers: 2
+
+- name: Merge the external snapshot back into the base image
+  libvirt_block_job:
+    job: commit
+    domain: web
+    disk: vda
+    delete: true
+'''
+
+RETURN = '''
+status:
+    description: how the job ended, C(completed), C(pivoted), C(aborted), C(started) when not waited for or
+      C(done) when its work was already done
+    type: str
+progress:
+    description: last C(cur) and C(end) reported by blockJobInfo
+    type: dict
+duration:
+    description: seconds spent on the job
+    type: float
+results:
+    description: one entry per job of I(jobs), with the same keys as above plus domain, disk, changed and failed
+    type: list
+'''
+
+JOB_COPY = 'copy'
+JOB_PULL = 'pull'
+JOB_COMMIT = 'commit'
+JOB_REBASE = 'rebase'
+
+# options each entry of jobs may override
+JOB_OPTIONS = ('base', 'top', 'destination', 'bandwidth')
+
+
+class JobEvents(object):
+    """Last block job status reported by events, keyed by domain UUID and disk target."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters = {}
+        self.statuses = {}
+
+    def watch(self, key):
+        # type: (tuple) -> threading.Event
+        with self.lock:
+            self.statuses.pop(key, None)
+            return self.waiters.setdefault(key, threading.Event())
+
+    def event(self, conn, vir_dom, disk, job_type, status, opaque):
+        key = (vir_dom.UUIDString(), disk)
+        with self.lock:
+            self.statuses[key] = status
+            waiter = self.waiters.get(key)
+        if waiter is not None:
+            waiter.set()
+
+    def status(self, key):
+        # type: (tuple) -> int
+        with self.lock:
+            self.waiters[key].clear()
+            return self.statuses.pop(key, None)
+
+
+def run_module():
+    module_args = dict(
+        job=dict(type='str', choices=[JOB_COPY, JOB_PULL, JOB_COMMIT, JOB_REBASE], required=True),
+        domain=dict(type='str'),
+        disk=dict(type='str'),
+        jobs=dict(type='list'),
+        base=dict(type='str'),
+        top=dict(type='str'),
+        destination=dict(type='dict'),
+        bandwidth=dict(type='int'),
+        shallow=dict(type='bool', default=False),
+        reuse_ext=dict(type='bool', default=False),
+        relative=dict(type='bool', default=False),
+        delete=dict(type='bool', default=False),
+        pivot=dict(type='bool', default=True),
+        wait=dict(type='bool', default=True),
+        timeout=dict(type='float'),
+        poll_interval=dict(type='float', default=1),
+        max_workers=dict(type='int', default=4),
+    )
+    module_args.update(util.common_args)
+
+    result = dict(
+        changed=False,
+    )
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        mutually_exclusive=[
+            ['domain', 'jobs'],
+        ],
+        required_one_of=[
+            ['domain', 'jobs'],
+        ],
+        required_together=[
+            ['domain', 'disk'],
+        ],
+        required_if=[
+            ['job', JOB_COPY, ['destination', 'jobs'], True],
+            ['job', JOB_REBASE, ['base', 'jobs'], True],
+        ],
+    )
+    util.start_profiling(module.params, module)
+
+    jobs = module.params['jobs']
+    for job in jobs or []:
+        if not isinstance(job, dict) or not job.get('domain') or not job.get('disk'):
+            module.fail_json(msg='every job needs a domain and a disk', **result)
+        unknown = set(job) - set(('domain', 'disk') + JOB_OPTIONS)
+        if unknown:
+            module.fail_json(msg='unsupported job options: {}'.format(', '.join(sorted(unknown))), **result)
+
+    events = JobEvents()
+    if module.params['wait']:
+        # the event loop must be registered before the connection is opened
+        util.start_event_loop()
+    conn = util.get_conn(module.params)  # type: libvirt.virConnect
+    if conn is None:
+        module.fail_json(msg='cannot open connection to libvirt', **result)
+    if module.params['wait'] and hasattr(libvirt, 'VIR_DOMAIN_EVENT_ID_BLOCK_JOB_2'):
+        try:
+            conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_BLOCK_JOB_2, events.event, None)
+        except libvirt.libvirtError:
+            # progress is still polled
+            pass
+
+    if jobs is None:
+        desc, error = run_job(conn, events, dict(module.params))
+        result.update(desc)
+        if error is not None:
+            module.fail_json(msg=str(error), **result)
+    else:
+        results = util.run_parallel(lambda job: run_job(conn, events, dict(module.params, **job)),
+                                    jobs, module.params['max_workers'])
+        result['results'] = []
+        failed = []
+        for job, (outcome, error) in zip(jobs, results):
+            desc, error = outcome if error is None else (dict(domain=job['domain'], disk=job['disk'],
+                                                              changed=False), error)
+            desc['failed'] = error is not None
+            if error is not None:
+                desc['msg'] = str(error)
+                failed.append('{domain}:{disk}'.format(**job))
+            result['changed'] |= desc['changed']
+            result['results'].append(desc)
+        if failed:
+            module.fail_json(msg='block job failed for {} of {} disks: {}'.format(
+                len(failed), len(jobs), ', '.join(failed)), **result)
+
+    util.finish_profiling(result)
+    module.exit_json(**result)
+
+
+def run_job(conn, events, params):
+    # type: (libvirt.virConnect, JobEvents, dict) -> tuple
+    desc = {
+        'domain': params['domain'],
+        'disk': params['disk'],
+        'changed': False,
+    }
+    start = util.monotonic()
+    error = None
+    try:
+        with util.phase('lookupByName'):
+            vir_dom = conn.lookupByName(params['domain'])  # type: libvirt.virDomain
+        key = (vir_dom.UUIDString(), params['disk'])
+        events.watch(key)
+        with util.phase('blockJobInfo'):
+            info = vir_dom.blockJobInfo(params['disk'], 0)
+        if not info and job_done(vir_dom, params):
+            desc['status'] = 'done'
+        else:
+            if not info:
+                start_job(vir_dom, params)
+                desc['changed'] = True
+            desc['status'] = 'started'
+            if params['wait']:
+                status, desc['progress'] = wait_job(vir_dom, events, key, params)
+                desc['status'] = status
+                desc['changed'] |= status in ('pivoted', 'aborted')
+    except libvirt.libvirtError as e:
+        error = e
+    desc['duration'] = util.monotonic() - start
+    return desc, error
+
+
+def job_done(vir_dom, params):
+    # type: (libvirt.virDomain, dict) -> bool
+    """Whether the current definition of the disk shows that the work of the job was already done."""
+    with util.phase('XMLDesc'):
+        domain = util.from_xml(vir_dom.XMLDesc(0))
+    disks = util.as_list(((domain or {}).get('devices') or {}).get('disk'))
+    disk = next((disk for disk in disks if (disk.get('target') or {}).get('_dev') == params['disk']), None)
+    if disk is None:
+        # an unknown disk is reported by the job itself
+        return False
+    source = source_path(disk)
+    chain = backing_chain(disk)
+    job = params['job']
+    base = params['base']
+    if job == JOB_COPY:
+        return source is not None and source == source_path(params['destination'])
+    if job == JOB_REBASE:
+        return source == base
+    if job == JOB_COMMIT and not params['top']:
+        # without base the active image is merged into its backing image, as long as there is one
+        return source == base if base else not chain
+    if job == JOB_PULL:
+        return chain[:1] == [base] if base else not chain
+    return params['top'] not in chain and (not base or base in chain)
+
+
+def source_path(disk):
+    # type: (dict) -> str
+    source = (disk or {}).get('source') or {}
+    return source.get('_file') or source.get('_dev') or source.get('_name') or source.get('_volume')
+
+
+def backing_chain(disk):
+    # type: (dict) -> list
+    """Paths of the backing images of the disk, from the top one down."""
+    chain = []
+    store = disk.get('backingStore')
+    while isinstance(store, dict) and store.get('source'):
+        chain.append(source_path(store))
+        store = store.get('backingStore')
+    return chain
+
+
+def start_job(vir_dom, params):
+    # type: (libvirt.virDomain, dict) -> None
+    job = params['job']
+    disk = params['disk']
+    bandwidth = params['bandwidth'] or 0
+    if job == JOB_COPY:
+        flags = 0
+        flags |= libvirt.VIR_DOMAIN_BLOCK_COPY_SHALLOW if params['shallow'] else 0
+        flags |= libvirt.VIR_DOMAIN_BLOCK_COPY_REUSE_EXT if params['reuse_ext'] else 0
+        # the bandwidth typed parameter of blockCopy is already in bytes
+        copy_params = {libvirt.VIR_DOMAIN_BLOCK_COPY_BANDWIDTH: bandwidth} if bandwidth else {}
+        with util.phase('blockCopy'):
+            vir_dom.blockCopy(disk, encode_disk(params['destination']), copy_params, flags)
+    elif job == JOB_PULL and not params['base']:
+        with util.phase('blockPull'):
+            vir_dom.blockPull(disk, bandwidth, libvirt.VIR_DOMAIN_BLOCK_PULL_BANDWIDTH_BYTES)
+    elif job == JOB_COMMIT:
+        flags = libvirt.VIR_DOMAIN_BLOCK_COMMIT_BANDWIDTH_BYTES
+        flags |= libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE if not params['top'] else 0
+        flags |= libvirt.VIR_DOMAIN_BLOCK_COMMIT_SHALLOW if params['shallow'] else 0
+        flags |= libvirt.VIR_DOMAIN_BLOCK_COMMIT_DELETE if params['delete'] else 0
+        flags |= libvirt.VIR_DOMAIN_BLOCK_COMMIT_RELATIVE if params['relative'] else 0
+        with util.phase('blockCommit'):
+            vir_dom.blockCommit(disk, params['base'], params['top'], bandwidth, flags)
+    else:
+        # a pull down to a base, or a copy onto it
+        flags = libvirt.VIR_DOMAIN_BLOCK_REBASE_BANDWIDTH_BYTES
+        flags |= libvirt.VIR_DOMAIN_BLOCK_REBASE_COPY if job == JOB_REBASE else 0
+        flags |= libvirt.VIR_DOMAIN_BLOCK_REBASE_SHALLOW if params['shallow'] else 0
+        flags |= libvirt.VIR_DOMAIN_BLOCK_REBASE_REUSE_EXT if params['reuse_ext'] else 0
+        flags |= libvirt.VIR_DOMAIN_BLOCK_REBASE_RELATIVE if params['relative'] else 0
+        with util.phase('blockRebase'):
+            vir_dom.blockRebase(disk, params['base'], bandwidth, flags)
+
+
+def wait_job(vir_dom, events, key, params):
+    # type: (libvirt.virDomain, JobEvents, tuple, dict) -> tuple
+    """Wait for the job on the disk to end, pivoting or aborting the jobs that become ready."""
+    disk = params['disk']
+    deadline = util.monotonic() + params['timeout'] if params['timeout'] else None
+    mirrors = params['job'] in (JOB_COPY, JOB_REBASE) or params['job'] == JOB_COMMIT and not params['top']
+    progress = {}
+    while True:
+        status = events.status(key)
+        if status == libvirt.VIR_DOMAIN_BLOCK_JOB_FAILED:
+            raise libvirt.libvirtError('block job on {} failed'.format(disk))
+        if status == libvirt.VIR_DOMAIN_BLOCK_JOB_CANCELED:
+            raise libvirt.libvirtError('block job on {} was canceled'.format(disk))
+        if status == libvirt.VIR_DOMAIN_BLOCK_JOB_COMPLETED:
+            return 'completed', progress
+        with util.phase('blockJobInfo'):
+            info = vir_dom.blockJobInfo(disk, 0)
+        if not info:
+            # the job ended, its event was missed or unsupported
+            return 'completed', progress
+        progress = dict(cur=info['cur'], end=info['end'])
+        # without events a mirroring job is ready once it caught up
+        if status == libvirt.VIR_DOMAIN_BLOCK_JOB_READY or mirrors and info['end'] and info['cur'] == info['end']:
+            if params['pivot']:
+                with util.phase('blockJobAbort'):
+                    vir_dom.blockJobAbort(disk, libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT)
+                return 'pivoted', progress
+            with util.phase('blockJobAbort'):
+                vir_dom.blockJobAbort(disk, 0)
+            return 'aborted', progress
+        if deadline is not None and util.monotonic() > deadline:
+            with util.phase('blockJobAbort'):
+                vir_dom.blockJobAbort(disk, 0)
+            raise libvirt.libvirtError('block job on {} timed out after {} seconds'.format(disk, params['timeout']))
+        events.waiters[key].wait(params['poll_interval'])
+
+
+def encode_disk(disk):
+    # type: (dict) -> str
+    return util.to_xml_str({'disk': disk})
+
+
+def main():
+    run_module()
+
+
+if __name__ == '__main__':
+    main()
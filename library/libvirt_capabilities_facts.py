@@ -1 +1,184 @@
-# TODO: https://libvirt.org/formatcaps.html#elementExamples
\ No newline at end of file
+#!/usr/bin/python
+
+# Copyright: (c) 2018, Bruno Meneguello
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+import time
+
+import ansible.module_utils.libvirt_utils as util
+import libvirt
+from ansible.module_utils.basic import AnsibleModule
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.1',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+DOCUMENTATION = '''
+---
+module: libvirt_capabilities_facts
+
+short_description: Indexed host capabilities
+
+version_added: "2.7"
+
+description:
+    - "https://libvirt.org/formatcaps.html"
+    - The parsed capabilities are cached on the managed host, keyed by connection URI, hostname and libvirt and
+      hypervisor versions.
+
+options:
+    arch:
+        description:
+            - Return the guest capabilities of this architecture as C(arch).
+    machine:
+        description:
+            - Return the architectures supporting this machine type as C(machine).
+    numa_cell:
+        description:
+            - Return this NUMA cell as C(numa_cell).
+    cpu_features:
+        description:
+            - Return whether the host CPU has each of these features as C(cpu_features).
+    cache:
+        description:
+            - Use the cached capabilities when available.
+        default: true
+    cache_dir:
+        description:
+            - Directory holding the cache on the managed host.
+        default: ~/.cache/ansible-libvirt
+    cache_ttl:
+        description:
+            - Seconds after which cached capabilities are fetched again; 0 never expires.
+        default: 86400
+    cache_validate:
+        description:
+            - Always fetch the capabilities and only reuse the cached index when their digest is unchanged.
+        default: false
+
+author:
+    - Bruno Meneguello (@bkmeneguello)
+'''
+
+EXAMPLES = '''
+- name: Check host support
+  libvirt_capabilities_facts:
+    arch: x86_64
+    machine: q35
+    cpu_features:
+      - vmx
+      - pdpe1gb
+  register: caps
+
+- debug:
+    msg: '{{ caps.arch.domain_types.kvm.emulator }}'
+'''
+
+RETURN = '''
+capabilities:
+    description: host capabilities indexed by arches, machines, numa_cells and cpu_features
+    type: dict
+cached:
+    description: whether the index was read from the cache
+    type: bool
+arch:
+    description: guest capabilities of the requested architecture
+    type: dict
+machine:
+    description: architectures supporting the requested machine type
+    type: list
+numa_cell:
+    description: requested NUMA cell
+    type: dict
+cpu_features:
+    description: requested CPU feature names mapped to their availability
+    type: dict
+'''
+
+
+def run_module():
+    module_args = dict(
+        arch=dict(type='str'),
+        machine=dict(type='str'),
+        numa_cell=dict(type='int'),
+        cpu_features=dict(type='list'),
+        cache=dict(type='bool', default=True),
+        cache_dir=dict(type='path', default=util.CACHE_DIR),
+        cache_ttl=dict(type='int', default=86400),
+        cache_validate=dict(type='bool', default=False),
+    )
+    module_args.update(util.common_args)
+
+    result = dict(
+        changed=False,
+    )
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True,
+    )
+    util.start_profiling(module.params, module)
+
+    arch = module.params['arch']
+    machine = module.params['machine']
+    numa_cell = module.params['numa_cell']
+    cpu_features = module.params['cpu_features']
+
+    conn = util.get_conn(module.params)  # type: libvirt.virConnect
+    if conn is None:
+        module.fail_json(msg='cannot open connection to libvirt', **result)
+
+    index, result['cached'] = get_capabilities(conn, module.params)
+    result['capabilities'] = index
+
+    if arch is not None:
+        result['arch'] = index['arches'].get(arch)
+    if machine is not None:
+        result['machine'] = index['machines'].get(machine, [])
+    if numa_cell is not None:
+        result['numa_cell'] = index['numa_cells'].get(str(numa_cell))
+    if cpu_features is not None:
+        features = set(index['cpu_features'])
+        result['cpu_features'] = {feature: feature in features for feature in cpu_features}
+
+    util.finish_profiling(result)
+    module.exit_json(**result)
+
+
+def get_capabilities(conn, params):
+    # type: (libvirt.virConnect, dict) -> tuple
+    cache_dir = params['cache_dir']
+    key = util.cache_key('capabilities', conn.getURI(), conn.getHostname(), conn.getLibVersion(), conn.getVersion())
+    with util.phase('cache_load'):
+        entry = util.cache_load(cache_dir, key) if params['cache'] else None
+
+    if entry is not None and not params['cache_validate']:
+        ttl = params['cache_ttl']
+        if not ttl or time.time() - entry['timestamp'] < ttl:
+            return entry['index'], True
+
+    with util.phase('getCapabilities'):
+        xml = conn.getCapabilities()
+    digest = util.xml_digest(xml)
+    if entry is not None and entry['sha256'] == digest:
+        # unchanged document, skip parsing but refresh the timestamp
+        index, cached = entry['index'], True
+    else:
+        with util.phase('index'):
+            index, cached = util.index_capabilities(util.str_to_xml(xml)), False
+    if params['cache']:
+        util.cache_store(cache_dir, key, {
+            'timestamp': time.time(),
+            'sha256': digest,
+            'index': index,
+        })
+    return index, cached
+
+
+def main():
+    run_module()
+
+
+if __name__ == '__main__':
+    main()
@@ -41,6 +41,44 @@ options:
         description:
             - TBD
         required: false
+    check_capabilities:
+        description:
+            - Check the definition against the domain capabilities of the host before defining or creating it.
+        default: false
+    capabilities_cache_dir:
+        description:
+            - Directory caching the domain capabilities on the managed host, disabled when not set.
+        required: false
+    compare_mode:
+        description:
+            - How I(update) compares the definition with the current one. C(exact) requires both to be equal,
+              C(subset) only compares what the definition gives, ignoring the addresses, aliases, controllers and
+              defaults libvirt fills in, so that definitions in short form are not redefined on every run.
+        choices: [ exact, subset ]
+        default: exact
+    compare_ignore:
+        description:
+            - Glob patterns of dotted paths, like C(domain.devices.graphics._port), left out of the comparison.
+              Elements of disk, interface and controller lists are named by their target device, MAC address,
+              and type and index, others by their position.
+        required: false
+    wait_for:
+        description:
+            - With I(state=created), wait until the guest reports an address through its C(agent), a DHCP C(lease)
+              or the C(arp) table, returned in C(interfaces_addresses). Agent connections end the waits early.
+        choices: [ agent, lease, arp ]
+        required: false
+    wait_timeout:
+        description:
+            - Seconds to wait for I(wait_for) before failing.
+        default: 300
+    live_update:
+        description:
+            - When I(update) finds a running domain, apply the changed tunables to it in place instead of only on the
+              next start. Covered are the C(vcpu) count, C(currentMemory), C(blkiotune), the C(iotune) of disks,
+              matched by target device, the C(bandwidth) of interfaces, matched by MAC address, and the scheduler
+              parameters of C(cputune). Other differences still need a restart.
+        default: false
 
 author:
     - Your Name (@bkmeneguello)
@@ -154,6 +192,12 @@ state:
 reason:
     description: TBD
     type: str
+interfaces_addresses:
+    description: addresses of the guest interfaces once ready, with I(wait_for)
+    type: dict
+live_updated:
+    description: paths of the tunables applied to the running domain by I(live_update)
+    type: list
 '''
 
 STATE_DESTROYED = 'destroyed'
@@ -162,6 +206,9 @@ STATE_CREATED = 'created'
 STATE_UNDEFINED = 'undefined'
 STATE_STOPPED = 'stopped'
 
+COMPARE_EXACT = 'exact'
+COMPARE_SUBSET = 'subset'
+
 
 def run_module():
     module_args = dict(
@@ -184,6 +231,13 @@ def run_module():
         shutdown_initctl=dict(type='bool', default=False),
         shutdown_signal=dict(type='bool', default=False),
         shutdown_paravirt=dict(type='bool', default=False),
+        check_capabilities=dict(type='bool', default=False),
+        capabilities_cache_dir=dict(type='path'),
+        compare_mode=dict(type='str', choices=[COMPARE_EXACT, COMPARE_SUBSET], default=COMPARE_EXACT),
+        compare_ignore=dict(type='list'),
+        live_update=dict(type='bool', default=False),
+        wait_for=dict(type='str', choices=list(util.DOMAIN_INTERFACE_ADDRESSES_SOURCES_LOOKUP)),
+        wait_timeout=dict(type='float', default=300),
         # undefine_remove_all_storage=dict(type='bool', default=False),  # TODO
         # undefine_storage=dict(type='list'),  # TODO
         # undefine_wipe_storage=dict(type='bool', default=False),  # TODO
@@ -206,6 +260,7 @@ def run_module():
             ['state', STATE_DESTROYED, ['name']],
         ],
     )
+    util.start_profiling(module.params, module)
 
     domain = module.params['domain']
     if module.params['xml'] is not None:
@@ -230,13 +285,31 @@ def run_module():
     shutdown_initctl = module.params['shutdown_initctl']
     shutdown_signal = module.params['shutdown_signal']
     shutdown_paravirt = module.params['shutdown_paravirt']
+    check_capabilities = module.params['check_capabilities']
+    subset = module.params['compare_mode'] == COMPARE_SUBSET
+    ignore = module.params['compare_ignore']
+    live_update = module.params['live_update']
+    wait_for = module.params['wait_for'] if state == STATE_CREATED else None
+
+    if wait_for == 'agent':
+        # the agent events need the event loop registered before the connection is opened
+        util.start_event_loop()
 
     conn = util.get_conn(module.params)  # type: libvirt.virConnect
     if conn is None:
         module.fail_json(msg='cannot open connection to libvirt', **result)
 
+    if check_capabilities and domain and state in (STATE_DEFINED, STATE_CREATED):
+        try:
+            problems = domain_unsupported(conn, domain, module.params['capabilities_cache_dir'])
+        except libvirt.libvirtError as e:
+            module.fail_json(msg=str(e), **result)
+        if problems:
+            module.fail_json(msg='domain definition not supported by the host', problems=problems, **result)
+
     try:
-        vir_dom = conn.lookupByName(name)  # type: libvirt.virDomain
+        with util.phase('lookupByName'):
+            vir_dom = conn.lookupByName(name)  # type: libvirt.virDomain
         if domain:
             domain['uuid'] = vir_dom.UUIDString()
     except libvirt.libvirtError:
@@ -248,13 +321,13 @@ def run_module():
             vir_dom = define_domain(conn, domain)
             result.update(util.describe_domain(vir_dom))
         elif update:
-            changed, path, cause = domain_has_changed(vir_dom, domain)
+            changed, path, cause = domain_has_changed(vir_dom, domain, subset=subset, ignore=ignore)
             if changed:
                 result['changed'] = True
                 result['changed_path'] = path
                 result['changed_cause'] = cause
                 vir_dom = define_domain(conn, domain)
-                changed, path, cause = domain_has_changed(vir_dom, domain)
+                changed, path, cause = domain_has_changed(vir_dom, domain, subset=subset, ignore=ignore)
                 if changed:
                     module.warn('the provided domain definition was modified by the virtualization platform, '
                                 'check the current definition to avoid unnecessary updates')
@@ -267,22 +340,40 @@ def run_module():
             result['changed'] = True
             if persistent:
                 vir_dom = define_domain(conn, domain)
-                vir_dom.create()
+                start_domain(vir_dom)
             else:
                 vir_dom = create_domain(conn, domain)
             result.update(util.describe_domain(vir_dom))
         elif update:
             if vir_dom.isActive():
-                # TODO: detect changes
-                changed, path, cause = domain_has_changed(vir_dom, domain, active=True)
+                if live_update:
+                    try:
+                        applied = apply_live(vir_dom, domain)
+                    except libvirt.libvirtError as e:
+                        module.fail_json(msg=e.get_error_message(), **result)
+                    except ValueError as e:
+                        module.fail_json(msg=str(e), **result)
+                    if applied:
+                        result['changed'] = True
+                    result['live_updated'] = applied
+                changed, path, cause = domain_has_changed(vir_dom, domain, True, subset, ignore)
                 if changed:
                     module.warn('some configurations cannot be applied to running domain')
                     module.warn('{}: {}'.format(path, cause))
             if persistent:
-                result['changed'] = True
-                vir_dom = define_domain(conn, domain)
+                # the persistent definition is only rewritten when it differs
+                if vir_dom.isPersistent():
+                    changed, path, cause = domain_has_changed(vir_dom, domain, subset=subset, ignore=ignore)
+                else:
+                    changed, path, cause = True, 'domain', 'not persistent'
+                if changed:
+                    result['changed'] = True
+                    result['changed_path'] = path
+                    result['changed_cause'] = cause
+                    vir_dom = define_domain(conn, domain)
                 if not vir_dom.isActive():
-                    vir_dom.create()
+                    result['changed'] = True
+                    start_domain(vir_dom)
                 result.update(util.describe_domain(vir_dom))
             elif vir_dom.isPersistent():
                 result['changed'] = True
@@ -320,21 +411,36 @@ def run_module():
                             shutdown_paravirt,
                             shutdown_signal)
 
+    if wait_for and vir_dom is not None:
+        [(addresses, error)] = util.wait_for_guests(conn, [vir_dom], wait_for, module.params['wait_timeout'])
+        if error is not None:
+            module.fail_json(msg=str(error), **result)
+        result['interfaces_addresses'] = addresses
+
+    util.finish_profiling(result)
     module.exit_json(**result)
 
 
 def create_domain(conn, domain):
     xml = encode_domain(domain)
-    vir_dom = conn.createXML(xml)
+    with util.phase('createXML'):
+        vir_dom = conn.createXML(xml)
     return vir_dom
 
 
 def define_domain(conn, domain):
     xml = encode_domain(domain)
-    vir_dom = conn.defineXML(xml)
+    with util.phase('defineXML'):
+        vir_dom = conn.defineXML(xml)
     return vir_dom
 
 
+def start_domain(vir_dom):
+    # type: (libvirt.virDomain) -> int
+    with util.phase('create'):
+        return vir_dom.create()
+
+
 def undefine_domain(vir_dom,
                     undefine_managed_save,
                     undefine_snapshots_metadata,
@@ -345,12 +451,14 @@ def undefine_domain(vir_dom,
     flags |= libvirt.VIR_DOMAIN_UNDEFINE_SNAPSHOTS_METADATA if undefine_snapshots_metadata else 0
     flags |= libvirt.VIR_DOMAIN_UNDEFINE_KEEP_NVRAM if undefine_keep_nvram else 0
     flags |= libvirt.VIR_DOMAIN_UNDEFINE_NVRAM if undefine_nvram else 0
-    return vir_dom.undefineFlags(flags)
+    with util.phase('undefineFlags'):
+        return vir_dom.undefineFlags(flags)
 
 
 def destroy_domain(domain, graceful):
     flags = libvirt.VIR_DOMAIN_DESTROY_GRACEFUL if graceful else 0
-    return domain.destroyFlags(flags)
+    with util.phase('destroyFlags'):
+        return domain.destroyFlags(flags)
 
 
 def domain_shutdown(vir_dom,
@@ -365,20 +473,224 @@ def domain_shutdown(vir_dom,
     flags |= libvirt.VIR_DOMAIN_SHUTDOWN_INITCTL if shutdown_initctl else 0
     flags |= libvirt.VIR_DOMAIN_SHUTDOWN_SIGNAL if shutdown_signal else 0
     flags |= libvirt.VIR_DOMAIN_SHUTDOWN_PARAVIRT if shutdown_paravirt else 0
-    return vir_dom.shutdownFlags(flags)
+    with util.phase('shutdownFlags'):
+        return vir_dom.shutdownFlags(flags)
 
 
-def domain_has_changed(vir_dom, domain, active=False):
+def domain_has_changed(vir_dom, domain, active=False, subset=False, ignore=None):
     flags = libvirt.VIR_DOMAIN_XML_SECURE
     flags |= libvirt.VIR_DOMAIN_XML_INACTIVE if not active else 0
-    current = util.from_xml(vir_dom.XMLDesc(flags))
-    eq, path, cause = util.compare(domain, current, 'domain')
+    with util.phase('XMLDesc'):
+        xml = vir_dom.XMLDesc(flags)
+    current = util.from_xml(xml)
+    with util.phase('compare'):
+        eq, path, cause = util.compare(domain, current, 'domain', subset, ignore)
     return not eq, path, cause
 
 
+# libvirt typed parameters of the live tuning calls, keyed by the element names of their definition
+BLKIO_DEVICE_PARAMETERS = {
+    'weight': libvirt.VIR_DOMAIN_BLKIO_DEVICE_WEIGHT,
+    'read_iops_sec': libvirt.VIR_DOMAIN_BLKIO_DEVICE_READ_IOPS,
+    'write_iops_sec': libvirt.VIR_DOMAIN_BLKIO_DEVICE_WRITE_IOPS,
+    'read_bytes_sec': libvirt.VIR_DOMAIN_BLKIO_DEVICE_READ_BPS,
+    'write_bytes_sec': libvirt.VIR_DOMAIN_BLKIO_DEVICE_WRITE_BPS,
+}
+
+SCHEDULER_PARAMETERS = {
+    'shares': libvirt.VIR_DOMAIN_SCHEDULER_CPU_SHARES,
+    'period': libvirt.VIR_DOMAIN_SCHEDULER_VCPU_PERIOD,
+    'quota': libvirt.VIR_DOMAIN_SCHEDULER_VCPU_QUOTA,
+    'global_period': libvirt.VIR_DOMAIN_SCHEDULER_GLOBAL_PERIOD,
+    'global_quota': libvirt.VIR_DOMAIN_SCHEDULER_GLOBAL_QUOTA,
+    'emulator_period': libvirt.VIR_DOMAIN_SCHEDULER_EMULATOR_PERIOD,
+    'emulator_quota': libvirt.VIR_DOMAIN_SCHEDULER_EMULATOR_QUOTA,
+    'iothread_period': libvirt.VIR_DOMAIN_SCHEDULER_IOTHREAD_PERIOD,
+    'iothread_quota': libvirt.VIR_DOMAIN_SCHEDULER_IOTHREAD_QUOTA,
+}
+
+# floor only applies to inbound traffic, a zero average removes the limits of a direction
+BANDWIDTH_ATTRIBUTES = ('average', 'peak', 'burst', 'floor')
+
+
+def value_of(value):
+    # type: (object) -> str
+    if isinstance(value, dict):
+        value = value.get('__value')
+    return None if value is None else str(value)
+
+
+def apply_live(vir_dom, domain):
+    # type: (libvirt.virDomain, dict) -> list
+    """Apply the tunables of the definition differing from the running domain, returns the paths applied."""
+    with util.phase('XMLDesc'):
+        current = util.from_xml(vir_dom.XMLDesc(0))
+    flags = libvirt.VIR_DOMAIN_AFFECT_LIVE
+    applied = []
+
+    vcpu, current_vcpu = domain.get('vcpu'), current.get('vcpu')
+    if vcpu is not None:
+        # the vcpus online are the current ones, the value being the maximum
+        count = vcpu.get('_current', vcpu.get('__value')) if isinstance(vcpu, dict) else vcpu
+        current_count = current_vcpu.get('_current', current_vcpu.get('__value')) \
+            if isinstance(current_vcpu, dict) else current_vcpu
+        if count is not None and str(count) != str(current_count):
+            with util.phase('setVcpusFlags'):
+                vir_dom.setVcpusFlags(int(count), flags)
+            applied.append('domain.vcpu')
+
+    memory = domain.get('currentMemory')
+    if memory is not None:
+        kib = memory_kib(memory)
+        if kib != memory_kib(current.get('currentMemory')):
+            with util.phase('setMemoryFlags'):
+                vir_dom.setMemoryFlags(kib, flags)
+            applied.append('domain.currentMemory')
+
+    blkiotune = domain.get('blkiotune')
+    if blkiotune is not None:
+        params = blkio_parameters(blkiotune)
+        if blkio_differs(params, blkio_parameters(current.get('blkiotune') or {})):
+            with util.phase('setBlkioParameters'):
+                vir_dom.setBlkioParameters(params, flags)
+            applied.append('domain.blkiotune')
+
+    cputune = domain.get('cputune')
+    if cputune is not None:
+        params = scheduler_parameters(cputune)
+        current_params = scheduler_parameters(current.get('cputune') or {})
+        if any(current_params.get(key) != value for key, value in params.items()):
+            with util.phase('setSchedulerParametersFlags'):
+                vir_dom.setSchedulerParametersFlags(params, flags)
+            applied.append('domain.cputune')
+
+    devices = domain.get('devices') or {}
+    current_devices = current.get('devices') or {}
+
+    current_disks = {(disk.get('target') or {}).get('_dev'): disk for disk in util.as_list(current_devices.get('disk'))}
+    for disk in util.as_list(devices.get('disk')):
+        dev = (disk.get('target') or {}).get('_dev')
+        if 'iotune' not in disk or dev not in current_disks:
+            continue
+        params = lifted_parameters(iotune_parameters(disk['iotune']),
+                                   iotune_parameters(current_disks[dev].get('iotune') or {}))
+        if params:
+            with util.phase('setBlockIoTune'):
+                vir_dom.setBlockIoTune(dev, params, flags)
+            applied.append('domain.devices.disk.{}.iotune'.format(dev))
+
+    current_interfaces = {(interface.get('mac') or {}).get('_address', '').lower(): interface
+                          for interface in util.as_list(current_devices.get('interface'))}
+    for interface in util.as_list(devices.get('interface')):
+        mac = (interface.get('mac') or {}).get('_address', '').lower()
+        if 'bandwidth' not in interface or mac not in current_interfaces:
+            continue
+        params = lifted_parameters(bandwidth_parameters(interface['bandwidth']),
+                                   bandwidth_parameters(current_interfaces[mac].get('bandwidth') or {}))
+        if params:
+            with util.phase('setInterfaceParameters'):
+                vir_dom.setInterfaceParameters(mac, params, flags)
+            applied.append('domain.devices.interface.{}.bandwidth'.format(mac))
+
+    return applied
+
+
+def memory_kib(memory):
+    # type: (object) -> int
+    if memory is None:
+        return None
+    unit = memory.get('_unit') if isinstance(memory, dict) else None
+    return util.to_bytes(int(value_of(memory)), unit or 'KiB') // 1024
+
+
+def blkio_parameters(blkiotune):
+    # type: (dict) -> dict
+    params = {}
+    if blkiotune.get('weight') is not None:
+        params[libvirt.VIR_DOMAIN_BLKIO_WEIGHT] = int(value_of(blkiotune['weight']))
+    # per device values are lists of path and value pairs
+    devices = util.as_list(blkiotune.get('device'))
+    if any(device.get('path') is None for device in devices):
+        raise ValueError('blkiotune device without path')
+    for element, param in BLKIO_DEVICE_PARAMETERS.items():
+        pairs = ['{},{}'.format(value_of(device['path']), value_of(device[element]))
+                 for device in devices if device.get(element) is not None]
+        if pairs:
+            params[param] = ','.join(pairs)
+    return params
+
+
+def blkio_differs(params, current_params):
+    # type: (dict, dict) -> bool
+    """Whether a requested value differs from the current one, libvirt reporting every tunable and device."""
+    for key, value in params.items():
+        if key not in BLKIO_DEVICE_PARAMETERS.values():
+            if current_params.get(key) != value:
+                return True
+            continue
+        current_pairs = device_pairs(current_params.get(key))
+        if any(current_pairs.get(path) != device_value for path, device_value in device_pairs(value).items()):
+            return True
+    return False
+
+
+def device_pairs(value):
+    # type: (str) -> dict
+    """Values keyed by device path of a per device blkio parameter."""
+    items = value.split(',') if value else []
+    return dict(zip(items[::2], items[1::2]))
+
+
+def scheduler_parameters(cputune):
+    # type: (dict) -> dict
+    return {param: int(value_of(cputune[element]))
+            for element, param in SCHEDULER_PARAMETERS.items() if cputune.get(element) is not None}
+
+
+def iotune_parameters(iotune):
+    # type: (dict) -> dict
+    # the elements of iotune are named after the typed parameters of setBlockIoTune
+    return {element: value_of(value) if element == 'group_name' else int(value_of(value))
+            for element, value in iotune.items() if value_of(value) is not None}
+
+
+def bandwidth_parameters(bandwidth):
+    # type: (dict) -> dict
+    params = {}
+    for direction in ('inbound', 'outbound'):
+        limits = bandwidth.get(direction) or {}
+        for attribute in BANDWIDTH_ATTRIBUTES:
+            if limits.get('_' + attribute) is not None:
+                params['{}.{}'.format(direction, attribute)] = int(limits['_' + attribute])
+    return params
+
+
+def lifted_parameters(params, current_params):
+    # type: (dict, dict) -> dict
+    """Parameters to set when they differ from the current ones, the limits left out being lifted with 0."""
+    params = dict(params)
+    params.update((key, '' if isinstance(value, str) else 0)
+                  for key, value in current_params.items() if key not in params and value)
+    if all(current_params.get(key, 0) == value for key, value in params.items()):
+        return None
+    return params
+
+
+def domain_unsupported(conn, domain, cache_dir):
+    # type: (libvirt.virConnect, dict, str) -> list
+    os_type = (domain.get('os') or {}).get('type')
+    os_type = os_type if isinstance(os_type, dict) else {}
+    index, _ = util.get_domain_capabilities(conn,
+                                            (domain.get('devices') or {}).get('emulator'),
+                                            os_type.get('_arch'),
+                                            os_type.get('_machine'),
+                                            domain.get('_type'),
+                                            cache_dir)
+    return util.check_domain_capabilities(domain, index)
+
+
 def encode_domain(domain):
-    xml = util.to_xml({'domain': domain})
-    return util.xml_to_str(xml)
+    return util.to_xml_str({'domain': domain})
 
 
 def main():
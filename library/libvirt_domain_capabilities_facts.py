@@ -1 +1,135 @@
-# TODO: https://libvirt.org/formatdomaincaps.html
\ No newline at end of file
+#!/usr/bin/python
+
+# Copyright: (c) 2018, Bruno Meneguello
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+import ansible.module_utils.libvirt_utils as util
+import libvirt
+from ansible.module_utils.basic import AnsibleModule
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.1',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+DOCUMENTATION = '''
+---
+module: libvirt_domain_capabilities_facts
+
+short_description: Indexed domain capabilities
+
+version_added: "2.7"
+
+description:
+    - "https://libvirt.org/formatdomaincaps.html"
+    - Results are memoized per emulator, arch, machine and virttype and cached on the managed host.
+
+options:
+    emulator:
+        description:
+            - Path to the emulator binary.
+    arch:
+        description:
+            - Domain architecture.
+    machine:
+        description:
+            - Machine type.
+    virttype:
+        description:
+            - Virtualization type, e.g. kvm or qemu.
+    domain:
+        description:
+            - Domain definition in dict form to check against the capabilities, the problems found are returned
+              as C(problems).
+    cache:
+        description:
+            - Use the capabilities cached on the managed host.
+        default: true
+    cache_dir:
+        description:
+            - Directory holding the cache on the managed host.
+        default: ~/.cache/ansible-libvirt
+
+author:
+    - Bruno Meneguello (@bkmeneguello)
+'''
+
+EXAMPLES = '''
+- name: Get KVM capabilities
+  libvirt_domain_capabilities_facts:
+    arch: x86_64
+    machine: q35
+    virttype: kvm
+  register: domcaps
+
+- debug:
+    msg: '{{ domcaps.domain_capabilities.disk_buses }}'
+'''
+
+RETURN = '''
+domain_capabilities:
+    description: supported values indexed as disk_buses, disk_devices, video_models, graphics_types, firmware,
+                 loaders, loader_types, cpu_modes, cpu_models, devices and features
+    type: dict
+cached:
+    description: whether the index was memoized or read from the cache
+    type: bool
+problems:
+    description: unsupported parts of the given domain definition
+    type: list
+'''
+
+
+def run_module():
+    module_args = dict(
+        emulator=dict(type='str'),
+        arch=dict(type='str'),
+        machine=dict(type='str'),
+        virttype=dict(type='str'),
+        domain=dict(type='dict'),
+        cache=dict(type='bool', default=True),
+        cache_dir=dict(type='path', default=util.CACHE_DIR),
+    )
+    module_args.update(util.common_args)
+
+    result = dict(
+        changed=False,
+    )
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True,
+    )
+    util.start_profiling(module.params, module)
+
+    domain = module.params['domain']
+
+    conn = util.get_conn(module.params)  # type: libvirt.virConnect
+    if conn is None:
+        module.fail_json(msg='cannot open connection to libvirt', **result)
+
+    cache_dir = module.params['cache_dir'] if module.params['cache'] else None
+    try:
+        index, result['cached'] = util.get_domain_capabilities(conn,
+                                                               module.params['emulator'],
+                                                               module.params['arch'],
+                                                               module.params['machine'],
+                                                               module.params['virttype'],
+                                                               cache_dir)
+    except libvirt.libvirtError as e:
+        module.fail_json(msg=str(e), **result)
+    result['domain_capabilities'] = index
+    if domain is not None:
+        result['problems'] = util.check_domain_capabilities(domain, index)
+
+    util.finish_profiling(result)
+    module.exit_json(**result)
+
+
+def main():
+    run_module()
+
+
+if __name__ == '__main__':
+    main()
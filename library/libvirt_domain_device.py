@@ -2,7 +2,6 @@
 
 # Copyright: (c) 2018, Bruno Meneguello
 # GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
-from xml.etree import ElementTree
 
 import ansible.module_utils.libvirt_utils as util
 import libvirt
@@ -93,6 +92,7 @@ def run_module():
             ['state', STATE_ABSENT, ['alias', 'domain', 'xml'], True],
         ],
     )
+    util.start_profiling(module.params, module)
 
     state = module.params['state']
     domain = module.params['domain']
@@ -113,7 +113,8 @@ def run_module():
         module.fail_json(msg='cannot open connection to libvirt', **result)
 
     try:
-        vir_dom = conn.lookupByName(domain)  # type: libvirt.virDomain
+        with util.phase('lookupByName'):
+            vir_dom = conn.lookupByName(domain)  # type: libvirt.virDomain
     except libvirt.libvirtError:
         module.fail_json(msg='domain not found', **result)
 
@@ -123,32 +124,38 @@ def run_module():
         xml = encode_device(device_type, device)
         if alias:
             if not alias_exists(vir_dom, device_type, alias):
-                vir_dom.attachDeviceFlags(xml, libvirt.VIR_DOMAIN_AFFECT_CURRENT)
+                with util.phase('attachDeviceFlags'):
+                    vir_dom.attachDeviceFlags(xml, libvirt.VIR_DOMAIN_AFFECT_CURRENT)
                 result['changed'] = True
         else:
-            vir_dom.attachDeviceFlags(xml, libvirt.VIR_DOMAIN_AFFECT_CURRENT)
+            with util.phase('attachDeviceFlags'):
+                vir_dom.attachDeviceFlags(xml, libvirt.VIR_DOMAIN_AFFECT_CURRENT)
             result['changed'] = True
     elif state == STATE_ABSENT:
         if alias:
             if alias_exists(vir_dom, device_type, alias):
-                vir_dom.detachDeviceAlias(alias, libvirt.VIR_DOMAIN_AFFECT_CURRENT)
+                with util.phase('detachDeviceAlias'):
+                    vir_dom.detachDeviceAlias(alias, libvirt.VIR_DOMAIN_AFFECT_CURRENT)
                 result['changed'] = True
         else:
             xml = encode_device(device_type, device)
-            vir_dom.detachDeviceFlags(xml, libvirt.VIR_DOMAIN_AFFECT_CURRENT)
+            with util.phase('detachDeviceFlags'):
+                vir_dom.detachDeviceFlags(xml, libvirt.VIR_DOMAIN_AFFECT_CURRENT)
             result['changed'] = True  # TODO: Check if has changed
 
+    util.finish_profiling(result)
     module.exit_json(**result)
 
 
 def alias_exists(vir_dom, device_type, alias):  # type: (libvirt.virDomain, str, str) -> bool
-    root = ElementTree.fromstring(vir_dom.XMLDesc())  # type: ElementTree.Element
+    with util.phase('XMLDesc'):
+        xml = vir_dom.XMLDesc()
+    root = util.str_to_xml(xml)
     return bool(root.findall('./devices/%s/alias[@name="%s"]' % (device_type, alias)))
 
 
 def encode_device(device_type, device):
-    xml = util.to_xml({device_type: device})
-    return util.xml_to_str(xml)
+    return util.to_xml_str({device_type: device})
 
 
 def main():
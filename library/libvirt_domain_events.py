@@ -0,0 +1,229 @@
+#!/usr/bin/python
+
+# Copyright: (c) 2018, Bruno Meneguello
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+import json
+import os
+import signal
+import threading
+import time
+
+import ansible.module_utils.libvirt_utils as util
+import libvirt
+from ansible.module_utils.basic import AnsibleModule
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.1',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+DOCUMENTATION = '''
+---
+module: libvirt_domain_events
+
+short_description: Journal the domains changed by libvirt events
+
+version_added: "2.7"
+
+description:
+    - Subscribes to the domain lifecycle, define and undefine, device, disk change, block job, tray, balloon, tunable
+      and metadata events and appends the UUID of each domain they concern to a JSON-lines journal on the managed
+      host.
+    - The journal lets M(libvirt_domain_facts) describe again only the domains changed since its last run, see
+      its I(journal) option. A C(started) and a C(stopped) record delimit each watch, events are missed outside them.
+    - The journal is touched every 10 seconds while watching. M(libvirt_domain_facts) does not trust a journal left
+      untouched for longer, by a watcher killed or lost with its host.
+    - Once larger than I(max_size), the journal is replaced by one holding a new C(started) record, so
+      M(libvirt_domain_facts) describes every domain again on its next run.
+    - Meant to run in the background with C(async) and C(poll: 0), or for a fixed I(duration).
+
+options:
+    journal:
+        description:
+            - Path of the journal on the managed host.
+        default: ~/.cache/ansible-libvirt/domain-events.jsonl
+    duration:
+        description:
+            - Seconds to watch for, 0 watches until the connection is closed.
+        default: 0
+    max_size:
+        description:
+            - Size in bytes above which the journal is replaced, checked every 10 seconds.
+        default: 1048576
+
+author:
+    - Bruno Meneguello (@bkmeneguello)
+'''
+
+EXAMPLES = '''
+- name: Watch domain events in the background
+  libvirt_domain_events:
+  async: 31536000
+  poll: 0
+
+- name: Describe only the changed domains
+  libvirt_domain_facts:
+    journal: ~/.cache/ansible-libvirt/domain-events.jsonl
+  register: domains
+'''
+
+RETURN = '''
+journal:
+    description: path of the journal
+    type: str
+events:
+    description: number of events journaled
+    type: int
+'''
+
+# journaled event names and the libvirt event IDs, the ones missing from the bindings are skipped
+EVENTS = [
+    ('lifecycle', 'VIR_DOMAIN_EVENT_ID_LIFECYCLE'),
+    ('device_added', 'VIR_DOMAIN_EVENT_ID_DEVICE_ADDED'),
+    ('device_removed', 'VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED'),
+    ('disk_change', 'VIR_DOMAIN_EVENT_ID_DISK_CHANGE'),
+    ('block_job', 'VIR_DOMAIN_EVENT_ID_BLOCK_JOB'),
+    ('block_job_2', 'VIR_DOMAIN_EVENT_ID_BLOCK_JOB_2'),
+    ('tray_change', 'VIR_DOMAIN_EVENT_ID_TRAY_CHANGE'),
+    ('balloon_change', 'VIR_DOMAIN_EVENT_ID_BALLOON_CHANGE'),
+    ('tunable', 'VIR_DOMAIN_EVENT_ID_TUNABLE'),
+    ('metadata_change', 'VIR_DOMAIN_EVENT_ID_METADATA_CHANGE'),
+]
+
+
+class Journal(object):
+    """Appends records as single JSON lines, flushed one by one, from the event loop and the module threads."""
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.uri = None
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.f = open(path, 'a')
+        self.lock = threading.Lock()
+        self.events = 0
+
+    def write(self, record):
+        # type: (dict) -> None
+        record['time'] = time.time()
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            # the event loop may still deliver events once the watch ended
+            if not self.f.closed:
+                self.f.write(line)
+                self.f.flush()
+
+    def start(self, uri):
+        # type: (str) -> None
+        self.uri = uri
+        self.write({'started': uri})
+
+    def event(self, conn, vir_dom, *args):
+        # callbacks receive event specific arguments, the opaque value registered with them comes last
+        self.write({'uuid': vir_dom.UUIDString(), 'name': vir_dom.name(), 'event': args[-1]})
+        self.events += 1
+
+    def heartbeat(self):
+        with self.lock:
+            if self.f.closed:
+                return
+            if os.fstat(self.f.fileno()).st_size > self.max_size:
+                self.replace()
+            else:
+                os.utime(self.path, None)
+
+    def replace(self):
+        # the readers see a new file and describe every domain again, the started record resuming the watch
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(json.dumps({'started': self.uri, 'time': time.time()}) + '\n')
+        os.rename(tmp, self.path)
+        self.f.close()
+        self.f = open(self.path, 'a')
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+
+def run_module():
+    module_args = dict(
+        journal=dict(type='path', default=util.JOURNAL_PATH),
+        duration=dict(type='int', default=0),
+        max_size=dict(type='int', default=1024 * 1024),
+    )
+    module_args.update(util.common_args)
+
+    result = dict(
+        changed=False,
+    )
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True,
+    )
+    util.start_profiling(module.params, module)
+
+    path = module.params['journal']
+    duration = module.params['duration']
+    result['journal'] = path
+
+    # the event loop must be registered before the connection is opened
+    util.start_event_loop()
+    conn = util.get_conn(module.params)  # type: libvirt.virConnect
+    if conn is None:
+        module.fail_json(msg='cannot open connection to libvirt', **result)
+
+    done = threading.Event()
+    stopped = ['interrupted']
+
+    def stop(reason):
+        stopped[0] = reason
+        done.set()
+
+    # async jobs are killed with SIGTERM, the journal must still record that the watch ended
+    signal.signal(signal.SIGTERM, lambda *args: stop('terminated'))
+    journal = Journal(path, module.params['max_size'])
+    try:
+        conn.registerCloseCallback(lambda *args: stop('closed'), None)
+        try:
+            # detect a dead daemon instead of waiting on it forever
+            conn.setKeepAlive(5, 3)
+        except libvirt.libvirtError:
+            pass
+        for name, event_id in EVENTS:
+            if hasattr(libvirt, event_id):
+                conn.domainEventRegisterAny(None, getattr(libvirt, event_id), journal.event, name)
+        journal.start(conn.getURI())
+        deadline = util.monotonic() + duration if duration else None
+        while True:
+            timeout = util.JOURNAL_HEARTBEAT
+            if deadline is not None:
+                timeout = min(timeout, deadline - util.monotonic())
+            if timeout <= 0:
+                stopped[0] = 'duration'
+                break
+            if done.wait(timeout):
+                break
+            journal.heartbeat()
+    except libvirt.libvirtError as e:
+        stopped[0] = e.get_error_message()
+        module.fail_json(msg=stopped[0], **result)
+    finally:
+        journal.write({'stopped': stopped[0]})
+        journal.close()
+
+    result['events'] = journal.events
+    util.finish_profiling(result)
+    module.exit_json(**result)
+
+
+def main():
+    run_module()
+
+
+if __name__ == '__main__':
+    main()
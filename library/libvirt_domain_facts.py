@@ -28,6 +28,56 @@ options:
         description:
             - TBD
         required: false
+    compact:
+        description:
+            - Share the equal strings and elements of the C(desc) of every domain while collecting them, which lowers
+              the memory used for large hosts.
+        default: false
+    spill:
+        description:
+            - Path of a file on the managed host receiving the description of every domain as one JSON line, as soon
+              as it is produced. The result then only holds C(count) and C(spill) instead of C(list).
+            - Only a single connection is described in constant memory, with I(uris) the descriptions are gathered in
+              memory by the concurrent workers before being spilled.
+    query:
+        description:
+            - XPath expressions keyed by name, evaluated on the definition of every domain instead of converting it.
+              Each domain is then described by its C(name), C(uuid) and the matched C(values) of every expression.
+            - Full XPath 1.0 needs lxml, otherwise element paths optionally ending with C(/@attribute) or C(/text())
+              are supported.
+    journal:
+        description:
+            - Journal written by M(libvirt_domain_events). The description of every domain is cached on the managed
+              host and only the domains named in the journal since the last run are described again.
+            - Every domain is described when the watch was not running the whole time since the last run, or when
+              its watcher did not touch the journal in the last 30 seconds.
+    journal_cache_dir:
+        description:
+            - Directory holding the cached descriptions on the managed host.
+        default: ~/.cache/ansible-libvirt
+    wait_for:
+        description:
+            - Wait until the named domain, or every running domain, reports an address through its guest C(agent), a
+              DHCP C(lease) or the C(arp) table, returned in C(interfaces_addresses). The domains are waited for
+              concurrently, by up to I(max_workers) threads, and agent connections end the waits early.
+            - The module fails listing the domains in C(not_ready) when some are still not ready after I(wait_timeout).
+        choices: [ agent, lease, arp ]
+    wait_timeout:
+        description:
+            - Seconds to wait for I(wait_for).
+        default: 300
+    uris:
+        description:
+            - Connection URIs queried concurrently, each with its own connection, instead of I(uri). Every domain
+              found is tagged with its C(uri), and C(uris) maps each URI to its C(count) of domains or its error C(msg).
+            - The module fails when any URI fails, the domains of the others are still returned.
+    max_workers:
+        description:
+            - Maximum number of URIs queried, or domains waited for with I(wait_for), at the same time.
+        default: 8
+    timeout:
+        description:
+            - Seconds after which a URI still being queried is reported as failed.
 
 author:
     - Your Name (@bkmeneguello)
@@ -64,6 +114,16 @@ def run_module():
     module_args = dict(
         name=dict(type='str', required=False),
         interfaces_addresses=dict(type='str', required=False, choices=['lease', 'agent', 'arp']),
+        compact=dict(type='bool', default=False),
+        spill=dict(type='path'),
+        query=dict(type='dict'),
+        journal=dict(type='path'),
+        journal_cache_dir=dict(type='path', default=util.CACHE_DIR),
+        uris=dict(type='list'),
+        max_workers=dict(type='int', default=8),
+        timeout=dict(type='float'),
+        wait_for=dict(type='str', choices=list(util.DOMAIN_INTERFACE_ADDRESSES_SOURCES_LOOKUP)),
+        wait_timeout=dict(type='float', default=300),
     )
     module_args.update(util.common_args)
 
@@ -74,30 +134,207 @@ def run_module():
     module = AnsibleModule(
         argument_spec=module_args,
         supports_check_mode=True,
+        mutually_exclusive=[
+            ['journal', 'compact'],
+            ['journal', 'query'],
+            ['journal', 'uris'],
+            ['uri', 'uris'],
+            ['wait_for', 'uris'],
+            ['wait_for', 'journal'],
+        ],
     )
+    util.start_profiling(module.params, module)
 
     name = module.params['name']
-    interfaces_addresses = module.params['interfaces_addresses']
+    # intern table shared by every domain, the nodes become plain dicts when the result is emitted
+    compact = {} if module.params['compact'] else None
+    spill = module.params['spill']
+    journal = module.params['journal']
+    uris = module.params['uris']
+    try:
+        describe = describer(module.params, compact)
+    except ValueError as e:
+        module.fail_json(msg=str(e), **result)
+
+    if uris:
+        results = util.run_parallel(lambda uri: gather(module.params, uri, compact), uris,
+                                    module.params['max_workers'], module.params['timeout'])
+        result['uris'] = {}
+        descs = []
+        failed = []
+        for uri, (uri_descs, error) in zip(uris, results):
+            if error is None:
+                result['uris'][uri] = dict(count=len(uri_descs))
+                descs.extend(uri_descs)
+            else:
+                result['uris'][uri] = dict(msg=error.get_error_message() if isinstance(error, libvirt.libvirtError)
+                                           else str(error))
+                failed.append(uri)
+        emit(descs, spill, result)
+        if failed:
+            module.fail_json(msg='facts gathering failed for {} of {} URIs: {}'.format(
+                len(failed), len(uris), ', '.join(failed)), **result)
+        util.finish_profiling(result)
+        module.exit_json(**result)
+
+    wait_for = module.params['wait_for']
+    if wait_for == 'agent':
+        # the agent events need the event loop registered before the connection is opened
+        util.start_event_loop()
 
     conn = util.get_conn(module.params)  # type: libvirt.virConnect
     if conn is None:
         module.fail_json(msg='Cannot open connection to libvirt', **result)
 
+    addresses = {}
     if name:
         try:
-            vir_dom = conn.lookupByName(name)
+            with util.phase('lookupByName'):
+                vir_dom = conn.lookupByName(name)
             result['exists'] = True
-            result.update(util.describe_domain(vir_dom, interfaces_addresses))
+            if wait_for:
+                addresses = wait(conn, [vir_dom], module.params, result)
+            result.update(describe(vir_dom))
+            if vir_dom.UUIDString() in addresses:
+                result['interfaces_addresses'] = addresses[vir_dom.UUIDString()]
         except libvirt.libvirtError:
             result['exists'] = False
     else:
-        desc_list = [util.describe_domain(vir_dom, interfaces_addresses) for vir_dom in conn.listAllDomains()]
-        result['list'] = desc_list
-        result['exists'] = bool(desc_list)
+        with util.phase('listAllDomains'):
+            vir_doms = conn.listAllDomains()
+        if journal:
+            descs = describe_changed(conn, vir_doms, describe, module.params, result)
+        elif wait_for:
+            addresses = wait(conn, [vir_dom for vir_dom in vir_doms if vir_dom.isActive()], module.params, result)
+            descs = (with_addresses(describe(vir_dom), addresses.get(vir_dom.UUIDString())) for vir_dom in vir_doms)
+        else:
+            descs = (describe(vir_dom) for vir_dom in vir_doms)
+        emit(descs, spill, result)
 
+    if result.get('not_ready'):
+        module.fail_json(msg='{} domains not ready after {} seconds: {}'.format(
+            len(result['not_ready']), module.params['wait_timeout'], ', '.join(result['not_ready'])), **result)
+
+    util.finish_profiling(result)
     module.exit_json(**result)
 
 
+def describer(params, compact):
+    # type: (dict, dict) -> Callable
+    """Function describing a domain as asked by the options, with the queries compiled for the calling thread."""
+    queries = util.compile_query(params['query']) if params['query'] else None
+
+    def describe(vir_dom):
+        if queries is not None:
+            return util.query_domain(vir_dom, queries)
+        return util.describe_domain(vir_dom, params['interfaces_addresses'], compact)
+    return describe
+
+
+def gather(params, uri, compact):
+    # type: (dict, str, dict) -> list
+    """Describe the named domain, or every domain, of one of the uris, on a connection of its own."""
+    describe = describer(params, compact)
+    conn = util.get_conn(dict(params, uri=uri))  # type: libvirt.virConnect
+    try:
+        if params['name']:
+            try:
+                with util.phase('lookupByName'):
+                    vir_doms = [conn.lookupByName(params['name'])]
+            except libvirt.libvirtError as e:
+                if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                    raise
+                vir_doms = []
+        else:
+            with util.phase('listAllDomains'):
+                vir_doms = conn.listAllDomains()
+        return [dict(describe(vir_dom), uri=uri) for vir_dom in vir_doms]
+    finally:
+        conn.close()
+
+
+def wait(conn, vir_doms, params, result):
+    # type: (libvirt.virConnect, list, dict, dict) -> dict
+    """Addresses of the domains ready in time by UUID, the others are listed in not_ready."""
+    results = util.wait_for_guests(conn, vir_doms, params['wait_for'], params['wait_timeout'], params['max_workers'])
+    addresses = {}
+    result['not_ready'] = []
+    for vir_dom, (domain_addresses, error) in zip(vir_doms, results):
+        if error is None:
+            addresses[vir_dom.UUIDString()] = domain_addresses
+        else:
+            result['not_ready'].append(vir_dom.name())
+    return addresses
+
+
+def with_addresses(desc, addresses):
+    # type: (dict, dict) -> dict
+    if addresses is not None:
+        desc['interfaces_addresses'] = addresses
+    return desc
+
+
+def emit(descs, spill, result):
+    # type: (Iterable, str, dict) -> None
+    if spill:
+        result['count'] = util.spill(spill, descs)
+        result['spill'] = spill
+        result['exists'] = bool(result['count'])
+    else:
+        result['list'] = list(descs)
+        result['exists'] = bool(result['list'])
+
+
+def describe_changed(conn, vir_doms, describe, params, result):
+    # type: (libvirt.virConnect, list, Callable, dict, dict) -> list
+    """Describe the domains named in the journal since the last run, reusing the cached description of the others."""
+    cache_dir = params['journal_cache_dir']
+    key = util.cache_key('domain_facts', conn.getURI(), params['journal'])
+    state = util.cache_load(cache_dir, key) or {}
+    cached = state.get('descs')
+    running = state.get('running', False)
+
+    # read before describing, so that changes made meanwhile are described again on the next run
+    records, position = util.read_journal(params['journal'], state.get('position'))
+    if records is None:
+        # replaced or truncated since the last run
+        records, position = util.read_journal(params['journal'])
+        cached, running = None, False
+    changed = set()
+    for record in records:
+        if 'started' in record:
+            # events may have been missed before the watch started
+            cached, running = None, True
+        elif 'stopped' in record:
+            running = False
+        else:
+            changed.add(record['uuid'])
+    if running and not util.journal_alive(params['journal']):
+        # the watcher died without a stopped record
+        running = False
+    if not running:
+        cached = None
+
+    descs = []
+    fresh = {}
+    result['described'] = 0
+    for vir_dom in vir_doms:
+        uuid = vir_dom.UUIDString()
+        desc = cached.get(uuid) if cached is not None and uuid not in changed else None
+        if desc is None:
+            desc = describe(vir_dom)
+            result['described'] += 1
+        elif params['interfaces_addresses']:
+            # addresses change without events
+            desc = dict(desc, interfaces_addresses=util.interface_addresses(vir_dom, params['interfaces_addresses']))
+        fresh[uuid] = desc
+        descs.append(desc)
+
+    if running:
+        util.cache_store(cache_dir, key, {'position': position, 'running': running, 'descs': fresh})
+    return descs
+
+
 def main():
     run_module()
 
@@ -1 +1,304 @@
-# TODO: https://libvirt.org/formatnwfilter.html
\ No newline at end of file
+#!/usr/bin/python
+
+# Copyright: (c) 2018, Bruno Meneguello
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+import json
+
+import ansible.module_utils.libvirt_utils as util
+import libvirt
+from ansible.module_utils.basic import AnsibleModule
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.1',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+DOCUMENTATION = '''
+---
+module: libvirt_filter
+
+short_description: Define network filters and bind them to ports
+
+version_added: "2.7"
+
+description:
+    - "https://libvirt.org/formatnwfilter.html"
+    - Redefining a filter rebuilds the firewall chains of every interface using it, so rules are compared one by
+      one in evaluation order (priority, then position) and the filter is only redefined when they differ.
+
+options:
+    state:
+        description:
+            - TBD
+        choices: [ present, absent ]
+        default: present
+    name:
+        description:
+            - Name of the filter.
+    filter:
+        description:
+            - Filter definition in dict form.
+    xml:
+        description:
+            - Filter definition in XML form.
+    bindings:
+        description:
+            - Filter bindings in dict form, identified by their C(portdev).
+    bindings_state:
+        description:
+            - Whether the I(bindings) must exist.
+        choices: [ present, absent ]
+        default: present
+
+author:
+    - Bruno Meneguello (@bkmeneguello)
+'''
+
+EXAMPLES = '''
+- name: Allow ssh
+  libvirt_filter:
+    filter:
+      _name: allow-ssh
+      _chain: root
+      filterref:
+        _filter: clean-traffic
+      rule:
+        - _action: accept
+          _direction: in
+          _priority: 500
+          tcp:
+            _dstportstart: 22
+        - _action: drop
+          _direction: inout
+          _priority: 1000
+          all: true
+
+- name: Bind filter to ports
+  libvirt_filter:
+    bindings:
+      - owner:
+          name: web
+          uuid: '{{ web.uuid }}'
+        portdev:
+          _name: vnet0
+        mac:
+          _address: '52:54:00:12:34:56'
+        filterref:
+          _filter: allow-ssh
+'''
+
+RETURN = '''
+name:
+    description: filter name
+    type: str
+rules_added:
+    description: rules of the definition missing from the current filter
+    type: list
+rules_removed:
+    description: rules of the current filter missing from the definition
+    type: list
+bindings_created:
+    description: port devices whose binding was created
+    type: list
+bindings_deleted:
+    description: port devices whose binding was deleted
+    type: list
+'''
+
+STATE_PRESENT = 'present'
+STATE_ABSENT = 'absent'
+
+DEFAULT_RULE_PRIORITY = 500
+
+
+def run_module():
+    module_args = dict(
+        state=dict(type='str', choices=[STATE_PRESENT, STATE_ABSENT], default=STATE_PRESENT),
+        name=dict(type='str'),
+        filter=dict(type='dict'),
+        xml=dict(type='str'),
+        bindings=dict(type='list'),
+        bindings_state=dict(type='str', choices=[STATE_PRESENT, STATE_ABSENT], default=STATE_PRESENT),
+    )
+    module_args.update(util.common_args)
+
+    result = dict(
+        changed=False,
+    )
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        mutually_exclusive=[
+            ['filter', 'xml'],
+        ],
+        required_one_of=[
+            ['name', 'filter', 'xml', 'bindings'],
+        ],
+    )
+    util.start_profiling(module.params, module)
+
+    state = module.params['state']
+    nwfilter = module.params['filter']
+    if module.params['xml'] is not None:
+        nwfilter = util.from_xml(module.params['xml'])
+    # the name is an attribute of the filter element
+    name = module.params['name'] or (nwfilter or {}).get('_name')
+    if nwfilter is not None and name:
+        nwfilter.setdefault('_name', name)
+    if state == STATE_PRESENT and name and nwfilter is None:
+        module.fail_json(msg='missing filter definition', **result)
+    bindings = module.params['bindings']
+    bindings_state = module.params['bindings_state']
+
+    conn = util.get_conn(module.params)  # type: libvirt.virConnect
+    if conn is None:
+        module.fail_json(msg='cannot open connection to libvirt', **result)
+
+    try:
+        # bindings are removed before the filter they may reference and created after it
+        if bindings is not None and bindings_state == STATE_ABSENT:
+            apply_bindings(conn, bindings, bindings_state, result)
+
+        if name:
+            result['name'] = name
+            try:
+                with util.phase('nwfilterLookupByName'):
+                    vir_filter = conn.nwfilterLookupByName(name)  # type: libvirt.virNWFilter
+            except libvirt.libvirtError:
+                vir_filter = None
+
+            if state == STATE_PRESENT:
+                if vir_filter is None:
+                    result['rules_added'] = [json.loads(rule) for rule in canonical_rules(nwfilter.get('rule'))]
+                    result['rules_removed'] = []
+                    define_filter(conn, nwfilter)
+                    result['changed'] = True
+                else:
+                    nwfilter['uuid'] = vir_filter.UUIDString()
+                    changed, added, removed = filter_has_changed(vir_filter, nwfilter)
+                    result['rules_added'] = added
+                    result['rules_removed'] = removed
+                    if changed:
+                        define_filter(conn, nwfilter)
+                        result['changed'] = True
+            elif vir_filter is not None:
+                with util.phase('undefine'):
+                    vir_filter.undefine()
+                result['changed'] = True
+
+        if bindings is not None and bindings_state == STATE_PRESENT:
+            apply_bindings(conn, bindings, bindings_state, result)
+    except libvirt.libvirtError as e:
+        module.fail_json(msg=e.get_error_message(), **result)
+    except ValueError as e:
+        module.fail_json(msg=str(e), **result)
+
+    util.finish_profiling(result)
+    module.exit_json(**result)
+
+
+def canonical(value):
+    # type: (object) -> object
+    """Drop ordering and scalar type differences so equal definitions compare equal."""
+    if isinstance(value, dict):
+        return {key: canonical(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [canonical(item) for item in value]
+    if value is None or isinstance(value, bool):
+        return {}
+    return str(value)
+
+
+def canonical_rules(rules):
+    # type: (object) -> list
+    """Rules in evaluation order: by priority, keeping the definition order among equal priorities."""
+    keyed = []
+    for rule in util.as_list(rules):
+        rule = dict(rule)
+        rule.setdefault('_priority', DEFAULT_RULE_PRIORITY)
+        keyed.append((int(rule['_priority']), json.dumps(canonical(rule), sort_keys=True)))
+    return [rule for _, rule in sorted(keyed, key=lambda k: k[0])]
+
+
+def canonical_refs(refs):
+    # type: (object) -> list
+    return sorted(json.dumps(canonical(ref), sort_keys=True) for ref in util.as_list(refs))
+
+
+def filter_has_changed(vir_filter, nwfilter):
+    # type: (libvirt.virNWFilter, dict) -> tuple
+    with util.phase('XMLDesc'):
+        xml = vir_filter.XMLDesc()
+    current = util.from_xml(xml)
+    wanted_rules = canonical_rules(nwfilter.get('rule'))
+    current_rules = canonical_rules(current.get('rule'))
+    wanted_set, current_set = set(wanted_rules), set(current_rules)
+    added = [rule for rule in wanted_rules if rule not in current_set]
+    removed = [rule for rule in current_rules if rule not in wanted_set]
+    changed = wanted_rules != current_rules
+    changed |= canonical_refs(nwfilter.get('filterref')) != canonical_refs(current.get('filterref'))
+    # libvirt fills in chain and priority, so only the attributes given are compared
+    for key, value in nwfilter.items():
+        if key.startswith('_') or key == 'uuid':
+            changed |= str(value) != str(current.get(key))
+    return changed, [json.loads(rule) for rule in added], [json.loads(rule) for rule in removed]
+
+
+def define_filter(conn, nwfilter):
+    # type: (libvirt.virConnect, dict) -> libvirt.virNWFilter
+    xml = encode_filter(nwfilter)
+    with util.phase('nwfilterDefineXML'):
+        return conn.nwfilterDefineXML(xml)
+
+
+def apply_bindings(conn, bindings, state, result):
+    # type: (libvirt.virConnect, list, str, dict) -> None
+    # a single listing indexed by port device, which is cached on the binding objects
+    with util.phase('listAllNWFilterBindings'):
+        vir_bindings = conn.listAllNWFilterBindings()
+    existing = {vir_binding.portDev(): vir_binding for vir_binding in vir_bindings}
+    created = result.setdefault('bindings_created', [])
+    deleted = result.setdefault('bindings_deleted', [])
+    for binding in bindings:
+        portdev = (binding.get('portdev') or {}).get('_name')
+        if not portdev:
+            raise ValueError('binding without portdev name')
+        vir_binding = existing.get(portdev)
+        if state == STATE_ABSENT:
+            if vir_binding is not None:
+                with util.phase('delete'):
+                    vir_binding.delete()
+                deleted.append(portdev)
+            continue
+        if vir_binding is not None:
+            eq, _, _ = util.compare(canonical(binding), canonical(util.from_xml(vir_binding.XMLDesc())), 'filterbinding')
+            if eq:
+                continue
+            # bindings cannot be modified in place
+            with util.phase('delete'):
+                vir_binding.delete()
+            deleted.append(portdev)
+        xml = encode_binding(binding)
+        with util.phase('nwfilterBindingCreateXML'):
+            conn.nwfilterBindingCreateXML(xml)
+        created.append(portdev)
+    result['changed'] |= bool(created or deleted)
+
+
+def encode_filter(nwfilter):
+    # type: (dict) -> str
+    return util.to_xml_str({'filter': nwfilter})
+
+
+def encode_binding(binding):
+    # type: (dict) -> str
+    return util.to_xml_str({'filterbinding': binding})
+
+
+def main():
+    run_module()
+
+
+if __name__ == '__main__':
+    main()
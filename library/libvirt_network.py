@@ -65,6 +65,7 @@ def run_module():
             ['state', STATE_DESTROYED, ['name']],
         ],
     )
+    util.start_profiling(module.params, module)
 
     network = module.params['network']
     if module.params['xml'] is not None:
@@ -85,7 +86,8 @@ def run_module():
         module.fail_json(msg='cannot open connection to libvirt', **result)
 
     try:
-        vir_net = conn.networkLookupByName(name)  # type: libvirt.virNetwork
+        with util.phase('networkLookupByName'):
+            vir_net = conn.networkLookupByName(name)  # type: libvirt.virNetwork
         if network:
             network['uuid'] = vir_net.UUIDString()
     except libvirt.libvirtError as e:
@@ -116,7 +118,7 @@ def run_module():
             result['changed'] = True
             if persistent:
                 vir_net = define_network(conn, network, autostart)
-                vir_net.create()
+                start_network(vir_net)
             else:
                 vir_net = create_network(conn, network)
             result.update(util.describe_network(vir_net))
@@ -131,7 +133,7 @@ def run_module():
                 result['changed'] = True
                 vir_net = define_network(conn, network, autostart)
                 if not vir_net.isActive():
-                    vir_net.create()
+                    start_network(vir_net)
                 result.update(util.describe_network(vir_net))
             elif vir_net.isPersistent():
                 result['changed'] = True
@@ -150,44 +152,57 @@ def run_module():
             result['changed'] = True
             destroy_network(vir_net)
 
+    util.finish_profiling(result)
     module.exit_json(**result)
 
 
 def create_network(conn, network):
     xml = encode_network(network)
-    vir_dom = conn.networkCreateXML(xml)
+    with util.phase('networkCreateXML'):
+        vir_dom = conn.networkCreateXML(xml)
     return vir_dom
 
 
 def define_network(conn, domain, autostart):
     xml = encode_network(domain)
-    vir_net = conn.networkDefineXML(xml)
-    vir_net.setAutostart(autostart)
+    with util.phase('networkDefineXML'):
+        vir_net = conn.networkDefineXML(xml)
+        vir_net.setAutostart(autostart)
     return vir_net
 
 
+def start_network(vir_net):
+    # type: (libvirt.virNetwork) -> int
+    with util.phase('create'):
+        return vir_net.create()
+
+
 def undefine_network(vir_net):
     # type: (libvirt.virNetwork) -> Any
-    return vir_net.undefine()
+    with util.phase('undefine'):
+        return vir_net.undefine()
 
 
 def destroy_network(vir_net):
     # type: (libvirt.virNetwork) -> Any
-    return vir_net.destroy()
+    with util.phase('destroy'):
+        return vir_net.destroy()
 
 
 def network_has_changed(vir_net, network, active=False):
     # type: (libvirt.virNetwork, dict, bool) -> tuple
     flags = libvirt.VIR_NETWORK_XML_INACTIVE if not active else 0
-    current = util.from_xml(vir_net.XMLDesc(flags))
-    eq, path, cause = util.compare(network, current, 'network')
+    with util.phase('XMLDesc'):
+        xml = vir_net.XMLDesc(flags)
+    current = util.from_xml(xml)
+    with util.phase('compare'):
+        eq, path, cause = util.compare(network, current, 'network')
     return not eq, path, cause
 
 
 def encode_network(network):
     # type: (dict) -> str
-    xml = util.to_xml({'network': network})
-    return util.xml_to_str(xml)
+    return util.to_xml_str({'network': network})
 
 
 def main():
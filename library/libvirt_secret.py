@@ -1 +1,335 @@
-# TODO: https://libvirt.org/formatsecret.html
\ No newline at end of file
+#!/usr/bin/python
+
+# Copyright: (c) 2018, Bruno Meneguello
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+import base64
+import errno
+import hashlib
+import hmac
+import os
+
+import ansible.module_utils.libvirt_utils as util
+import libvirt
+from ansible.module_utils.basic import AnsibleModule
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.1',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+DOCUMENTATION = '''
+---
+module: libvirt_secret
+
+short_description: Define secrets and set their values
+
+version_added: "2.7"
+
+description:
+    - "https://libvirt.org/formatsecret.html"
+    - Existing secrets are found with a single listing indexed by UUID and by usage, and values are only set when
+      their digest differs.
+
+options:
+    state:
+        description:
+            - TBD
+        choices: [ present, absent ]
+        default: present
+    secret:
+        description:
+            - Secret definition in dict form.
+    xml:
+        description:
+            - Secret definition in XML form.
+    value:
+        description:
+            - Secret value.
+    encoding:
+        description:
+            - Encoding of I(value).
+        choices: [ raw, base64 ]
+        default: raw
+    uuid:
+        description:
+            - UUID of the secret, looked up when absent.
+    usage_type:
+        description:
+            - Usage type of the secret, looked up with I(usage_id) when absent.
+        choices: [ none, volume, ceph, iscsi, tls, vtpm ]
+    usage_id:
+        description:
+            - Usage identifier of the secret, e.g. the ceph name or the iscsi target.
+    secrets:
+        description:
+            - List of secrets handled in one call, each item accepting I(state), I(secret), I(xml), I(value),
+              I(encoding), I(uuid), I(usage_type) and I(usage_id).
+    cache_dir:
+        description:
+            - Directory keeping the digest of private secret values, which cannot be read back. The digests are
+              HMACs keyed with a random key of the host, kept in the directory readable by its owner only.
+        default: ~/.cache/ansible-libvirt
+
+author:
+    - Bruno Meneguello (@bkmeneguello)
+'''
+
+EXAMPLES = '''
+- name: Define ceph secret
+  libvirt_secret:
+    secret:
+      _ephemeral: 'no'
+      _private: 'yes'
+      usage:
+        _type: ceph
+        name: client.libvirt secret
+    value: '{{ ceph_key }}'
+    encoding: base64
+
+- name: Define many secrets
+  libvirt_secret:
+    secrets:
+      - secret:
+          usage:
+            _type: iscsi
+            target: libvirtiscsi
+        value: '{{ iscsi_password }}'
+      - state: absent
+        usage_type: ceph
+        usage_id: client.old secret
+'''
+
+RETURN = '''
+uuid:
+    description: UUID of the secret
+    type: str
+usage_type:
+    description: usage type of the secret
+    type: str
+usage_id:
+    description: usage identifier of the secret
+    type: str
+defined:
+    description: whether the secret definition was written
+    type: bool
+value_changed:
+    description: whether the secret value was written
+    type: bool
+results:
+    description: one entry per item of I(secrets), with the same keys as above plus changed
+    type: list
+'''
+
+STATE_PRESENT = 'present'
+STATE_ABSENT = 'absent'
+
+USAGE_TYPES = {
+    'none': libvirt.VIR_SECRET_USAGE_TYPE_NONE,
+    'volume': libvirt.VIR_SECRET_USAGE_TYPE_VOLUME,
+    'ceph': libvirt.VIR_SECRET_USAGE_TYPE_CEPH,
+    'iscsi': libvirt.VIR_SECRET_USAGE_TYPE_ISCSI,
+}
+
+if hasattr(libvirt, 'VIR_SECRET_USAGE_TYPE_TLS'):
+    USAGE_TYPES['tls'] = libvirt.VIR_SECRET_USAGE_TYPE_TLS
+if hasattr(libvirt, 'VIR_SECRET_USAGE_TYPE_VTPM'):
+    USAGE_TYPES['vtpm'] = libvirt.VIR_SECRET_USAGE_TYPE_VTPM
+
+# child of <usage> holding the usage identifier
+USAGE_ID_TAGS = {
+    'volume': 'volume',
+    'ceph': 'name',
+    'iscsi': 'target',
+    'tls': 'name',
+    'vtpm': 'name',
+}
+
+
+def run_module():
+    item_args = dict(
+        state=dict(type='str', choices=[STATE_PRESENT, STATE_ABSENT], default=STATE_PRESENT),
+        secret=dict(type='dict'),
+        xml=dict(type='str'),
+        value=dict(type='str', no_log=True),
+        encoding=dict(type='str', choices=['raw', 'base64'], default='raw'),
+        uuid=dict(type='str'),
+        usage_type=dict(type='str', choices=sorted(USAGE_TYPES.keys())),
+        usage_id=dict(type='str'),
+    )
+    module_args = dict(
+        # only the values are hidden, the whole list would mask every state, usage type and identifier
+        secrets=dict(type='list', elements='dict', options=item_args, mutually_exclusive=[['secret', 'xml']]),
+        cache_dir=dict(type='path', default=util.CACHE_DIR),
+    )
+    module_args.update(item_args)
+    module_args.update(util.common_args)
+
+    result = dict(
+        changed=False,
+    )
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        mutually_exclusive=[
+            ['secret', 'xml'],
+            ['secrets', 'secret'],
+            ['secrets', 'xml'],
+            ['secrets', 'uuid'],
+            ['secrets', 'usage_type'],
+        ],
+    )
+    util.start_profiling(module.params, module)
+
+    secrets = module.params['secrets']
+    items = secrets if secrets is not None else [{arg: module.params[arg] for arg in item_args}]
+    cache_dir = module.params['cache_dir']
+
+    conn = util.get_conn(module.params)  # type: libvirt.virConnect
+    if conn is None:
+        module.fail_json(msg='cannot open connection to libvirt', **result)
+
+    # a single listing, UUID and usage are cached on the secret objects so indexing makes no further calls
+    by_uuid = {}
+    by_usage = {}
+    with util.phase('listAllSecrets'):
+        vir_secrets = conn.listAllSecrets()
+    for vir_secret in vir_secrets:
+        by_uuid[vir_secret.UUIDString()] = vir_secret
+        by_usage[(vir_secret.usageType(), vir_secret.usageID())] = vir_secret
+
+    results = []
+    for item in items:
+        try:
+            desc = apply_secret(conn, item, by_uuid, by_usage, cache_dir)
+        except (ValueError, TypeError) as e:
+            module.fail_json(msg=str(e), results=results, **result)
+        except libvirt.libvirtError as e:
+            module.fail_json(msg=e.get_error_message(), results=results, **result)
+        result['changed'] |= desc['changed']
+        results.append(desc)
+
+    if secrets is not None:
+        result['results'] = results
+    else:
+        result.update(results[0])
+
+    util.finish_profiling(result)
+    module.exit_json(**result)
+
+
+def apply_secret(conn, item, by_uuid, by_usage, cache_dir):
+    # type: (libvirt.virConnect, dict, dict, dict, str) -> dict
+    secret = item.get('secret')
+    if item.get('xml') is not None:
+        secret = util.from_xml(item['xml'])
+    secret = dict(secret or {})
+    # libvirt always reports these attributes, missing ones would look like a change on every run
+    secret.setdefault('_ephemeral', 'no')
+    secret.setdefault('_private', 'no')
+
+    usage = secret.get('usage') or {}
+    usage_type = item.get('usage_type') or usage.get('_type')
+    usage_id = item.get('usage_id') or usage.get(USAGE_ID_TAGS.get(usage_type))
+    if usage_type is not None and usage_type not in USAGE_TYPES:
+        raise ValueError('unsupported usage type {}'.format(usage_type))
+    uuid = item.get('uuid') or secret.get('uuid')
+
+    vir_secret = by_uuid.get(uuid)
+    if vir_secret is None and usage_type not in (None, 'none'):
+        vir_secret = by_usage.get((USAGE_TYPES[usage_type], usage_id))
+
+    desc = dict(changed=False, defined=False, value_changed=False, usage_type=usage_type, usage_id=usage_id)
+
+    if item.get('state', STATE_PRESENT) == STATE_ABSENT:
+        if vir_secret is not None:
+            desc['uuid'] = vir_secret.UUIDString()
+            with util.phase('undefine'):
+                vir_secret.undefine()
+            desc['changed'] = True
+        return desc
+
+    if vir_secret is None or secret_has_changed(vir_secret, secret):
+        xml = encode_secret(secret)
+        with util.phase('secretDefineXML'):
+            vir_secret = conn.secretDefineXML(xml)
+        desc['defined'] = True
+    desc['uuid'] = vir_secret.UUIDString()
+
+    value = item.get('value')
+    if value is not None:
+        value = base64.b64decode(value) if item.get('encoding') == 'base64' else value.encode('utf-8')
+        if desc['defined'] or not value_matches(vir_secret, value, cache_dir):
+            with util.phase('setValue'):
+                vir_secret.setValue(value)
+            desc['value_changed'] = True
+            if secret.get('_private') == 'yes':
+                util.cache_store(cache_dir, value_cache_key(vir_secret), {'hmac': value_digest(value, cache_dir)})
+
+    desc['changed'] = desc['defined'] or desc['value_changed']
+    return desc
+
+
+def secret_has_changed(vir_secret, secret):
+    # type: (libvirt.virSecret, dict) -> bool
+    secret['uuid'] = vir_secret.UUIDString()
+    with util.phase('XMLDesc'):
+        xml = vir_secret.XMLDesc()
+    current = util.from_xml(xml)
+    with util.phase('compare'):
+        eq, _, _ = util.compare(secret, current, 'secret')
+    return not eq
+
+
+def value_matches(vir_secret, value, cache_dir):
+    # type: (libvirt.virSecret, bytes, str) -> bool
+    try:
+        with util.phase('value'):
+            current = vir_secret.value()
+        return hmac.compare_digest(current, value)
+    except libvirt.libvirtError:
+        # private secrets cannot be read back, rely on the digest of the last value set
+        entry = util.cache_load(cache_dir, value_cache_key(vir_secret))
+        return bool(entry) and 'hmac' in entry and hmac.compare_digest(entry['hmac'], value_digest(value, cache_dir))
+
+
+def value_digest(value, cache_dir):
+    # type: (bytes, str) -> str
+    """HMAC of a value keyed with the random key of the host, an unkeyed hash of short values is easily reversed."""
+    return hmac.new(digest_key(cache_dir), value, hashlib.sha256).hexdigest()
+
+
+def digest_key(cache_dir):
+    # type: (str) -> bytes
+    path = os.path.join(cache_dir, 'secret-digest.key')
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, 0o700)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        with open(path, 'rb') as f:
+            return f.read()
+    key = os.urandom(32)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    return key
+
+
+def value_cache_key(vir_secret):
+    # type: (libvirt.virSecret) -> str
+    return util.cache_key('secret', vir_secret.connect().getURI(), vir_secret.UUIDString())
+
+
+def encode_secret(secret):
+    # type: (dict) -> str
+    return util.to_xml_str({'secret': secret})
+
+
+def main():
+    run_module()
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,370 @@
-# TODO: https://libvirt.org/formatsnapshot.html
\ No newline at end of file
+#!/usr/bin/python
+
+# Copyright: (c) 2018, Bruno Meneguello
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from functools import partial
+
+import ansible.module_utils.libvirt_utils as util
+import libvirt
+from ansible.module_utils.basic import AnsibleModule
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.1',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+DOCUMENTATION = '''
+---
+module: libvirt_snapshot
+
+short_description: Create, revert and delete domain snapshots
+
+version_added: "2.7"
+
+description:
+    - "https://libvirt.org/formatsnapshot.html"
+
+options:
+    state:
+        description:
+            - C(present) creates the snapshot when missing, C(reverted) reverts the domain to it
+              and C(absent) deletes it.
+            - The domain may have changed since the snapshot even when it is the current one, so C(reverted)
+              always reverts and reports a change.
+        choices: [ present, reverted, absent ]
+        default: present
+    domain:
+        description:
+            - Name of the domain.
+    domains:
+        description:
+            - Names of the domains to handle concurrently (fleet mode).
+    name:
+        description:
+            - Name of the snapshot, required unless I(state=present).
+    snapshot:
+        description:
+            - Snapshot definition in dict form.
+    xml:
+        description:
+            - Snapshot definition in XML form.
+    disk_only:
+        description:
+            - Create an external disk-only snapshot.
+        default: false
+    quiesce:
+        description:
+            - Freeze and thaw guest filesystems through the guest agent.
+        default: false
+    atomic:
+        description:
+            - Either snapshot every disk or none.
+        default: false
+    live:
+        description:
+            - Take the snapshot while the domain keeps running.
+        default: false
+    no_metadata:
+        description:
+            - Do not keep snapshot metadata in libvirt. The snapshot cannot be looked up again then, so every run
+              creates a new one and reports a change.
+        default: false
+    reuse_ext:
+        description:
+            - Reuse existing external files.
+        default: false
+    revert_running:
+        description:
+            - Run the domain after reverting.
+        default: false
+    revert_paused:
+        description:
+            - Pause the domain after reverting.
+        default: false
+    revert_force:
+        description:
+            - Allow risky reverts.
+        default: false
+    delete_children:
+        description:
+            - Also delete the descendants of the snapshot.
+        default: false
+    delete_children_only:
+        description:
+            - Only delete the descendants of the snapshot.
+        default: false
+    delete_metadata_only:
+        description:
+            - Only delete libvirt metadata, keeping the snapshot data.
+        default: false
+    max_workers:
+        description:
+            - Maximum number of domains handled at the same time in fleet mode.
+        default: 10
+
+author:
+    - Bruno Meneguello (@bkmeneguello)
+'''
+
+EXAMPLES = '''
+# Snapshot a single domain
+- name: Snapshot web
+  libvirt_snapshot:
+    domain: web
+    snapshot:
+      name: nightly
+      description: nightly backup
+
+# Consistent disk-only snapshots of many domains, 20 at a time
+- name: Snapshot the fleet
+  libvirt_snapshot:
+    domains: '{{ groups.vms }}'
+    name: nightly
+    disk_only: true
+    quiesce: true
+    atomic: true
+    max_workers: 20
+
+# Revert a domain and start it
+- name: Revert web
+  libvirt_snapshot:
+    state: reverted
+    domain: web
+    name: nightly
+    revert_running: true
+
+# Delete a snapshot
+- name: Delete snapshot
+  libvirt_snapshot:
+    state: absent
+    domain: web
+    name: nightly
+'''
+
+RETURN = '''
+name:
+    description: snapshot name
+    type: str
+domain:
+    description: domain name
+    type: str
+duration:
+    description: seconds spent on the domain
+    type: float
+xml:
+    description: snapshot XML definition
+    type: str
+desc:
+    description: snapshot definition in dict form
+    type: dict
+results:
+    description: one entry per domain in fleet mode, with the same keys as above plus changed and failed
+    type: list
+'''
+
+STATE_PRESENT = 'present'
+STATE_REVERTED = 'reverted'
+STATE_ABSENT = 'absent'
+
+
+def run_module():
+    module_args = dict(
+        state=dict(type='str',
+                   choices=[STATE_PRESENT, STATE_REVERTED, STATE_ABSENT],
+                   default=STATE_PRESENT),
+        domain=dict(type='str'),
+        domains=dict(type='list'),
+        name=dict(type='str'),
+        snapshot=dict(type='dict'),
+        xml=dict(type='str'),
+        disk_only=dict(type='bool', default=False),
+        quiesce=dict(type='bool', default=False),
+        atomic=dict(type='bool', default=False),
+        live=dict(type='bool', default=False),
+        no_metadata=dict(type='bool', default=False),
+        reuse_ext=dict(type='bool', default=False),
+        revert_running=dict(type='bool', default=False),
+        revert_paused=dict(type='bool', default=False),
+        revert_force=dict(type='bool', default=False),
+        delete_children=dict(type='bool', default=False),
+        delete_children_only=dict(type='bool', default=False),
+        delete_metadata_only=dict(type='bool', default=False),
+        max_workers=dict(type='int', default=10),
+    )
+    module_args.update(util.common_args)
+
+    result = dict(
+        changed=False,
+    )
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        mutually_exclusive=[
+            ['domain', 'domains'],
+            ['snapshot', 'xml'],
+            ['revert_running', 'revert_paused'],
+            ['delete_children', 'delete_children_only'],
+        ],
+        required_one_of=[
+            ['domain', 'domains'],
+        ],
+    )
+    util.start_profiling(module.params, module)
+
+    state = module.params['state']
+    snapshot = module.params['snapshot'] or {}
+    if module.params['xml'] is not None:
+        snapshot = util.from_xml(module.params['xml'])
+
+    name = module.params['name'] or snapshot.get('name')
+    if state != STATE_PRESENT and not name:
+        module.fail_json(msg='missing snapshot name', **result)
+    if name:
+        snapshot['name'] = name
+
+    conn = util.get_conn(module.params)  # type: libvirt.virConnect
+    if conn is None:
+        module.fail_json(msg='cannot open connection to libvirt', **result)
+
+    if state == STATE_PRESENT:
+        # the definition is the same for every domain, so it is encoded once
+        xml = encode_snapshot(snapshot)
+        flags = create_flags(module.params)
+        action = partial(create_snapshot, name=name, xml=xml, flags=flags)
+    elif state == STATE_REVERTED:
+        flags = revert_flags(module.params)
+        action = partial(revert_snapshot, name=name, flags=flags)
+    else:
+        flags = delete_flags(module.params)
+        action = partial(delete_snapshot, name=name, flags=flags)
+
+    domains = module.params['domains']
+    if domains is None:
+        desc, error = run_on_domain(conn, module.params['domain'], action)
+        if error is not None:
+            module.fail_json(msg=str(error), **result)
+        result.update(desc)
+    else:
+        results = util.run_parallel(lambda domain: run_on_domain(conn, domain, action),
+                                    domains, module.params['max_workers'])
+        result['results'] = []
+        failed = []
+        for domain, (outcome, error) in zip(domains, results):
+            desc, error = outcome if error is None else (dict(domain=domain, changed=False), error)
+            desc['failed'] = error is not None
+            if error is not None:
+                desc['msg'] = str(error)
+                failed.append(domain)
+            result['changed'] |= desc['changed']
+            result['results'].append(desc)
+        if failed:
+            module.fail_json(msg='snapshot failed for {} of {} domains: {}'.format(
+                len(failed), len(domains), ', '.join(failed)), **result)
+
+    util.finish_profiling(result)
+    module.exit_json(**result)
+
+
+def run_on_domain(conn, domain, action):
+    # type: (libvirt.virConnect, str, Callable) -> tuple
+    desc = {
+        'domain': domain,
+        'changed': False,
+    }
+    start = util.monotonic()
+    error = None
+    try:
+        with util.phase('lookupByName'):
+            vir_dom = conn.lookupByName(domain)  # type: libvirt.virDomain
+        desc.update(action(vir_dom))
+    except libvirt.libvirtError as e:
+        error = e
+    desc['duration'] = util.monotonic() - start
+    return desc, error
+
+
+def lookup_snapshot(vir_dom, name):
+    # type: (libvirt.virDomain, str) -> libvirt.virDomainSnapshot
+    try:
+        with util.phase('snapshotLookupByName'):
+            return vir_dom.snapshotLookupByName(name)
+    except libvirt.libvirtError:
+        return None
+
+
+def create_snapshot(vir_dom, name, xml, flags):
+    # type: (libvirt.virDomain, str, str, int) -> dict
+    vir_snap = lookup_snapshot(vir_dom, name) if name else None
+    changed = vir_snap is None
+    if changed:
+        with util.phase('snapshotCreateXML'):
+            vir_snap = vir_dom.snapshotCreateXML(xml, flags)
+    desc = dict(changed=changed)
+    if not flags & libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA:
+        desc.update(util.describe_snapshot(vir_snap))
+    return desc
+
+
+def revert_snapshot(vir_dom, name, flags):
+    # type: (libvirt.virDomain, str, int) -> dict
+    with util.phase('snapshotLookupByName'):
+        vir_snap = vir_dom.snapshotLookupByName(name)
+    with util.phase('revertToSnapshot'):
+        vir_dom.revertToSnapshot(vir_snap, flags)
+    desc = dict(changed=True)
+    desc.update(util.describe_snapshot(vir_snap))
+    return desc
+
+
+def delete_snapshot(vir_dom, name, flags):
+    # type: (libvirt.virDomain, str, int) -> dict
+    vir_snap = lookup_snapshot(vir_dom, name)
+    if vir_snap is None:
+        return dict(changed=False, name=name)
+    with util.phase('delete'):
+        vir_snap.delete(flags)
+    return dict(changed=True, name=name)
+
+
+def create_flags(params):
+    # type: (dict) -> int
+    flags = 0
+    flags |= libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY if params['disk_only'] else 0
+    flags |= libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_QUIESCE if params['quiesce'] else 0
+    flags |= libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC if params['atomic'] else 0
+    flags |= libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_LIVE if params['live'] else 0
+    flags |= libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA if params['no_metadata'] else 0
+    flags |= libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_REUSE_EXT if params['reuse_ext'] else 0
+    return flags
+
+
+def revert_flags(params):
+    # type: (dict) -> int
+    flags = 0
+    flags |= libvirt.VIR_DOMAIN_SNAPSHOT_REVERT_RUNNING if params['revert_running'] else 0
+    flags |= libvirt.VIR_DOMAIN_SNAPSHOT_REVERT_PAUSED if params['revert_paused'] else 0
+    flags |= libvirt.VIR_DOMAIN_SNAPSHOT_REVERT_FORCE if params['revert_force'] else 0
+    return flags
+
+
+def delete_flags(params):
+    # type: (dict) -> int
+    flags = 0
+    flags |= libvirt.VIR_DOMAIN_SNAPSHOT_DELETE_CHILDREN if params['delete_children'] else 0
+    flags |= libvirt.VIR_DOMAIN_SNAPSHOT_DELETE_CHILDREN_ONLY if params['delete_children_only'] else 0
+    flags |= libvirt.VIR_DOMAIN_SNAPSHOT_DELETE_METADATA_ONLY if params['delete_metadata_only'] else 0
+    return flags
+
+
+def encode_snapshot(snapshot):
+    # type: (dict) -> str
+    return util.to_xml_str({'domainsnapshot': snapshot})
+
+
+def main():
+    run_module()
+
+
+if __name__ == '__main__':
+    main()
@@ -30,6 +30,37 @@ options:
         description:
             - TBD
         required: false
+    clone:
+        description:
+            - Name of a volume of the same pool to create the volume from, with its content.
+        required: false
+    reflink:
+        description:
+            - Share the blocks of the I(clone) instead of copying them, on pools supporting it like btrfs or XFS,
+              which makes the clone instant.
+        default: false
+    prealloc_metadata:
+        description:
+            - Preallocate the metadata of qcow2 volumes, avoiding allocation stalls on the first writes of the guest.
+        default: false
+    resize:
+        description:
+            - Capacity in bytes the volume is resized to when it differs from the current one.
+            - A capacity above it by less than I(resize_rounding) is taken as already resized, the storage backends
+              rounding the capacity up to their allocation unit.
+        required: false
+    resize_rounding:
+        description:
+            - Largest rounding in bytes of the capacity by the storage backend, like the extent size of LVM pools.
+        default: 4194304
+    resize_allocate:
+        description:
+            - Allocate the space added by I(resize) instead of leaving it sparse.
+        default: false
+    resize_shrink:
+        description:
+            - Allow I(resize) to reduce the capacity, losing the data beyond it.
+        default: false
 
 author:
     - Your Name (@bkmeneguello)
@@ -54,6 +85,9 @@ EXAMPLES = '''
 '''
 
 RETURN = '''
+resized:
+    description: capacity in bytes the volume was resized to, when it differed
+    type: int
 original_message:
     description: The original name param that was passed in
     type: str
@@ -71,6 +105,12 @@ def run_module():
         xml=dict(type='str'),
         upload=dict(type='path'),
         resize=dict(type='int'),
+        resize_allocate=dict(type='bool', default=False),
+        resize_shrink=dict(type='bool', default=False),
+        resize_rounding=dict(type='int', default=4 * 1024 * 1024),
+        clone=dict(type='str'),
+        reflink=dict(type='bool', default=False),
+        prealloc_metadata=dict(type='bool', default=False),
     )
     module_args.update(util.common_args)
 
@@ -85,14 +125,17 @@ def run_module():
         ],
         required_if=[
             ['state', 'present', ['volume', 'xml'], True],
-            ['state', 'absent', ['name']]
+            ['state', 'absent', ['name']],
+            ['reflink', True, ['clone']],
         ]
     )
+    util.start_profiling(module.params, module)
 
     state = module.params['state']
     pool = module.params['pool']
     upload = module.params['upload']
     resize = module.params['resize']
+    clone = module.params['clone']
 
     volume = module.params['volume']
     if module.params['xml'] is not None:
@@ -108,53 +151,99 @@ def run_module():
 
     vir_pool = None
     try:
-        vir_pool = conn.storagePoolLookupByName(pool)
+        with util.phase('storagePoolLookupByName'):
+            vir_pool = conn.storagePoolLookupByName(pool)
     except libvirt.libvirtError:
         pass
 
     vir_vol = None
     if vir_pool is not None:
         try:
-            vir_vol = vir_pool.storageVolLookupByName(name)
+            with util.phase('storageVolLookupByName'):
+                vir_vol = vir_pool.storageVolLookupByName(name)
         except libvirt.libvirtError:
             pass
 
     if state == 'absent':
         if vir_vol is not None:
-            vir_vol.delete()
+            with util.phase('delete'):
+                vir_vol.delete()
             result['name'] = vir_vol.name()
             result['changed'] = True
     elif state == 'present':
         if vir_vol is None:
             xml = encode_volume(volume)
-            vir_vol = vir_pool.createXML(xml)
+            flags = create_flags(module.params)
+            try:
+                if clone is not None:
+                    with util.phase('storageVolLookupByName'):
+                        vir_clone = vir_pool.storageVolLookupByName(clone)
+                    with util.phase('createXMLFrom'):
+                        vir_vol = vir_pool.createXMLFrom(xml, vir_clone, flags)
+                else:
+                    with util.phase('createXML'):
+                        vir_vol = vir_pool.createXML(xml, flags)
+            except libvirt.libvirtError as e:
+                module.fail_json(msg=e.get_error_message(), **result)
             result['changed'] = True
             result.update(util.describe_volume(vir_vol))
 
             if upload is not None:
                 size = os.path.getsize(upload)
                 if not module.check_mode:
-                    stream = conn.newStream()
-                    vir_vol.upload(stream, 0, size)
-                    with open(upload, 'rb') as f:
-                        stream.sendAll(lambda _, data, file_: file_.read(data), f)
-                    stream.finish()
+                    with util.phase('upload'):
+                        stream = conn.newStream()
+                        vir_vol.upload(stream, 0, size)
+                        with open(upload, 'rb') as f:
+                            stream.sendAll(lambda _, data, file_: file_.read(data), f)
+                        stream.finish()
                 result['uploaded'] = upload
                 result['uploaded_bytes'] = size
-
-            if resize is not None:
-                vir_vol.resize(resize)
-                result['resized'] = resize
         else:
             # TODO
             result.update(util.describe_volume(vir_vol))
 
+        if resize is not None:
+            with util.phase('info'):
+                capacity = vir_vol.info()[1]
+            # the backends round the capacity up, a resize within that rounding is already done
+            rounded = resize <= capacity < resize + module.params['resize_rounding']
+            if not rounded and resize < capacity and not module.params['resize_shrink']:
+                module.fail_json(msg='shrinking volume from {} to {} bytes needs resize_shrink'.format(
+                    capacity, resize), **result)
+            if not rounded:
+                try:
+                    with util.phase('resize'):
+                        vir_vol.resize(resize, resize_flags(module.params, resize < capacity))
+                except libvirt.libvirtError as e:
+                    module.fail_json(msg=e.get_error_message(), **result)
+                result['changed'] = True
+                result['resized'] = resize
+                result.update(util.describe_volume(vir_vol))
+
+    util.finish_profiling(result)
     module.exit_json(**result)
 
 
+def create_flags(params):
+    # type: (dict) -> int
+    flags = 0
+    flags |= libvirt.VIR_STORAGE_VOL_CREATE_PREALLOC_METADATA if params['prealloc_metadata'] else 0
+    flags |= libvirt.VIR_STORAGE_VOL_CREATE_REFLINK if params['reflink'] else 0
+    return flags
+
+
+def resize_flags(params, shrink):
+    # type: (dict, bool) -> int
+    flags = 0
+    flags |= libvirt.VIR_STORAGE_VOL_RESIZE_ALLOCATE if params['resize_allocate'] else 0
+    # growing rejects the shrink flag, it is only passed when reducing the capacity
+    flags |= libvirt.VIR_STORAGE_VOL_RESIZE_SHRINK if shrink and params['resize_shrink'] else 0
+    return flags
+
+
 def encode_volume(volume):
-    xml = util.to_xml({'volume': volume})
-    return util.xml_to_str(xml)
+    return util.to_xml_str({'volume': volume})
 
 
 def main():
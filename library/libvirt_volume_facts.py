@@ -2,6 +2,7 @@
 
 # Copyright: (c) 2018, Terry Jones <terry.jones@example.org>
 # GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+import re
 
 import ansible.module_utils.libvirt_utils as util
 import libvirt
@@ -29,6 +30,73 @@ options:
         description:
             - TBD
         required: false
+    all:
+        description:
+            - Deprecated and ignored, every volume of the pool is listed unless filtered.
+        required: false
+    pattern:
+        description:
+            - Only list volumes whose name matches this glob pattern.
+        required: false
+    regex:
+        description:
+            - Only list volumes whose name matches this regular expression.
+        required: false
+    detail:
+        description:
+            - C(name) returns only names and keys, C(info) adds type, capacity and allocation,
+              C(full) adds path and XML definition.
+        choices: [ name, info, full ]
+        default: full
+    parse:
+        description:
+            - Convert the XML definition of each matched volume into C(desc) when I(detail=full).
+        default: true
+    offset:
+        description:
+            - Number of matched volumes, sorted by name, to skip.
+        default: 0
+    limit:
+        description:
+            - Maximum number of volumes to describe.
+        required: false
+    spill:
+        description:
+            - Path of a file on the managed host receiving the description of every volume as one JSON line, as soon
+              as it is produced. The result then only holds C(count) and C(spill) instead of C(list).
+            - Only a single pool is described in constant memory, with I(uris) or I(all_pools) the descriptions
+              are gathered in memory by the concurrent workers before being spilled.
+        required: false
+    query:
+        description:
+            - XPath expressions keyed by name, evaluated on the definition of every volume instead of converting it.
+              Each volume is then described by its C(name), C(key) and the matched C(values) of every expression,
+              regardless of I(detail).
+            - Full XPath 1.0 needs lxml, otherwise element paths optionally ending with C(/@attribute) or C(/text())
+              are supported.
+        required: false
+    all_pools:
+        description:
+            - List the volumes of every pool instead of I(pool), the pools being handled concurrently by up to
+              I(max_workers) threads, each volume tagged with its C(pool). C(pools) maps each pool to its C(state),
+              C(capacity), C(allocation) and C(available) bytes and its C(count) of volumes, or its error C(msg).
+              I(offset) and I(limit) apply to every pool.
+        default: false
+    uris:
+        description:
+            - Connection URIs queried concurrently, each with its own connection, instead of I(uri). The I(pool) of
+              every URI is listed, each volume found is tagged with its C(uri), and C(uris) maps each URI to its
+              C(count) of volumes or its error C(msg). I(offset) and I(limit) apply to every URI.
+            - The module fails when any URI fails, the volumes of the others are still returned.
+        required: false
+    max_workers:
+        description:
+            - Maximum number of URIs, or pools with I(all_pools), queried at the same time.
+        default: 8
+    timeout:
+        description:
+            - Seconds after which a URI, or a pool with I(all_pools), still being queried is reported as failed.
+        required: false
 
 author:
     - Your Name (@bkmeneguello)
@@ -60,12 +128,35 @@ message:
     description: The output message that the sample module generates
 '''
 
+POOL_STATES = {
+    libvirt.VIR_STORAGE_POOL_INACTIVE: 'inactive',
+    libvirt.VIR_STORAGE_POOL_BUILDING: 'building',
+    libvirt.VIR_STORAGE_POOL_RUNNING: 'running',
+    libvirt.VIR_STORAGE_POOL_DEGRADED: 'degraded',
+    libvirt.VIR_STORAGE_POOL_INACCESSIBLE: 'inaccessible',
+}
+
 
 def run_module():
     module_args = dict(
         name=dict(type='str'),
-        pool=dict(type='str', required=True),
-        all=dict(type='bool', default=False),
+        pool=dict(type='str'),
+        all_pools=dict(type='bool', default=False),
+        # never read, only accepted for the playbooks still passing it
+        all=dict(type='bool', removed_in_version='2.0'),
+        pattern=dict(type='str'),
+        regex=dict(type='str'),
+        detail=dict(type='str',
+                    choices=[util.VOLUME_DETAIL_NAME, util.VOLUME_DETAIL_INFO, util.VOLUME_DETAIL_FULL],
+                    default=util.VOLUME_DETAIL_FULL),
+        parse=dict(type='bool', default=True),
+        offset=dict(type='int', default=0),
+        limit=dict(type='int'),
+        spill=dict(type='path'),
+        query=dict(type='dict'),
+        uris=dict(type='list'),
+        max_workers=dict(type='int', default=8),
+        timeout=dict(type='float'),
     )
     module_args.update(util.common_args)
 
@@ -77,38 +168,191 @@ def run_module():
         argument_spec=module_args,
         supports_check_mode=True,
         mutually_exclusive=[
-            ['name', 'all']
-        ]
+            ['name', 'pattern'],
+            ['name', 'regex'],
+            ['uri', 'uris'],
+            ['pool', 'all_pools'],
+            ['uris', 'all_pools'],
+        ],
+        required_one_of=[
+            ['pool', 'all_pools'],
+        ],
     )
+    util.start_profiling(module.params, module)
 
     name = module.params['name']
     pool = module.params['pool']
-    show_all = module.params['all']
+    regex = module.params['regex']
+    spill = module.params['spill']
+    uris = module.params['uris']
+    try:
+        describe = describer(module.params)
+    except ValueError as e:
+        module.fail_json(msg=str(e), **result)
+    except re.error as e:
+        module.fail_json(msg='Invalid regex {}: {}'.format(regex, e), **result)
+    if module.params['offset'] < 0 or (module.params['limit'] or 0) < 0:
+        module.fail_json(msg='offset and limit cannot be negative', **result)
+
+    if uris:
+        results = util.run_parallel(lambda uri: gather(module.params, uri), uris,
+                                    module.params['max_workers'], module.params['timeout'])
+        result['uris'] = {}
+        result['total'] = 0
+        descs = []
+        failed = []
+        for uri, (outcome, error) in zip(uris, results):
+            if error is None:
+                total, uri_descs = outcome
+                result['uris'][uri] = dict(count=len(uri_descs))
+                result['total'] += total
+                descs.extend(uri_descs)
+            else:
+                result['uris'][uri] = dict(msg=error.get_error_message() if isinstance(error, libvirt.libvirtError)
+                                           else str(error))
+                failed.append(uri)
+        emit(descs, spill, result)
+        if failed:
+            module.fail_json(msg='facts gathering failed for {} of {} URIs: {}'.format(
+                len(failed), len(uris), ', '.join(failed)), **result)
+        util.finish_profiling(result)
+        module.exit_json(**result)
 
     conn = util.get_conn(module.params)  # type: libvirt.virConnect
     if conn is None:
         module.fail_json(msg='Cannot open connection to libvirt', **result)
 
+    if module.params['all_pools']:
+        try:
+            with util.phase('listAllStoragePools'):
+                vir_pools = conn.listAllStoragePools()
+        except libvirt.libvirtError as e:
+            module.fail_json(msg=e.get_error_message(), **result)
+        results = util.run_parallel(lambda vir_pool: gather_pool(vir_pool, module.params), vir_pools,
+                                    module.params['max_workers'], module.params['timeout'])
+        result['pools'] = {}
+        result['total'] = 0
+        descs = []
+        failed = []
+        for vir_pool, (outcome, error) in zip(vir_pools, results):
+            pool_name = vir_pool.name()
+            if error is None:
+                info, total, pool_descs = outcome
+                result['pools'][pool_name] = dict(info, count=len(pool_descs))
+                result['total'] += total
+                descs.extend(pool_descs)
+            else:
+                result['pools'][pool_name] = dict(msg=error.get_error_message()
+                                                  if isinstance(error, libvirt.libvirtError) else str(error))
+                failed.append(pool_name)
+        emit(descs, spill, result)
+        if failed:
+            module.fail_json(msg='facts gathering failed for {} of {} pools: {}'.format(
+                len(failed), len(vir_pools), ', '.join(failed)), **result)
+        util.finish_profiling(result)
+        module.exit_json(**result)
+
     try:
-        vir_pool = conn.storagePoolLookupByName(pool)
+        with util.phase('storagePoolLookupByName'):
+            vir_pool = conn.storagePoolLookupByName(pool)
         if name:
             try:
-                vir_vol_list = vir_pool.storageVolLookupByName(name)
+                with util.phase('storageVolLookupByName'):
+                    vir_vol = vir_pool.storageVolLookupByName(name)
                 result['exists'] = True
-                result.update(util.describe_volume(vir_vol_list))
+                result.update(describe(vir_vol))
             except libvirt.libvirtError:
                 result['exists'] = False
         else:
-            vir_vol_list = vir_pool.listAllVolumes() if show_all else vir_pool.listVolumes()
-            desc_list = [util.describe_volume(vir_vol) for vir_vol in vir_vol_list]
-            result['list'] = desc_list
-            result['exists'] = bool(desc_list)
+            result['total'], vir_vol_list = list_volumes(vir_pool, module.params)
+            emit((describe(vir_vol) for vir_vol in vir_vol_list), spill, result)
     except libvirt.libvirtError as e:
-        module.fail_json(msg='Cannot find pool {}'.format(pool), e=e.get_error_message())
+        module.fail_json(msg='Cannot find pool {}'.format(pool), e=e.get_error_message(), **result)
 
+    util.finish_profiling(result)
     module.exit_json(**result)
 
 
+def describer(params):
+    # type: (dict) -> Callable
+    """Function describing a volume as asked by the options, with the queries compiled for the calling thread."""
+    queries = util.compile_query(params['query']) if params['query'] else None
+    if params['regex']:
+        re.compile(params['regex'])
+
+    def describe(vir_vol):
+        if queries is not None:
+            return util.query_volume(vir_vol, queries)
+        return util.describe_volume(vir_vol, params['detail'], params['parse'])
+    return describe
+
+
+def list_volumes(vir_pool, params):
+    # type: (libvirt.virStoragePool, dict) -> tuple
+    """Number of volumes matching the name filters, and the page of them to describe."""
+    # a single listAllVolumes round-trip returns objects whose names are known locally,
+    # so filtering and paging happen before any per-volume call
+    with util.phase('listAllVolumes'):
+        vir_vol_list = vir_pool.listAllVolumes()
+    vir_vol_list = util.filter_names(vir_vol_list, params['pattern'], params['regex'])
+    return len(vir_vol_list), util.paginate(vir_vol_list, params['offset'], params['limit'])
+
+
+def gather(params, uri):
+    # type: (dict, str) -> tuple
+    """Total and descriptions of the named volume, or the matching volumes, of the pool of one of the uris,
+    on a connection of its own."""
+    describe = describer(params)
+    conn = util.get_conn(dict(params, uri=uri))  # type: libvirt.virConnect
+    try:
+        with util.phase('storagePoolLookupByName'):
+            vir_pool = conn.storagePoolLookupByName(params['pool'])
+        total, vir_vol_list = pool_volumes(vir_pool, params)
+        return total, [dict(describe(vir_vol), uri=uri) for vir_vol in vir_vol_list]
+    finally:
+        conn.close()
+
+
+def gather_pool(vir_pool, params):
+    # type: (libvirt.virStoragePool, dict) -> tuple
+    """Info, total and descriptions of the named volume, or the matching volumes, of one of all the pools."""
+    describe = describer(params)
+    with util.phase('info'):
+        state, capacity, allocation, available = vir_pool.info()
+    info = dict(state=POOL_STATES.get(state, state), capacity=capacity, allocation=allocation, available=available)
+    # the volumes of inactive pools cannot be listed
+    if state != libvirt.VIR_STORAGE_POOL_RUNNING:
+        return info, 0, []
+    total, vir_vol_list = pool_volumes(vir_pool, params)
+    pool = vir_pool.name()
+    return info, total, [dict(describe(vir_vol), pool=pool) for vir_vol in vir_vol_list]
+
+
+def pool_volumes(vir_pool, params):
+    # type: (libvirt.virStoragePool, dict) -> tuple
+    if not params['name']:
+        return list_volumes(vir_pool, params)
+    try:
+        with util.phase('storageVolLookupByName'):
+            vir_vol_list = [vir_pool.storageVolLookupByName(params['name'])]
+    except libvirt.libvirtError as e:
+        if e.get_error_code() != libvirt.VIR_ERR_NO_STORAGE_VOL:
+            raise
+        vir_vol_list = []
+    return len(vir_vol_list), vir_vol_list
+
+
+def emit(descs, spill, result):
+    # type: (Iterable, str, dict) -> None
+    if spill:
+        result['count'] = util.spill(spill, descs)
+        result['spill'] = spill
+        result['exists'] = bool(result['count'])
+    else:
+        result['list'] = list(descs)
+        result['exists'] = bool(result['list'])
+
+
 def main():
     run_module()
 
@@ -1,7 +1,23 @@
+import os
+import runpy
 import unittest
 
 import roles.libvirt.module_utils.libvirt_utils as util
 
+try:
+    import ansible.module_utils
+    # module_utils of the role are looked up in the ansible.module_utils package, as AnsiballZ bundles them
+    ansible.module_utils.__path__.append(os.path.dirname(os.path.realpath(util.__file__)))
+    HAS_ANSIBLE = True
+except ImportError:
+    HAS_ANSIBLE = False
+
+
+def load_module(name):
+    # type: (str) -> dict
+    """Globals of a module of the library, without running it."""
+    return runpy.run_path(os.path.join(os.path.dirname(os.path.realpath(util.__file__)), '..', 'library', name + '.py'))
+
 
 class TestUtilMethods(unittest.TestCase):
 
@@ -58,6 +74,204 @@ class TestUtilMethods(unittest.TestCase):
         self.assertTrue(util.compare({'a': {'_unit': 'KiB', '__value': 1}}, {'a': {'_unit': 'b', '__value': 1024}}, 'domain')[0])
         self.assertTrue(util.compare({'a': {'_unit': 'KiB', '__value': 1024}}, {'a': {'_unit': 'MiB', '__value': 1}}, 'domain')[0])
 
+    def test_compare_keyed_lists(self):
+        disks = [{'target': {'_dev': 'vda'}, 'serial': 'a'}, {'target': {'_dev': 'vdb'}, 'serial': 'b'}]
+        self.assertTrue(util.compare({'disk': disks}, {'disk': disks[::-1]}, 'domain')[0])
+        self.assertEqual(util.compare({'disk': disks}, {'disk': [disks[0], dict(disks[1], serial='c')]}, 'domain'),
+                         (False, 'domain.disk.vdb.serial', 'values differ b != c'))
+        self.assertEqual(util.compare({'disk': disks}, {'disk': [disks[0], {'target': {'_dev': 'vdc'}}]}, 'domain'),
+                         (False, 'domain.disk.vdb', 'element missing'))
+        controllers = [{'_type': 'usb', '_index': 0}, {'_type': 'pci', '_index': 0}, {'_type': 'pci', '_index': 1}]
+        self.assertTrue(util.compare({'controller': controllers}, {'controller': controllers[::-1]}, 'domain')[0])
+        # without keys on every element, lists are still compared by position
+        self.assertFalse(util.compare({'disk': [{'_a': 1}, {'_a': 2}]}, {'disk': [{'_a': 2}, {'_a': 1}]}, 'domain')[0])
+        self.assertFalse(util.compare({'graphics': ['a', 'b']}, {'graphics': ['b', 'a']}, 'domain')[0])
+
+    def test_compare_subset(self):
+        wanted = {'name': 'web', 'vcpu': 2, 'memory': {'_unit': 'GiB', '__value': 1}, 'features': {'acpi': True},
+                  'devices': {'controller': {'_type': 'usb', '_model': 'qemu-xhci'},
+                              'graphics': {'_type': 'vnc', '_port': '5900'}}}
+        current = {'_type': 'kvm', 'name': 'web', 'vcpu': {'_placement': 'static', '__value': '2'},
+                   'memory': {'_unit': 'KiB', '__value': '1048576'}, 'features': {'acpi': {}, 'apic': {}},
+                   'devices': {'controller': [{'_type': 'pci', '_index': '0', '_model': 'pci-root'},
+                                              {'_type': 'usb', '_index': '0', '_model': 'qemu-xhci',
+                                               'alias': {'_name': 'usb'}}],
+                               'graphics': {'_type': 'vnc', '_port': '5901'}}}
+        self.assertFalse(util.compare(wanted, current, 'domain')[0])
+        self.assertEqual(util.compare(wanted, current, 'domain', subset=True),
+                         (False, 'domain.devices.graphics._port', 'values differ 5900 != 5901'))
+        self.assertTrue(util.compare(wanted, current, 'domain', subset=True, ignore=['*.graphics._port'])[0])
+        self.assertFalse(util.compare({'devices': {'controller': {'_type': 'sata'}}}, current, 'domain', subset=True)[0])
+
+    def test_filter_names(self):
+        class Named(object):
+            def __init__(self, name):
+                self._name = name
+
+            def name(self):
+                return self._name
+
+        objects = [Named(n) for n in ('web-2', 'db-1', 'web-1', 'web-10')]
+        names = lambda objs: [obj.name() for obj in objs]
+        self.assertEqual(names(util.filter_names(objects)), ['db-1', 'web-1', 'web-10', 'web-2'])
+        self.assertEqual(names(util.filter_names(objects, pattern='web-?')), ['web-1', 'web-2'])
+        self.assertEqual(names(util.filter_names(objects, regex=r'-1')), ['db-1', 'web-1', 'web-10'])
+        self.assertEqual(names(util.filter_names(objects, pattern='web-*', regex=r'0$')), ['web-10'])
+        self.assertEqual(util.paginate([1, 2, 3, 4], 1, 2), [2, 3])
+        self.assertEqual(util.paginate([1, 2, 3, 4], 2), [3, 4])
+
+    def test_index_capabilities(self):
+        xml = '''
+        <capabilities>
+          <host><uuid>u</uuid><cpu><arch>x86_64</arch></cpu></host>
+          <guest>
+            <os_type>hvm</os_type>
+            <arch name='x86_64'>
+              <emulator>/usr/bin/qemu-system-x86_64</emulator>
+              <machine>pc</machine>
+              <domain type='qemu'><machine>isapc</machine></domain>
+              <domain type='kvm'><machine>q35</machine></domain>
+            </arch>
+          </guest>
+        </capabilities>
+        '''
+        index = util.index_capabilities(util.str_to_xml(xml.strip()))
+        domain_types = index['arches']['x86_64']['domain_types']
+        self.assertEqual(domain_types['qemu']['machines'], ['pc', 'isapc'])
+        self.assertEqual(domain_types['kvm']['machines'], ['pc', 'q35'])
+        self.assertEqual(index['arches']['x86_64']['machines'], ['pc', 'isapc', 'q35'])
+
+    def test_rpc_proxy(self):
+        class Target(object):
+            def name(self):
+                return 'target'
+
+            def XMLDesc(self, flags=0):
+                return '<target/>'
+
+        stats = util.RPCStats()
+        proxy = util.RPCProxy(Target(), stats)
+        self.assertEqual(proxy.name(), 'target')
+        self.assertEqual(proxy.XMLDesc(), '<target/>')
+        proxy.XMLDesc(0)
+        report = stats.report()
+        self.assertEqual(report['calls'], 2)
+        self.assertEqual(list(report['apis'].keys()), ['Target.XMLDesc'])
+        self.assertEqual(report['apis']['Target.XMLDesc']['calls'], 2)
+
+    def test_to_xml_str(self):
+        for obj in [
+            {'a': None},
+            {'a': True},
+            {'a': False},
+            {'a': ''},
+            {'a': {'__value': ''}},
+            {'a': {'b': []}},
+            {'a': {'_x': '1', 'b': [], 'c': [{}, None]}},
+            {'a': {'_x': '1 & "2" <3>\n\t\r', '__value': 't<&>é', 'b': [{'_c': 1}, {'d': 'x'}, None]}},
+            {'domain': {'_type': 'kvm', 'name': 'test', 'memory': {'_unit': 'GiB', '__value': 1},
+                        'devices': {'disk': [{'target': {'_dev': 'vda'}}, {'target': {'_dev': 'vdb'}}]}}},
+        ]:
+            self.assertEqual(util.to_xml_str(obj), util.xml_to_str(util.to_xml(obj)))
+
+    def test_from_xml(self):
+        xml = '''<?xml version='1.0' encoding='UTF-8'?>
+        <domain type='kvm'>
+          <!-- comment -->
+          <?pi ignored?>
+          <name>test</name>
+          <memory unit='GiB'>1</memory>
+          <features><acpi/></features>
+          <devices>
+            <disk type='file'><target dev='vda'/></disk>
+            <disk type='file'><target dev='vdb'/></disk>
+          </devices>
+        </domain>
+        '''
+        self.assertEqual(util.from_xml(xml.strip()), {
+            '_type': 'kvm',
+            'name': 'test',
+            'memory': {'__value': '1', '_unit': 'GiB'},
+            'features': {'acpi': {}},
+            'devices': {'disk': [
+                {'_type': 'file', 'target': {'_dev': 'vda'}},
+                {'_type': 'file', 'target': {'_dev': 'vdb'}},
+            ]},
+        })
+
+    def test_from_xml_compact(self):
+        xmls = [util.to_xml_str({'domain': {'name': name, 'devices': {'disk': [
+            {'_type': 'file', 'driver': {'_name': 'qemu'}, 'target': {'_dev': 'vda', '_bus': 'virtio'}},
+            {'_type': 'file', 'driver': {'_name': 'qemu'}, 'target': {'_dev': 'vdb', '_bus': 'virtio'}},
+        ]}}}) for name in ('a', 'b')]
+        table = {}
+        compact = [util.from_xml(xml, table) for xml in xmls]
+        self.assertEqual([util.thaw(desc) for desc in compact], [util.from_xml(xml) for xml in xmls])
+        self.assertIs(compact[0]['devices'], compact[1]['devices'])
+        self.assertEqual(compact[0]['devices']['disk'][1]['target']['_dev'], 'vdb')
+
+    def test_query(self):
+        xml = util.to_xml_str({'domain': {'name': 'test', 'devices': {
+            'interface': [{'mac': {'_address': '52:54:00:00:00:01'}}, {'mac': {'_address': '52:54:00:00:00:02'}}],
+            'graphics': {'_type': 'vnc', '_port': 5900},
+        }}})
+        queries = util.compile_query({
+            'name': '/domain/name/text()',
+            'macs': 'devices/interface/mac/@address',
+            'port': '//graphics/@port',
+            'missing': '/network/name',
+        })
+        self.assertEqual(util.query_xml(xml, queries), {
+            'name': ['test'],
+            'macs': ['52:54:00:00:00:01', '52:54:00:00:00:02'],
+            'port': ['5900'],
+            'missing': [],
+        })
+        self.assertRaises(ValueError, util.compile_query, {'bad': '//a[@b='})
+
+    @unittest.skipUnless(util.LXML, 'lxml is not installed')
+    def test_str_to_xml_backends(self):
+        documents = [
+            "<?xml version='1.0' encoding='UTF-8'?>\n<a x='1'><!-- c --><?pi x?><b>t&amp;é</b><b/> tail</a>",
+            "<a xmlns='urn:x'><b>1</b><c>  </c></a>",
+            util.to_xml_str({'domain': {'_type': 'kvm', 'devices': {'disk': [{'_type': 'file'}, {'_type': 'block'}]}}}),
+        ]
+        try:
+            for xml in documents:
+                trees = []
+                dicts = []
+                for backend in (True, False):
+                    util.LXML = backend
+                    trees.append([(e.tag, dict(e.attrib), e.text) for e in util.str_to_xml(xml).iter()])
+                    dicts.append(util.from_xml(xml))
+                self.assertEqual(trees[0], trees[1])
+                self.assertEqual(dicts[0], dicts[1])
+            util.LXML = True
+            # a declaration that cannot be removed reports the original error
+            self.assertRaisesRegex(ValueError, 'encoding declaration', util.str_to_xml,
+                                   "<?xml version='1.0' encoding='UTF-8'")
+        finally:
+            util.LXML = True
+
+    @unittest.skipUnless(HAS_ANSIBLE, 'ansible is not installed')
+    def test_filter_has_changed(self):
+        module = load_module('libvirt_filter')
+        nwfilter = {'_name': 'allow-ssh', '_chain': 'root', 'filterref': {'_filter': 'clean-traffic'},
+                    'rule': [{'_action': 'accept', '_direction': 'in', '_priority': 500, 'tcp': {'_dstportstart': 22}},
+                             {'_action': 'drop', '_direction': 'inout', '_priority': 1000, 'all': True}]}
+        xml = module['encode_filter'](nwfilter)
+        self.assertTrue(xml.startswith('<filter name="allow-ssh"'))
+
+        class Filter(object):
+            def XMLDesc(self, flags=0):
+                return xml
+
+        current = util.from_xml(xml)
+        self.assertEqual(current['_name'], 'allow-ssh')
+        self.assertEqual(module['filter_has_changed'](Filter(), dict(nwfilter)), (False, [], []))
+        changed, added, removed = module['filter_has_changed'](Filter(), dict(nwfilter, _chain='ipv4'))
+        self.assertTrue(changed)
+
     def test_validate(self):
         xml = '''
         <domain type='kvm'>
@@ -1,25 +1,243 @@
-import copy
+import contextlib
+import json
 import os
-import re
-from enum import IntEnum
-from xml.etree import ElementTree
+import threading
+import time
 
 import libvirt
 
 try:
-    from io import StringIO
-    from lxml import etree
-    VALIDATE = True
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from collections.abc import Mapping
 except ImportError:
-    VALIDATE = False
+    from collections import Mapping
+
+
+class __LazyModule(object):
+    """Stand-in for a module, imported on first attribute access so that the modules not using it skip the cost."""
+
+    def __init__(self, name):
+        self.__name = name
+
+    def __getattr__(self, attr):
+        value = getattr(__import__(self.__name, fromlist=['__name__']), attr)
+        # later lookups find the attribute without going through __getattr__
+        setattr(self, attr, value)
+        return value
+
+
+copy = __LazyModule('copy')
+fnmatch = __LazyModule('fnmatch')
+hashlib = __LazyModule('hashlib')
+re = __LazyModule('re')
+tempfile = __LazyModule('tempfile')
+ElementTree = __LazyModule('xml.etree.ElementTree')
+
+
+def __lxml():
+    # type: () -> bool
+    """Whether parsing uses lxml, importing it on first use; util.LXML may be set to force a backend."""
+    global etree, LXML, VALIDATE
+    if 'etree' not in globals():
+        try:
+            from lxml import etree as module
+        except ImportError:
+            module = None
+        VALIDATE = module is not None
+        if 'LXML' not in globals():
+            LXML = VALIDATE
+        # assigned last, as concurrent callers return as soon as it is set
+        etree = module
+    return LXML
+
+
+def __getattr__(name):
+    # tables and optional dependencies are built or imported on first use
+    if name in ('LXML', 'VALIDATE', 'etree'):
+        __lxml()
+    elif name in ('DOMAIN_STATES', 'DOMAIN_STATE_REASONS'):
+        __domain_states()
+    elif name in ('Unit', 'p'):
+        __units()
+    else:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+    return globals()[name]
+
 
 common_args = dict(
-    uri=dict(type='str')
+    uri=dict(type='str'),
+    profile=dict(type='bool', default=False),
+    profile_dump=dict(type='path'),
+    rpc_stats=dict(type='bool', default=False),
 )
 
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+class Profiler(object):
+    """Accumulates the monotonic time spent in named phases, optionally under cProfile.
+
+    Phases may nest, e.g. from_xml runs inside describe, and time spent by
+    concurrent threads in the same phase is added up.
+    """
+
+    def __init__(self, dump=None):
+        self.timings = {}
+        self.dump = dump
+        self.lock = threading.Lock()
+        self.start = monotonic()
+        self.cprofile = None
+        if dump:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            elapsed = monotonic() - start
+            with self.lock:
+                self.timings[name] = self.timings.get(name, 0.0) + elapsed
+
+    def finish(self, result):
+        # type: (dict) -> None
+        self.timings['total'] = monotonic() - self.start
+        result['timings'] = self.timings
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.dump)
+            result['profile_dump'] = self.dump
+
+
+class __NoPhase(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+__NO_PHASE = __NoPhase()
+__PROFILER = None
+__RPC_STATS = None
+
+# answered from data the client keeps on each object, these never reach the daemon
+LOCAL_CALLS = frozenset([
+    'name', 'ID', 'UUID', 'UUIDString', 'key', 'usageType', 'usageID', 'portDev', 'filterName',
+    'getName', 'getDomain', 'getConnect', 'connect', 'c_pointer',
+])
+
+LIBVIRT_OBJECT_TYPES = tuple(getattr(libvirt, name) for name in (
+    'virConnect', 'virDomain', 'virDomainSnapshot', 'virNetwork', 'virStoragePool', 'virStorageVol', 'virStream',
+    'virSecret', 'virNWFilter', 'virNWFilterBinding', 'virInterface', 'virNodeDevice',
+) if hasattr(libvirt, name))
+
+
+class RPCStats(object):
+    """Number of calls and cumulated latency per libvirt API."""
+
+    def __init__(self):
+        self.apis = {}
+        self.lock = threading.Lock()
+
+    def record(self, api, elapsed):
+        # type: (str, float) -> None
+        with self.lock:
+            stats = self.apis.setdefault(api, {'calls': 0, 'time': 0.0})
+            stats['calls'] += 1
+            stats['time'] += elapsed
+
+    def wrap(self, value):
+        # type: (object) -> object
+        if isinstance(value, LIBVIRT_OBJECT_TYPES):
+            return RPCProxy(value, self)
+        if isinstance(value, list) and value and isinstance(value[0], LIBVIRT_OBJECT_TYPES):
+            return [RPCProxy(item, self) for item in value]
+        return value
+
+    def report(self):
+        # type: () -> dict
+        return {
+            'calls': sum(stats['calls'] for stats in self.apis.values()),
+            'time': sum(stats['time'] for stats in self.apis.values()),
+            'apis': self.apis,
+        }
+
+
+class RPCProxy(object):
+    """Counts and times the calls made on a libvirt object and wraps the objects it returns.
+
+    Private attributes such as _o are passed through, so proxies can be given as
+    arguments to other libvirt calls.
+    """
+    __slots__ = ('_target', '_stats')
+
+    def __init__(self, target, stats):
+        self._target = target
+        self._stats = stats
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        stats = self._stats
+        if name in LOCAL_CALLS:
+            return lambda *args, **kwargs: stats.wrap(attr(*args, **kwargs))
+        api = '{}.{}'.format(type(self._target).__name__, name)
+
+        def call(*args, **kwargs):
+            start = monotonic()
+            try:
+                value = attr(*args, **kwargs)
+            finally:
+                stats.record(api, monotonic() - start)
+            return stats.wrap(value)
+
+        return call
+
+
+def start_profiling(params, module=None):
+    # type: (dict, AnsibleModule) -> None
+    """Start the profiling asked by params, the failures of module then report the timings as well."""
+    global __PROFILER, __RPC_STATS
+    if params.get('profile') or params.get('profile_dump'):
+        __PROFILER = Profiler(params.get('profile_dump'))
+    if params.get('rpc_stats'):
+        __RPC_STATS = RPCStats()
+    if module is not None and (__PROFILER is not None or __RPC_STATS is not None):
+        fail_json = module.fail_json
+
+        def fail_with_profiling(*args, **kwargs):
+            finish_profiling(kwargs)
+            fail_json(*args, **kwargs)
+        module.fail_json = fail_with_profiling
+
+
+def phase(name):
+    # type: (str) -> ContextManager
+    """Time the enclosed block as the named phase when profiling is enabled."""
+    profiler = __PROFILER
+    return profiler.phase(name) if profiler is not None else __NO_PHASE
+
+
+def finish_profiling(result):
+    # type: (dict) -> None
+    if __PROFILER is not None:
+        __PROFILER.finish(result)
+    if __RPC_STATS is not None:
+        result['rpc_stats'] = __RPC_STATS.report()
+
 
 def to_xml(obj):
-    els, _, _ = __dict_to_xml(obj)
+    with phase('to_xml'):
+        els, _, _ = __dict_to_xml(obj)
     return els[0]
 
 
@@ -27,6 +245,84 @@ def xml_to_str(root):
     return ElementTree.tostring(root).decode()
 
 
+def to_xml_str(obj):
+    """Same text as xml_to_str(to_xml(obj)), written straight from the dict without building elements."""
+    with phase('to_xml'):
+        out = []
+        for key, value in obj.items():
+            if key.startswith('_'):
+                continue
+            __write_tag(out, key, value[0] if isinstance(value, list) else value)
+            break
+        text = ''.join(out)
+    try:
+        text.encode('ascii')
+    except UnicodeEncodeError:
+        # ElementTree.tostring() defaults to us-ascii and writes character references
+        text = text.encode('ascii', 'xmlcharrefreplace').decode()
+    return text
+
+
+def __escape_text(text):
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
+
+
+def __escape_attr(text):
+    text = __escape_text(text)
+    if '"' in text:
+        text = text.replace('"', '&quot;')
+    if '\r' in text:
+        text = text.replace('\r', '&#13;')
+    if '\n' in text:
+        text = text.replace('\n', '&#10;')
+    if '\t' in text:
+        text = text.replace('\t', '&#09;')
+    return text
+
+
+def __write_tag(out, tag, value):
+    if isinstance(value, dict):
+        text = None
+        children = []
+        out.append('<' + tag)
+        for key, item in value.items():
+            if key == '__value':
+                text = str(item)
+            elif key.startswith('_'):
+                out.append(' {}="{}"'.format(key[1:], __escape_attr(str(item))))
+            elif item != []:
+                # an empty list writes no element, the tag must still self-close
+                children.append((key, item))
+        if not text and not children:
+            out.append(' />')
+            return
+        out.append('>')
+        if text:
+            out.append(__escape_text(text))
+        for key, item in children:
+            if isinstance(item, list):
+                for element in item:
+                    __write_tag(out, key, element)
+            else:
+                __write_tag(out, key, item)
+        out.append('</' + tag + '>')
+    elif value is None or isinstance(value, bool):
+        # a bool only marks the presence of an empty element
+        out.append('<' + tag + ' />')
+    else:
+        text = str(value)
+        if text:
+            out.append('<{0}>{1}</{0}>'.format(tag, __escape_text(text)))
+        else:
+            out.append('<' + tag + ' />')
+
+
 def __dict_to_xml(d):
     children = []
     attrs = {}
@@ -68,122 +364,319 @@ def __build_tag(key, value=None):
         return ElementTree.Element(key)
 
 
+__PARSERS = threading.local()
+
+
+def __lxml_parser():
+    # lxml parsers are not thread safe, so one is kept per thread and reused across calls
+    parser = getattr(__PARSERS, 'parser', None)
+    if parser is None:
+        # comments and processing instructions are dropped, as ElementTree does
+        parser = etree.XMLParser(resolve_entities=False, huge_tree=True, remove_comments=True, remove_pis=True)
+        __PARSERS.parser = parser
+    return parser
+
+
 def str_to_xml(xml):
-    root = ElementTree.fromstring(xml)
-    return root
+    if not __lxml():
+        return ElementTree.fromstring(xml)
+    try:
+        return etree.fromstring(xml, __lxml_parser())
+    except ValueError:
+        # lxml refuses str documents carrying an encoding declaration, which ElementTree ignores
+        end = xml.find('?>') if xml.startswith('<?xml') else -1
+        if end < 0:
+            raise
+        return etree.fromstring(xml[end + 2:], __lxml_parser())
 
 
-def from_xml(xml):
-    root = str_to_xml(xml)
-    d = __xml_to_dict(root)
-    return __build_dict(*d)
+def from_xml(xml, compact=None):
+    # type: (str, dict) -> dict
+    """Convert a document to dict form.
+
+    When compact is given, a dict shared by the calls, the result is built of
+    CompactNode and tuples instead, equal strings and elements being stored once.
+    """
+    with phase('from_xml'):
+        # the conversion touches every element, where the lxml proxies cost more than its faster parser saves
+        root = ElementTree.fromstring(xml)
+        if compact is not None:
+            return __xml_to_compact(root, compact)
+        return __xml_to_dict(root)
+
+
+def __xml_to_dict(element):
+    group = dict()
+    for child in element:
+        node = __xml_to_dict(child)
+        if child.tag in group:
+            group[child.tag].append(node)
+        else:
+            group[child.tag] = [node]
 
+    text = element.text
+    if text is not None and not text.strip():
+        text = None
+    attrs = element.items()
+    if text is not None and not attrs and not group:
+        return text
 
-def __build_dict(text, attrs, children):
     obj = dict()
     if text is not None:
-        if attrs or children:
-            obj['__value'] = text
-        else:
-            obj = text
-    for key, value in attrs.items():
-        obj['_{}'.format(key)] = value
-    for tag, child in children.items():
-        obj[tag] = child
+        obj['__value'] = text
+    for key, value in attrs:
+        obj['_' + key] = value
+    for tag, child_list in group.items():
+        obj[tag] = child_list[0] if len(child_list) == 1 else child_list
     return obj
 
 
-def __xml_to_dict(element):
+class CompactNode(Mapping):
+    """Immutable element of the compact dict form, shared between equal elements.
+
+    AnsibleModule copies mappings into plain dicts when emitting the result, so
+    the nodes can be returned as they are; thaw() converts them elsewhere.
+    """
+    __slots__ = ('_keys', '_values', '_hash')
+
+    def __init__(self, keys, values):
+        # type: (tuple, tuple) -> None
+        self._keys = keys
+        self._values = values
+        self._hash = hash((keys, values))
+
+    def __getitem__(self, key):
+        try:
+            return self._values[self._keys.index(key)]
+        except ValueError:
+            raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if isinstance(other, CompactNode):
+            return self._hash == other._hash and self._keys == other._keys and self._values == other._values
+        return Mapping.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'CompactNode({!r})'.format(dict(zip(self._keys, self._values)))
+
+
+def __xml_to_compact(element, table):
     group = dict()
-    for child in list(element):
-        group.setdefault(child.tag, []).append(__xml_to_dict(child))
-    children = dict()
+    for child in element:
+        node = __xml_to_compact(child, table)
+        if child.tag in group:
+            group[child.tag].append(node)
+        else:
+            group[child.tag] = [node]
+
+    text = element.text
+    if text is not None and not text.strip():
+        text = None
+    attrs = element.items()
+    if text is not None and not attrs and not group:
+        return table.setdefault(text, text)
+
+    keys = []
+    values = []
+    if text is not None:
+        keys.append('__value')
+        values.append(table.setdefault(text, text))
+    for key, value in attrs:
+        keys.append('_' + key)
+        values.append(table.setdefault(value, value))
     for tag, child_list in group.items():
-        if len(child_list) is 1:
-            children[tag] = __build_dict(*child_list[0])
+        keys.append(tag)
+        if len(child_list) == 1:
+            values.append(child_list[0])
         else:
-            children[tag] = [__build_dict(*child) for child in child_list]
+            child_list = tuple(child_list)
+            values.append(table.setdefault(child_list, child_list))
+    keys = tuple(keys)
+    node = CompactNode(table.setdefault(keys, keys), tuple(values))
+    return table.setdefault(node, node)
 
-    text = None
-    if element.text and element.text.strip():
-        text = element.text
-    return text, element.attrib, children
+
+def thaw(value):
+    # type: (object) -> object
+    """Turn the CompactNode and tuples of a compact result back into dicts and lists."""
+    if isinstance(value, Mapping):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [thaw(item) for item in value]
+    return value
 
 
 def get_conn(params):
-    conn = libvirt.open(params['uri'])
-    return conn
-
-
-DOMAIN_STATES = {
-    libvirt.VIR_DOMAIN_NOSTATE: 'nostate',
-    libvirt.VIR_DOMAIN_RUNNING: 'running',
-    libvirt.VIR_DOMAIN_BLOCKED: 'blocked',
-    libvirt.VIR_DOMAIN_PAUSED: 'paused',
-    libvirt.VIR_DOMAIN_SHUTDOWN: 'shutdown',
-    libvirt.VIR_DOMAIN_SHUTOFF: 'shutoff',
-    libvirt.VIR_DOMAIN_CRASHED: 'crashed',
-    libvirt.VIR_DOMAIN_PMSUSPENDED: 'pmsuspended',
-}
+    with phase('get_conn'):
+        if __RPC_STATS is None:
+            return libvirt.open(params['uri'])
+        start = monotonic()
+        conn = libvirt.open(params['uri'])
+        __RPC_STATS.record('libvirt.open', monotonic() - start)
+        return RPCProxy(conn, __RPC_STATS)
+
+
+__EVENT_LOOP = None
+__EVENT_LOOP_LOCK = threading.Lock()
+
+
+def start_event_loop():
+    # type: () -> None
+    """Run the default libvirt event loop on a daemon thread.
+
+    Must be called before opening the connections whose events are awaited.
+    """
+    global __EVENT_LOOP
+    with __EVENT_LOOP_LOCK:
+        if __EVENT_LOOP is not None:
+            return
+        libvirt.virEventRegisterDefaultImpl()
+        __EVENT_LOOP = threading.Thread(target=__run_event_loop, name='libvirt-events')
+        __EVENT_LOOP.daemon = True
+        __EVENT_LOOP.start()
+
+
+def __run_event_loop():
+    while True:
+        libvirt.virEventRunDefaultImpl()
+
+
+def run_parallel(func, items, max_workers=8, timeout=None):
+    # type: (Callable, list, int, float) -> list
+    """Call func for every item on at most max_workers daemon threads.
+
+    Returns a list of (result, error) tuples in the order of items, error being
+    the exception raised by func or None. A call still running after timeout
+    seconds gets a TimeoutError; it cannot be interrupted, so its thread is left
+    behind and the worker moves on to the next item.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    pending = queue.Queue()
+    for i, item in enumerate(items):
+        pending.put((i, item))
+
+    def call(item, outcome):
+        try:
+            outcome.append((func(item), None))
+        except Exception as e:
+            outcome.append((None, e))
+
+    def worker():
+        while True:
+            try:
+                i, item = pending.get_nowait()
+            except queue.Empty:
+                return
+            outcome = []
+            if timeout is None:
+                call(item, outcome)
+            else:
+                thread = threading.Thread(target=call, args=(item, outcome))
+                thread.daemon = True
+                thread.start()
+                thread.join(timeout)
+            results[i] = outcome[0] if outcome else (None, TimeoutError('timed out after {} seconds'.format(timeout)))
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, min(max_workers, len(items))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def __domain_states():
+    # type: () -> tuple
+    global DOMAIN_STATES, DOMAIN_STATE_REASONS
+    if 'DOMAIN_STATE_REASONS' not in globals():
+        DOMAIN_STATES = {
+            libvirt.VIR_DOMAIN_NOSTATE: 'nostate',
+            libvirt.VIR_DOMAIN_RUNNING: 'running',
+            libvirt.VIR_DOMAIN_BLOCKED: 'blocked',
+            libvirt.VIR_DOMAIN_PAUSED: 'paused',
+            libvirt.VIR_DOMAIN_SHUTDOWN: 'shutdown',
+            libvirt.VIR_DOMAIN_SHUTOFF: 'shutoff',
+            libvirt.VIR_DOMAIN_CRASHED: 'crashed',
+            libvirt.VIR_DOMAIN_PMSUSPENDED: 'pmsuspended',
+        }
+
+        DOMAIN_STATE_REASONS = {
+            libvirt.VIR_DOMAIN_NOSTATE: {
+                libvirt.VIR_DOMAIN_NOSTATE_UNKNOWN: 'unknown',
+            },
+            libvirt.VIR_DOMAIN_RUNNING: {
+                libvirt.VIR_DOMAIN_RUNNING_UNKNOWN: 'unknown',
+                libvirt.VIR_DOMAIN_RUNNING_BOOTED: 'booted',
+                libvirt.VIR_DOMAIN_RUNNING_MIGRATED: 'migrated',
+                libvirt.VIR_DOMAIN_RUNNING_RESTORED: 'restored',
+                libvirt.VIR_DOMAIN_RUNNING_FROM_SNAPSHOT: 'from_snapshot',
+                libvirt.VIR_DOMAIN_RUNNING_UNPAUSED: 'unpaused',
+                libvirt.VIR_DOMAIN_RUNNING_MIGRATION_CANCELED: 'migration_canceled',
+                libvirt.VIR_DOMAIN_RUNNING_SAVE_CANCELED: 'save_canceled',
+                libvirt.VIR_DOMAIN_RUNNING_WAKEUP: 'wakeup',
+                libvirt.VIR_DOMAIN_RUNNING_CRASHED: 'crashed',
+                libvirt.VIR_DOMAIN_RUNNING_POSTCOPY: 'postcopy',
+            },
+            libvirt.VIR_DOMAIN_BLOCKED: {
+                libvirt.VIR_DOMAIN_BLOCKED_UNKNOWN: 'unknown',
+            },
+            libvirt.VIR_DOMAIN_PAUSED: {
+                libvirt.VIR_DOMAIN_PAUSED_UNKNOWN: 'unknown',
+                libvirt.VIR_DOMAIN_PAUSED_USER: 'user',
+                libvirt.VIR_DOMAIN_PAUSED_MIGRATION: 'migration',
+                libvirt.VIR_DOMAIN_PAUSED_SAVE: 'save',
+                libvirt.VIR_DOMAIN_PAUSED_DUMP: 'dump',
+                libvirt.VIR_DOMAIN_PAUSED_IOERROR: 'ioerror',
+                libvirt.VIR_DOMAIN_PAUSED_WATCHDOG: 'watchdog',
+                libvirt.VIR_DOMAIN_PAUSED_FROM_SNAPSHOT: 'from_snapshot',
+                libvirt.VIR_DOMAIN_PAUSED_SHUTTING_DOWN: 'shutting_down',
+                libvirt.VIR_DOMAIN_PAUSED_SNAPSHOT: 'snapshot',
+                libvirt.VIR_DOMAIN_PAUSED_CRASHED: 'crashed',
+                libvirt.VIR_DOMAIN_PAUSED_STARTING_UP: 'starting_up',
+                libvirt.VIR_DOMAIN_PAUSED_POSTCOPY: 'postcopy',
+                libvirt.VIR_DOMAIN_PAUSED_POSTCOPY_FAILED: 'postcopy_failed',
+            },
+            libvirt.VIR_DOMAIN_SHUTDOWN: {
+                libvirt.VIR_DOMAIN_SHUTDOWN_UNKNOWN: 'unknown',
+                libvirt.VIR_DOMAIN_SHUTDOWN_USER: 'user',
+            },
+            libvirt.VIR_DOMAIN_SHUTOFF: {
+                libvirt.VIR_DOMAIN_SHUTOFF_UNKNOWN: 'unknown',
+                libvirt.VIR_DOMAIN_SHUTOFF_SHUTDOWN: 'shutdown',
+                libvirt.VIR_DOMAIN_SHUTOFF_DESTROYED: 'destroyed',
+                libvirt.VIR_DOMAIN_SHUTOFF_CRASHED: 'crashed',
+                libvirt.VIR_DOMAIN_SHUTOFF_MIGRATED: 'migrated',
+                libvirt.VIR_DOMAIN_SHUTOFF_SAVED: 'saved',
+                libvirt.VIR_DOMAIN_SHUTOFF_FAILED: 'failed',
+                libvirt.VIR_DOMAIN_SHUTOFF_FROM_SNAPSHOT: 'from_snapshot',
+            },
+            libvirt.VIR_DOMAIN_CRASHED: {
+                libvirt.VIR_DOMAIN_CRASHED_UNKNOWN: 'unknown',
+                libvirt.VIR_DOMAIN_CRASHED_PANICKED: 'panicked',
+            },
+            libvirt.VIR_DOMAIN_PMSUSPENDED: {
+                libvirt.VIR_DOMAIN_PMSUSPENDED_UNKNOWN: 'unknown',
+            },
+        }
+    return DOMAIN_STATES, DOMAIN_STATE_REASONS
 
-DOMAIN_STATE_REASONS = {
-    libvirt.VIR_DOMAIN_NOSTATE: {
-        libvirt.VIR_DOMAIN_NOSTATE_UNKNOWN: 'unknown',
-    },
-    libvirt.VIR_DOMAIN_RUNNING: {
-        libvirt.VIR_DOMAIN_RUNNING_UNKNOWN: 'unknown',
-        libvirt.VIR_DOMAIN_RUNNING_BOOTED: 'booted',
-        libvirt.VIR_DOMAIN_RUNNING_MIGRATED: 'migrated',
-        libvirt.VIR_DOMAIN_RUNNING_RESTORED: 'restored',
-        libvirt.VIR_DOMAIN_RUNNING_FROM_SNAPSHOT: 'from_snapshot',
-        libvirt.VIR_DOMAIN_RUNNING_UNPAUSED: 'unpaused',
-        libvirt.VIR_DOMAIN_RUNNING_MIGRATION_CANCELED: 'migration_canceled',
-        libvirt.VIR_DOMAIN_RUNNING_SAVE_CANCELED: 'save_canceled',
-        libvirt.VIR_DOMAIN_RUNNING_WAKEUP: 'wakeup',
-        libvirt.VIR_DOMAIN_RUNNING_CRASHED: 'crashed',
-        libvirt.VIR_DOMAIN_RUNNING_POSTCOPY: 'postcopy',
-    },
-    libvirt.VIR_DOMAIN_BLOCKED: {
-        libvirt.VIR_DOMAIN_BLOCKED_UNKNOWN: 'unknown',
-    },
-    libvirt.VIR_DOMAIN_PAUSED: {
-        libvirt.VIR_DOMAIN_PAUSED_UNKNOWN: 'unknown',
-        libvirt.VIR_DOMAIN_PAUSED_USER: 'user',
-        libvirt.VIR_DOMAIN_PAUSED_MIGRATION: 'migration',
-        libvirt.VIR_DOMAIN_PAUSED_SAVE: 'save',
-        libvirt.VIR_DOMAIN_PAUSED_DUMP: 'dump',
-        libvirt.VIR_DOMAIN_PAUSED_IOERROR: 'ioerror',
-        libvirt.VIR_DOMAIN_PAUSED_WATCHDOG: 'watchdog',
-        libvirt.VIR_DOMAIN_PAUSED_FROM_SNAPSHOT: 'from_snapshot',
-        libvirt.VIR_DOMAIN_PAUSED_SHUTTING_DOWN: 'shutting_down',
-        libvirt.VIR_DOMAIN_PAUSED_SNAPSHOT: 'snapshot',
-        libvirt.VIR_DOMAIN_PAUSED_CRASHED: 'crashed',
-        libvirt.VIR_DOMAIN_PAUSED_STARTING_UP: 'starting_up',
-        libvirt.VIR_DOMAIN_PAUSED_POSTCOPY: 'postcopy',
-        libvirt.VIR_DOMAIN_PAUSED_POSTCOPY_FAILED: 'postcopy_failed',
-    },
-    libvirt.VIR_DOMAIN_SHUTDOWN: {
-        libvirt.VIR_DOMAIN_SHUTDOWN_UNKNOWN: 'unknown',
-        libvirt.VIR_DOMAIN_SHUTDOWN_USER: 'user',
-    },
-    libvirt.VIR_DOMAIN_SHUTOFF: {
-        libvirt.VIR_DOMAIN_SHUTOFF_UNKNOWN: 'unknown',
-        libvirt.VIR_DOMAIN_SHUTOFF_SHUTDOWN: 'shutdown',
-        libvirt.VIR_DOMAIN_SHUTOFF_DESTROYED: 'destroyed',
-        libvirt.VIR_DOMAIN_SHUTOFF_CRASHED: 'crashed',
-        libvirt.VIR_DOMAIN_SHUTOFF_MIGRATED: 'migrated',
-        libvirt.VIR_DOMAIN_SHUTOFF_SAVED: 'saved',
-        libvirt.VIR_DOMAIN_SHUTOFF_FAILED: 'failed',
-        libvirt.VIR_DOMAIN_SHUTOFF_FROM_SNAPSHOT: 'from_snapshot',
-    },
-    libvirt.VIR_DOMAIN_CRASHED: {
-        libvirt.VIR_DOMAIN_CRASHED_UNKNOWN: 'unknown',
-        libvirt.VIR_DOMAIN_CRASHED_PANICKED: 'panicked',
-    },
-    libvirt.VIR_DOMAIN_PMSUSPENDED: {
-        libvirt.VIR_DOMAIN_PMSUSPENDED_UNKNOWN: 'unknown',
-    },
-}
 
 DOMAIN_INTERFACE_ADDRESSES_SOURCES_LOOKUP = {
     'lease': libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE,
@@ -194,36 +687,106 @@ if hasattr(libvirt, 'VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_ARP'):
     DOMAIN_INTERFACE_ADDRESSES_SOURCES_LOOKUP['arp'] = libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_ARP
 
 
-def describe_domain(vir_dom, interfaces_addresses=None):
-    # type: (libvirt.virDomain, str) -> dict
+def describe_domain(vir_dom, interfaces_addresses=None, compact=None):
+    # type: (libvirt.virDomain, str, dict) -> dict
+    states, reasons = __domain_states()
     state, reason = vir_dom.state()
-    xml = vir_dom.XMLDesc()
+    with phase('XMLDesc'):
+        xml = vir_dom.XMLDesc()
     desc = {
         'name': vir_dom.name(),
         'xml': xml,
-        'desc': from_xml(xml),
+        'desc': from_xml(xml, compact),
         'id': vir_dom.ID(),
         'uuid': vir_dom.UUIDString(),
-        'state': DOMAIN_STATES[state],
-        'reason': DOMAIN_STATE_REASONS[state][reason],
+        'state': states[state],
+        'reason': reasons[state][reason],
     }
     if interfaces_addresses:
-        desc['interfaces_addresses'] = vir_dom.interfaceAddresses(DOMAIN_INTERFACE_ADDRESSES_SOURCES_LOOKUP[interfaces_addresses])
+        desc['interfaces_addresses'] = interface_addresses(vir_dom, interfaces_addresses)
     return desc
 
 
-Unit = IntEnum('Unit', 'k m g t p e')
-p = re.compile('((?P<unit1>[b])(ytes?)?)|((?P<unit2>[kmgtpe])((?P<type>[i]?)[b])?)')
+def interface_addresses(vir_dom, source):
+    # type: (libvirt.virDomain, str) -> dict
+    with phase('interfaceAddresses'):
+        return vir_dom.interfaceAddresses(DOMAIN_INTERFACE_ADDRESSES_SOURCES_LOOKUP[source])
+
+
+WAIT_INITIAL_DELAY = 0.5
+WAIT_MAX_DELAY = 10
+
+
+def wait_for_guests(conn, vir_doms, source, timeout, max_workers=8):
+    # type: (libvirt.virConnect, list, str, float, int) -> list
+    """Wait until every guest reports an address through source, the interface addresses source.
+
+    Each domain is polled on its own worker with an exponential backoff, the
+    agent lifecycle events, when the event loop runs, ending the waits early.
+    Returns a list of (addresses, error) tuples in the order of vir_doms, error
+    being a TimeoutError for the guests still not ready after timeout seconds.
+    """
+    waiters = {vir_dom.UUIDString(): threading.Event() for vir_dom in vir_doms}
+
+    def agent_event(conn, vir_dom, state, reason, opaque):
+        waiter = waiters.get(vir_dom.UUIDString())
+        if waiter is not None:
+            waiter.set()
+
+    callback = None
+    if source == 'agent' and __EVENT_LOOP is not None and hasattr(libvirt, 'VIR_DOMAIN_EVENT_ID_AGENT_LIFECYCLE'):
+        try:
+            callback = conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_AGENT_LIFECYCLE, agent_event, None)
+        except libvirt.libvirtError:
+            pass
+    deadline = monotonic() + timeout
+    try:
+        return run_parallel(lambda vir_dom: __wait_for_guest(vir_dom, source, deadline, waiters[vir_dom.UUIDString()]),
+                            vir_doms, max_workers)
+    finally:
+        if callback is not None:
+            conn.domainEventDeregisterAny(callback)
+
+
+def __wait_for_guest(vir_dom, source, deadline, waiter):
+    # type: (libvirt.virDomain, str, float, threading.Event) -> dict
+    delay = WAIT_INITIAL_DELAY
+    while True:
+        waiter.clear()
+        try:
+            addresses = interface_addresses(vir_dom, source)
+        except libvirt.libvirtError:
+            # the agent is not connected yet or the domain is still starting
+            addresses = {}
+        # the agent also reports the loopback interface
+        if any(name != 'lo' and interface.get('addrs') for name, interface in addresses.items()):
+            return addresses
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            raise TimeoutError('{} reported no address through {} in time'.format(vir_dom.name(), source))
+        waiter.wait(min(delay, remaining))
+        delay = min(delay * 2, WAIT_MAX_DELAY)
+
+
+def __units():
+    # type: () -> tuple
+    global Unit, p
+    if 'p' not in globals():
+        from enum import IntEnum
+        Unit = IntEnum('Unit', 'k m g t p e')
+        p = re.compile('((?P<unit1>[b])(ytes?)?)|((?P<unit2>[kmgtpe])((?P<type>[i]?)[b])?)')
+    return Unit, p
 
 
 def to_bytes(value, unit):
     # type: (int, str) -> int
-    m = p.fullmatch(unit.lower())
+    units, pattern = __units()
+    m = pattern.fullmatch(unit.lower())
     if m:
         if m.group('unit1'):
             return value
         elif m.group('unit2'):
-            scale = Unit[m.group('unit2')]
+            scale = units[m.group('unit2')]
             if m.group('type'):
                 return value * (1 << (10 * scale))
             else:
@@ -238,32 +801,106 @@ UNIT_PATHS = {
 }
 
 
-def compare(e1, e2, path):
+# repeated elements identified by these attribute paths are matched by identity instead of position
+LIST_KEYS = {
+    'disk': (('target', '_dev'),),
+    'interface': (('mac', '_address'),),
+    'controller': (('_type',), ('_index',)),
+}
+
+
+def __list_key(element, key_paths):
+    # type: (object, tuple) -> tuple
+    key = []
+    for key_path in key_paths:
+        value = element
+        for name in key_path:
+            value = value.get(name) if isinstance(value, dict) else None
+        if value is None or isinstance(value, (dict, list)):
+            return None
+        key.append(str(value).lower())
+    return tuple(key)
+
+
+def __keyed(elements, key_paths):
+    # type: (list, tuple) -> dict
+    """Elements by identity, or None when some element has no key or shares it."""
+    keyed = {}
+    for element in elements:
+        key = __list_key(element, key_paths)
+        if key is None or key in keyed:
+            return None
+        keyed[key] = element
+    return keyed
+
+
+def compare(e1, e2, path, subset=False, ignore=None):
+    """Compare the definition e1 with e2, returns whether they are equal, and the path and cause of the difference.
+
+    In subset mode only what e1 defines is compared: members and list elements
+    only found in e2, such as the addresses, aliases and defaults filled in by
+    libvirt, are ignored, and a scalar stands for the text of an element. The
+    dotted paths matching one of the ignore glob patterns are not compared.
+    """
     path = [path] if not isinstance(path, list) else path
+    if ignore and any(fnmatch.fnmatchcase('.'.join(path), pattern) for pattern in ignore):
+        return True, None, None
     e1 = copy.copy(e1)
     e2 = copy.copy(e2)
 
+    if subset:
+        if isinstance(e2, list) and not isinstance(e1, list):
+            e1 = [e1]
+        elif isinstance(e2, dict):
+            # empty elements are written from booleans and None, texts from scalars
+            if e1 is None or isinstance(e1, bool):
+                e1 = {}
+            elif not isinstance(e1, (dict, list)):
+                e1 = {'__value': e1}
+
     if isinstance(e1, dict) and isinstance(e2, dict):
-        if any('_unit' in e for e in (e1, e2)) and path[0] in UNIT_PATHS.keys():
-            if not all('_unit' in e for e in (e1, e2)):
+        if any('_unit' in e for e in (e1, e2)) and path[0] in UNIT_PATHS.keys() \
+                and all('__value' in e for e in (e1, e2)):
+            if not subset and not all('_unit' in e for e in (e1, e2)):
                 return False, '.'.join(path), 'missing unit attribute'
-            e1bytes = to_bytes(int(e1['__value']), e1['_unit'] or UNIT_PATHS[path[0]])
-            e2bytes = to_bytes(int(e2['__value']), e2['_unit'] or UNIT_PATHS[path[0]])
+            e1bytes = to_bytes(int(e1['__value']), e1.get('_unit') or UNIT_PATHS[path[0]])
+            e2bytes = to_bytes(int(e2['__value']), e2.get('_unit') or UNIT_PATHS[path[0]])
             e1['__value'], e1['_unit'] = str(e1bytes), 'b'
             e2['__value'], e2['_unit'] = str(e2bytes), 'b'
-        if len(e1) != len(e2):
-            return False, '.'.join(path), 'member count differ'
-        if set(e1.keys()) != set(e2.keys()):
-            return False, '.'.join(path), 'member names differ'
+        if subset:
+            for key in e1.keys():
+                if key not in e2:
+                    if ignore and any(fnmatch.fnmatchcase('.'.join(path + [key]), pattern) for pattern in ignore):
+                        continue
+                    return False, '.'.join(path + [key]), 'member missing'
+        else:
+            if len(e1) != len(e2):
+                return False, '.'.join(path), 'member count differ'
+            if set(e1.keys()) != set(e2.keys()):
+                return False, '.'.join(path), 'member names differ'
         for key in e1.keys():
-            eq, p, m = compare(e1[key], e2[key], path=path + [key])
-            if not eq:
-                return False, p, m
+            if key in e2:
+                eq, p, m = compare(e1[key], e2[key], path + [key], subset, ignore)
+                if not eq:
+                    return False, p, m
     elif isinstance(e1, list) and isinstance(e2, list):
-        if len(e1) != len(e2):
+        if len(e1) > len(e2) or not subset and len(e1) != len(e2):
             return False, '.'.join(path), 'element count differ'
+        key_paths = LIST_KEYS.get(path[-1])
+        keyed1 = __keyed(e1, key_paths) if key_paths else None
+        keyed2 = __keyed(e2, key_paths) if keyed1 is not None else None
+        if keyed2 is not None:
+            for key, element in keyed1.items():
+                if key not in keyed2:
+                    return False, '.'.join(path + [','.join(key)]), 'element missing'
+                eq, p, m = compare(element, keyed2[key], path + [','.join(key)], subset, ignore)
+                if not eq:
+                    return False, p, m
+            return True, None, None
+        if subset:
+            return __compare_subset_list(e1, e2, path, ignore)
         for i in range(len(e1)):
-            eq, p, m = compare(e1[i], e2[i], path=path + [str(i)])
+            eq, p, m = compare(e1[i], e2[i], path + [str(i)], subset, ignore)
             if not eq:
                 return False, p, m
     elif str(e1) != str(e2):
@@ -272,21 +909,182 @@ def compare(e1, e2, path):
     return True, None, None
 
 
-def describe_volume(volume):
-    # type: (libvirt.virStorageVol) -> dict
-    xml = volume.XMLDesc()
+def __compare_subset_list(e1, e2, path, ignore):
+    # type: (list, list, list, list) -> tuple
+    """Match every element of e1 with a distinct element of e2, the one at the same position first."""
+    unmatched = list(range(len(e2)))
+    for i, element in enumerate(e1):
+        candidates = ([i] if i in unmatched else []) + [j for j in unmatched if j != i]
+        first = None
+        for j in candidates:
+            eq, p, m = compare(element, e2[j], path + [str(i)], True, ignore)
+            if eq:
+                unmatched.remove(j)
+                break
+            first = first or (False, p, m)
+        else:
+            return first
+    return True, None, None
+
+
+VOLUME_TYPES = {
+    libvirt.VIR_STORAGE_VOL_FILE: 'file',
+    libvirt.VIR_STORAGE_VOL_BLOCK: 'block',
+    libvirt.VIR_STORAGE_VOL_DIR: 'dir',
+    libvirt.VIR_STORAGE_VOL_NETWORK: 'network',
+}
+
+if hasattr(libvirt, 'VIR_STORAGE_VOL_NETDIR'):
+    VOLUME_TYPES[libvirt.VIR_STORAGE_VOL_NETDIR] = 'netdir'
+if hasattr(libvirt, 'VIR_STORAGE_VOL_PLOOP'):
+    VOLUME_TYPES[libvirt.VIR_STORAGE_VOL_PLOOP] = 'ploop'
+
+VOLUME_DETAIL_NAME = 'name'
+VOLUME_DETAIL_INFO = 'info'
+VOLUME_DETAIL_FULL = 'full'
+
+
+def describe_volume(volume, detail=VOLUME_DETAIL_FULL, parse=True):
+    # type: (libvirt.virStorageVol, str, bool) -> dict
+    # name() and key() are cached on the object, only info(), path() and XMLDesc() cost a round-trip
+    desc = {
+        'name': volume.name(),
+        'key': volume.key(),
+    }
+    if detail == VOLUME_DETAIL_NAME:
+        return desc
+    if detail == VOLUME_DETAIL_INFO:
+        vol_type, capacity, allocation = volume.info()
+        desc.update({
+            'type': VOLUME_TYPES.get(vol_type, 'unknown'),
+            'capacity': capacity,
+            'allocation': allocation,
+        })
+        return desc
+    with phase('XMLDesc'):
+        xml = volume.XMLDesc()
+    desc['path'] = volume.path()
+    desc['xml'] = xml
+    if parse:
+        desc['desc'] = from_xml(xml)
+    return desc
+
+
+def compile_query(query):
+    # type: (dict) -> dict
+    """Compile a dict of XPath expressions, keyed by the name of the value they extract.
+
+    Full XPath 1.0 is available with lxml. The ElementTree fallback supports its
+    element paths, optionally ending with /@attribute or /text().
+    Raises ValueError for an invalid expression.
+    """
+    compiled = dict()
+    for name, expression in query.items():
+        try:
+            if __lxml():
+                compiled[name] = __lxml_query(expression)
+            else:
+                compiled[name] = __etree_query(expression)
+        except (SyntaxError, ValueError) as e:
+            raise ValueError('invalid query {}: {}'.format(name, e))
+    return compiled
+
+
+def __lxml_query(expression):
+    xpath = etree.XPath(expression, smart_strings=False)
+    try:
+        # unknown functions and variables are only reported on evaluation
+        xpath(etree.Element('query'))
+    except etree.XPathError as e:
+        raise ValueError(str(e))
+
+    def query(root):
+        value = xpath(root)
+        if isinstance(value, list):
+            return [item.text if hasattr(item, 'tag') else item for item in value]
+        return value
+    return query
+
+
+def __etree_query(expression):
+    path, _, last = expression.rpartition('/')
+    if last.startswith('@') or last == 'text()':
+        path = path or '.'
+    else:
+        path, last = expression, None
+    root_tag = None
+    if path.startswith('//'):
+        path = './/' + path[2:]
+    elif path.startswith('/'):
+        root_tag, _, rest = path[1:].partition('/')
+        path = './' + rest if rest else '.'
+    try:
+        # ElementPath compiles, and reports invalid paths, on first use
+        ElementTree.Element('query').findall(path)
+    except (KeyError, TypeError, StopIteration):
+        raise ValueError('unsupported path {}'.format(expression))
+
+    def query(root):
+        if root_tag not in (None, '*', root.tag):
+            return []
+        found = root.findall(path)
+        if last is None or last == 'text()':
+            return [element.text for element in found]
+        return [element.get(last[1:]) for element in found if element.get(last[1:]) is not None]
+    return query
+
+
+def query_xml(xml, queries):
+    # type: (str, dict) -> dict
+    """Evaluate compiled queries on a document without converting it to dict form."""
+    with phase('query'):
+        root = str_to_xml(xml)
+        return {name: query(root) for name, query in queries.items()}
+
+
+def query_domain(vir_dom, queries):
+    # type: (libvirt.virDomain, dict) -> dict
+    with phase('XMLDesc'):
+        xml = vir_dom.XMLDesc()
+    return {
+        'name': vir_dom.name(),
+        'uuid': vir_dom.UUIDString(),
+        'values': query_xml(xml, queries),
+    }
+
+
+def query_volume(volume, queries):
+    # type: (libvirt.virStorageVol, dict) -> dict
+    with phase('XMLDesc'):
+        xml = volume.XMLDesc()
     return {
         'name': volume.name(),
-        'path': volume.path(),
         'key': volume.key(),
-        'xml': xml,
-        'desc': from_xml(xml),
+        'values': query_xml(xml, queries),
     }
 
 
+def filter_names(objects, pattern=None, regex=None):
+    # type: (list, str, str) -> list
+    """Keep the objects whose name() matches the glob pattern and/or the regex, sorted by name."""
+    if pattern is not None:
+        objects = [obj for obj in objects if fnmatch.fnmatchcase(obj.name(), pattern)]
+    if regex is not None:
+        r = re.compile(regex)
+        objects = [obj for obj in objects if r.search(obj.name())]
+    return sorted(objects, key=lambda obj: obj.name())
+
+
+def paginate(items, offset=0, limit=None):
+    # type: (list, int, int) -> list
+    end = offset + limit if limit is not None else None
+    return items[offset:end]
+
+
 def describe_network(network):
     # type: (libvirt.virNetwork) -> dict
-    xml = network.XMLDesc()
+    with phase('XMLDesc'):
+        xml = network.XMLDesc()
     return {
         'name': network.name(),
         'bridgeName': network.bridgeName(),
@@ -296,6 +1094,348 @@ def describe_network(network):
     }
 
 
+def describe_snapshot(snapshot):
+    # type: (libvirt.virDomainSnapshot) -> dict
+    with phase('XMLDesc'):
+        xml = snapshot.getXMLDesc()
+    return {
+        'name': snapshot.getName(),
+        'domain': snapshot.getDomain().name(),
+        'current': bool(snapshot.isCurrent()),
+        'xml': xml,
+        'desc': from_xml(xml),
+    }
+
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'ansible-libvirt')
+
+
+JOURNAL_PATH = os.path.join(CACHE_DIR, 'domain-events.jsonl')
+
+# seconds between the touches of the journal by a live watcher, older journals are left by dead ones
+JOURNAL_HEARTBEAT = 10
+JOURNAL_MAX_AGE = 3 * JOURNAL_HEARTBEAT
+
+
+def cache_key(*parts):
+    # type: (*object) -> str
+    return hashlib.sha1('\0'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+def cache_load(cache_dir, key):
+    # type: (str, str) -> dict
+    try:
+        with open(os.path.join(cache_dir, key + '.json')) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def cache_store(cache_dir, key, data):
+    # type: (str, str, dict) -> None
+    """Store data under key, an unwritable cache_dir leaving the callers uncached."""
+    tmp = None
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # written aside and renamed so that concurrent readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, os.path.join(cache_dir, key + '.json'))
+    except (IOError, OSError):
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def xml_digest(xml):
+    # type: (str) -> str
+    return hashlib.sha256(xml.encode()).hexdigest()
+
+
+def read_journal(path, position=None):
+    # type: (str, list) -> tuple
+    """Read the JSON-lines records appended to a journal since position.
+
+    Returns the records and the position following the last complete line. The
+    records are None when the journal was replaced or truncated since position.
+    """
+    try:
+        f = open(path, 'rb')
+    except (IOError, OSError):
+        return (None if position else []), None
+    with f:
+        stat = os.fstat(f.fileno())
+        offset = 0
+        if position:
+            if position[0] != stat.st_ino or position[1] > stat.st_size:
+                return None, None
+            offset = position[1]
+        f.seek(offset)
+        records = []
+        for line in f:
+            if not line.endswith(b'\n'):
+                # still being written, read again on the next call
+                break
+            offset += len(line)
+            try:
+                records.append(json.loads(line.decode()))
+            except ValueError:
+                continue
+    return records, [stat.st_ino, offset]
+
+
+def journal_alive(path, max_age=JOURNAL_MAX_AGE):
+    # type: (str, float) -> bool
+    """Whether the watcher writing the journal touched it within max_age seconds.
+
+    A watcher killed or lost with its host cannot record that it stopped, its
+    journal then silently misses the later events.
+    """
+    try:
+        return time.time() - os.stat(path).st_mtime <= max_age
+    except (IOError, OSError):
+        return False
+
+
+def __json_default(value):
+    if isinstance(value, Mapping):
+        return dict(value)
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def spill(path, items):
+    # type: (str, Iterable) -> int
+    """Write every item as a JSON line as soon as it is produced and return their count.
+
+    Items are consumed one by one, so a generator keeps the memory used constant.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    # written aside and renamed so that readers never see a partial file
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    count = 0
+    try:
+        with os.fdopen(fd, 'w') as f:
+            for item in items:
+                f.write(json.dumps(item, default=__json_default))
+                f.write('\n')
+                count += 1
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    os.rename(tmp, path)
+    return count
+
+
+def __attrs_of(element):
+    return dict(element.attrib) if element is not None else {}
+
+
+def __text_of(element):
+    return element.text.strip() if element is not None and element.text else None
+
+
+def index_capabilities(root):
+    # type: (ElementTree.Element) -> dict
+    """Index the output of getCapabilities() by arch, machine type, NUMA cell and CPU feature."""
+    host = root.find('host')
+    cpu = host.find('cpu')
+    index = {
+        'host': {
+            'uuid': __text_of(host.find('uuid')),
+            'cpu': {
+                'arch': __text_of(cpu.find('arch')),
+                'model': __text_of(cpu.find('model')),
+                'vendor': __text_of(cpu.find('vendor')),
+                'topology': __attrs_of(cpu.find('topology')),
+            },
+        },
+        'cpu_features': sorted(feature.get('name') for feature in cpu.findall('feature')),
+        'numa_cells': {},
+        'cache_banks': [dict(bank.attrib) for bank in host.findall('cache/bank')],
+        'arches': {},
+        'machines': {},
+    }
+
+    for cell in host.findall('topology/cells/cell'):
+        memory = cell.find('memory')
+        index['numa_cells'][cell.get('id')] = {
+            'memory': to_bytes(int(memory.text), memory.get('unit', 'KiB')) if memory is not None else None,
+            'cpus': [int(c.get('id')) for c in cell.findall('cpus/cpu')],
+            'pages': {page.get('size'): int(page.text) for page in cell.findall('pages')},
+            'distances': {sibling.get('id'): int(sibling.get('value')) for sibling in cell.findall('distances/sibling')},
+        }
+
+    for guest in root.findall('guest'):
+        arch = guest.find('arch')
+        entry = index['arches'].setdefault(arch.get('name'), {
+            'wordsize': __text_of(arch.find('wordsize')),
+            'emulator': __text_of(arch.find('emulator')),
+            'os_types': [],
+            'machines': [],
+            'canonical': {},
+            'domain_types': {},
+            'features': [],
+        })
+        entry['os_types'].append(__text_of(guest.find('os_type')))
+        features = guest.find('features')
+        if features is not None:
+            entry['features'] = sorted(set(entry['features']) | set(f.tag for f in features))
+        guest_machines = arch.findall('machine')
+        machines = list(guest_machines)
+        for domain in arch.findall('domain'):
+            # the machines of a domain type are the ones of the guest plus its own
+            domain_machines = guest_machines + domain.findall('machine')
+            entry['domain_types'][domain.get('type')] = {
+                'emulator': __text_of(domain.find('emulator')) or entry['emulator'],
+                'machines': [__text_of(m) for m in domain_machines],
+            }
+            machines.extend(domain.findall('machine'))
+        for machine in machines:
+            machine_name = __text_of(machine)
+            if machine_name not in entry['machines']:
+                entry['machines'].append(machine_name)
+            if machine.get('canonical'):
+                entry['canonical'][machine_name] = machine.get('canonical')
+            arches = index['machines'].setdefault(machine_name, [])
+            if arch.get('name') not in arches:
+                arches.append(arch.get('name'))
+
+    return index
+
+
+def as_list(value):
+    # type: (object) -> list
+    """Repeated tags become lists in dict form while single ones do not, this undoes the difference."""
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def __value_of(value):
+    if isinstance(value, dict):
+        return value.get('__value')
+    return value
+
+
+__DOMAIN_CAPABILITIES = {}
+
+
+def get_domain_capabilities(conn, emulator=None, arch=None, machine=None, virttype=None, cache_dir=None):
+    # type: (libvirt.virConnect, str, str, str, str, str) -> tuple
+    """Return the index of getDomainCapabilities() and whether it was cached.
+
+    Results are memoized for the lifetime of the process and, when cache_dir is
+    given, on disk keyed by the libvirt and hypervisor versions.
+    """
+    memo_key = (conn.getURI(), emulator, arch, machine, virttype)
+    if memo_key in __DOMAIN_CAPABILITIES:
+        return __DOMAIN_CAPABILITIES[memo_key], True
+
+    key = None
+    if cache_dir is not None:
+        key = cache_key('domain_capabilities', conn.getHostname(), conn.getLibVersion(), conn.getVersion(), *memo_key)
+        entry = cache_load(cache_dir, key)
+        if entry is not None:
+            __DOMAIN_CAPABILITIES[memo_key] = entry['index']
+            return entry['index'], True
+
+    with phase('getDomainCapabilities'):
+        xml = conn.getDomainCapabilities(emulator, arch, machine, virttype, 0)
+    index = index_domain_capabilities(str_to_xml(xml))
+    __DOMAIN_CAPABILITIES[memo_key] = index
+    if key is not None:
+        cache_store(cache_dir, key, {'sha256': xml_digest(xml), 'index': index})
+    return index, False
+
+
+def __enums_of(element):
+    if element is None or element.get('supported') == 'no':
+        return {}
+    return {enum.get('name'): [__text_of(v) for v in enum.findall('value')] for enum in element.findall('enum')}
+
+
+def index_domain_capabilities(root):
+    # type: (ElementTree.Element) -> dict
+    """Index the output of getDomainCapabilities() into lists of supported values."""
+    vcpu = root.find('vcpu')
+    os_el = root.find('os')
+    loader = os_el.find('loader') if os_el is not None else None
+    index = {
+        'path': __text_of(root.find('path')),
+        'domain': __text_of(root.find('domain')),
+        'machine': __text_of(root.find('machine')),
+        'arch': __text_of(root.find('arch')),
+        'vcpu_max': int(vcpu.get('max')) if vcpu is not None else None,
+        'firmware': __enums_of(os_el).get('firmware', []),
+        'loaders': [__text_of(v) for v in loader.findall('value')] if loader is not None else [],
+        'loader_types': __enums_of(loader).get('type', []),
+        'cpu_modes': [],
+        'cpu_models': [],
+        'devices': {},
+        'features': {},
+    }
+    for mode in root.findall('cpu/mode'):
+        if mode.get('supported') != 'yes':
+            continue
+        index['cpu_modes'].append(mode.get('name'))
+        if mode.get('name') == 'custom':
+            index['cpu_models'] = [__text_of(m) for m in mode.findall('model') if m.get('usable') != 'no']
+    devices = root.find('devices')
+    for device in list(devices) if devices is not None else []:
+        index['devices'][device.tag] = __enums_of(device) if device.get('supported') == 'yes' else None
+    features = root.find('features')
+    for feature in list(features) if features is not None else []:
+        index['features'][feature.tag] = feature.get('supported') == 'yes'
+    index['disk_buses'] = (index['devices'].get('disk') or {}).get('bus', [])
+    index['disk_devices'] = (index['devices'].get('disk') or {}).get('diskDevice', [])
+    index['video_models'] = (index['devices'].get('video') or {}).get('modelType', [])
+    index['graphics_types'] = (index['devices'].get('graphics') or {}).get('type', [])
+    return index
+
+
+def check_domain_capabilities(domain, index):
+    # type: (dict, dict) -> list
+    """List the parts of a domain definition that the indexed domain capabilities do not support."""
+    problems = []
+
+    def check(path, value, supported):
+        if value is not None and supported and str(value) not in set(supported):
+            problems.append('{}: {} not in {}'.format(path, value, ', '.join(supported)))
+
+    vcpu = __value_of(domain.get('vcpu'))
+    if vcpu is not None and index['vcpu_max'] is not None and int(vcpu) > index['vcpu_max']:
+        problems.append('domain.vcpu: {} above maximum {}'.format(vcpu, index['vcpu_max']))
+
+    os_ = domain.get('os') or {}
+    check('domain.os._firmware', os_.get('_firmware'), index['firmware'])
+    loader = os_.get('loader')
+    if isinstance(loader, dict):
+        # loader paths are not checked, libvirt only reports the firmware it knows about
+        check('domain.os.loader._type', loader.get('_type'), index['loader_types'])
+
+    cpu = domain.get('cpu')
+    if isinstance(cpu, dict):
+        mode = cpu.get('_mode', 'custom' if 'model' in cpu else None)
+        check('domain.cpu._mode', mode, index['cpu_modes'])
+        if mode == 'custom':
+            check('domain.cpu.model', __value_of(cpu.get('model')), index['cpu_models'])
+
+    devices = domain.get('devices') or {}
+    for i, disk in enumerate(as_list(devices.get('disk'))):
+        check('domain.devices.disk.{}._device'.format(i), disk.get('_device'), index['disk_devices'])
+        check('domain.devices.disk.{}.target._bus'.format(i), (disk.get('target') or {}).get('_bus'),
+              index['disk_buses'])
+    for i, video in enumerate(as_list(devices.get('video'))):
+        check('domain.devices.video.{}.model._type'.format(i), (video.get('model') or {}).get('_type'),
+              index['video_models'])
+    for i, graphics in enumerate(as_list(devices.get('graphics'))):
+        check('domain.devices.graphics.{}._type'.format(i), graphics.get('_type'), index['graphics_types'])
+    return problems
+
+
 SCHEMA_LOOKUP = {
     'domainsnapshot': 'domainsnapshot',
     'domain': 'domain',
@@ -314,9 +1454,12 @@ SCHEMA_PATH = '/usr/share/libvirt/schemas'
 
 
 def validate(xml):
+    __lxml()
     if not VALIDATE:
         return False
 
+    from io import StringIO
+
     tree = etree.parse(StringIO(xml))
 
     root = tree.getroot().tag
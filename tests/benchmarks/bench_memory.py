@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""Measure the memory held by from_xml results with and without compact mode.
+
+Domain and storage pool definitions are generated by corpus.py and converted
+the way libvirt_domain_facts does for a whole host. tracemalloc reports the memory
+still held by the results and the peak reached while building them:
+
+    python tests/benchmarks/bench_memory.py --sizes 1000,10000 --disks 8 --output memory.json
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'module_utils'))
+import libvirt_utils as util  # noqa: E402
+
+import corpus  # noqa: E402
+
+DEFAULT_SIZES = [100, 1000, 10000]
+
+
+def measure(xmls, compact):
+    # type: (list, bool) -> dict
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    table = {} if compact else None
+    descs = [util.from_xml(xml, table) for xml in xmls]
+    seconds = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del descs, table
+    return {'current': current, 'peak': peak, 'seconds': seconds}
+
+
+def run(sizes, profile):
+    # type: (list, dict) -> dict
+    report = {
+        'meta': {
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'profile': profile,
+        },
+        'results': [],
+    }
+    profile = dict(profile)
+    profile.pop('dhcp_hosts')
+    for size in sizes:
+        documents = {
+            'domain': [corpus.domain(i, **profile) for i in range(size)],
+            'pool': [corpus.pool(name='corpus-{}'.format(i)) for i in range(size)],
+        }
+        for kind in sorted(documents):
+            xmls = [corpus.encode(kind, obj) for obj in documents[kind]]
+            for compact in (False, True):
+                entry = dict(measure(xmls, compact), size=size, kind=kind, compact=compact)
+                report['results'].append(entry)
+                print('{size:>6} {kind:<6} {mode:<8} {0:>10.1f} KiB/1000 held {1:>10.1f} KiB/1000 peak '
+                      '{seconds:>8.3f} s'.format(
+                          entry['current'] / 1024.0 / size * 1000, entry['peak'] / 1024.0 / size * 1000,
+                          mode='compact' if compact else 'dict', **entry))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=lambda s: [int(n) for n in s.split(',')], default=DEFAULT_SIZES,
+                        help='comma separated domain and pool counts (default: %(default)s)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    corpus.add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    report = run(args.sizes, corpus.profile_of(args))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""Measure the cold start of every module: interpreter, imports and argument parsing.
+
+Each module runs in a fresh interpreter, the way AnsiballZ runs it, with an
+unsupported parameter so that AnsibleModule fails right after validating the
+arguments, before any connection. The baseline interpreter only imports
+ansible.module_utils.basic, its time is subtracted to give the cost of the
+module itself:
+
+    python tests/benchmarks/bench_startup.py --repeat 20 --output startup.json
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+
+# module_utils of the role are looked up in the ansible.module_utils package, as AnsiballZ bundles them
+DRIVER = '''
+import sys
+import ansible.module_utils
+ansible.module_utils.__path__.append(sys.argv.pop(1))
+path = sys.argv.pop(1)
+if path:
+    import runpy
+    sys.argv[0] = path
+    runpy.run_path(path, run_name='__main__')
+else:
+    import ansible.module_utils.basic
+'''
+
+ARGS = json.dumps({'ANSIBLE_MODULE_ARGS': {'bench_unsupported': True}})
+
+
+def validation_failed(stdout):
+    # type: (bytes) -> bool
+    try:
+        result = json.loads(stdout.decode(errors='replace'))
+    except ValueError:
+        return False
+    # the invocation is only reported once AnsibleModule has parsed the arguments
+    return bool(result.get('failed')) and 'invocation' in result
+
+
+def measure(path, repeat):
+    # type: (str, int) -> tuple
+    """Best wall time of running the module, and its output when it did not fail on its arguments."""
+    command = [sys.executable, '-c', DRIVER, os.path.join(ROOT, 'module_utils'), path, ARGS]
+    best = None
+    output = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proc = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        if path and not validation_failed(proc.stdout):
+            output = proc.stdout.decode(errors='replace').strip()
+    return best, output
+
+
+def run(modules, repeat):
+    # type: (list, int) -> dict
+    report = {
+        'meta': {
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'repeat': repeat,
+        },
+        'results': [],
+    }
+    baseline, _ = measure('', repeat)
+    report['meta']['baseline'] = baseline
+    print('{:<36} {:>10.1f} ms'.format('baseline', baseline * 1e3))
+    for path in modules:
+        entry = {'module': os.path.splitext(os.path.basename(path))[0]}
+        seconds, output = measure(path, repeat)
+        if output is not None:
+            # e.g. an import error, the timing would not be comparable
+            entry['error'] = output.splitlines()[-1] if output else 'no output'
+        else:
+            entry.update(seconds=seconds, own=seconds - baseline)
+        report['results'].append(entry)
+        print('{module:<36} {0}'.format(
+            '{:>10.1f} ms {:>+10.1f} ms'.format(entry['seconds'] * 1e3, entry['own'] * 1e3) if 'seconds' in entry
+            else entry['error'], **entry))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('modules', nargs='*', help='module names (default: every module of the library)')
+    parser.add_argument('--repeat', type=int, default=10, help='runs per module, the best one is kept')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    if args.modules:
+        modules = [os.path.join(ROOT, 'library', name + '.py') for name in args.modules]
+    else:
+        modules = []
+        for path in sorted(glob.glob(os.path.join(ROOT, 'library', '*.py'))):
+            with open(path) as f:
+                if 'AnsibleModule(' in f.read():
+                    modules.append(path)
+    report = run(modules, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""Benchmark the libvirt_utils hot paths against the libvirt test driver.
+
+Every size gets its own custom test-driver node definition holding that many
+domains, networks, volumes and pools generated by corpus.py, so no hypervisor is
+needed. Results are written
+as JSON and can be compared with the results of another commit:
+
+    python tests/benchmarks/bench_utils.py --output before.json
+    git checkout other-branch
+    python tests/benchmarks/bench_utils.py --output after.json --compare before.json
+"""
+import argparse
+import copy
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import libvirt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'module_utils'))
+import libvirt_utils as util  # noqa: E402
+
+import corpus  # noqa: E402
+
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+
+
+def open_test_conn(size, workdir, profile):
+    # type: (int, str, dict) -> libvirt.virConnect
+    generated = corpus.generate(size, **profile)
+    path = os.path.join(workdir, 'node-{}.xml'.format(size))
+    with open(path, 'w') as f:
+        f.write(corpus.node_xml(generated['domains'], generated['networks'],
+                                [corpus.pool(generated['volumes'])] + generated['pools']))
+    return libvirt.open('test://' + path)
+
+
+def measure(func, repeat):
+    # type: (Callable, int) -> float
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def benchmarks(conn):
+    # type: (libvirt.virConnect) -> list
+    domains = conn.listAllDomains()
+    networks = conn.listAllNetworks()
+    volumes = conn.storagePoolLookupByName(corpus.POOL_NAME).listAllVolumes()
+    pools = conn.listAllStoragePools()
+    xmls = [vir_dom.XMLDesc() for vir_dom in domains]
+    dicts = [util.from_xml(xml) for xml in xmls]
+    copies = [copy.deepcopy(d) for d in dicts]
+    queries = util.compile_query({
+        'vnc_port': '/domain/devices/graphics/@port',
+        'macs': '/domain/devices/interface/mac/@address',
+        'disk_sources': '/domain/devices/disk/source/@file',
+    })
+
+    return [
+        ('from_xml', lambda: [util.from_xml(xml) for xml in xmls]),
+        ('str_to_xml', lambda: [util.str_to_xml(xml) for xml in xmls]),
+        ('query_xml', lambda: [util.query_xml(xml, queries) for xml in xmls]),
+        ('to_xml/xml_to_str', lambda: [util.xml_to_str(util.to_xml({'domain': d})) for d in dicts]),
+        ('to_xml_str', lambda: [util.to_xml_str({'domain': d}) for d in dicts]),
+        ('compare', lambda: [util.compare(d1, d2, 'domain') for d1, d2 in zip(dicts, copies)]),
+        ('describe_domain', lambda: [util.describe_domain(vir_dom) for vir_dom in domains]),
+        ('describe_volume', lambda: [util.describe_volume(vir_vol) for vir_vol in volumes]),
+        ('describe_network', lambda: [util.describe_network(vir_net) for vir_net in networks]),
+        ('describe_pool', lambda: [util.from_xml(vir_pool.XMLDesc()) for vir_pool in pools]),
+    ]
+
+
+def git_commit():
+    # type: () -> str
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes, repeat, profile):
+    # type: (list, int, dict) -> dict
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'libvirt': libvirt.getVersion(),
+            'lxml': util.LXML,
+            'repeat': repeat,
+            'profile': profile,
+        },
+        'results': [],
+    }
+    workdir = tempfile.mkdtemp(prefix='libvirt-bench-')
+    for size in sizes:
+        conn = open_test_conn(size, workdir, profile)
+        for name, func in benchmarks(conn):
+            entry = {'bench': name, 'size': size}
+            try:
+                seconds = measure(func, repeat)
+                entry.update(seconds=seconds, per_object_us=seconds / size * 1e6)
+            except libvirt.libvirtError as e:
+                # e.g. DHCPLeases is not implemented by every driver
+                entry['error'] = e.get_error_message()
+            report['results'].append(entry)
+            print('{bench:<20} {size:>6} {0}'.format(
+                '{:>12.1f} us/object'.format(entry['per_object_us']) if 'seconds' in entry else entry['error'],
+                **entry))
+        conn.close()
+    return report
+
+
+def compare_reports(baseline, report, threshold):
+    # type: (dict, dict, float) -> list
+    """Print the ratio of each result to the baseline and return those slower than the threshold."""
+    base = {(r['bench'], r['size']): r for r in baseline['results'] if 'seconds' in r}
+    regressions = []
+    for entry in report['results']:
+        previous = base.get((entry['bench'], entry['size']))
+        if previous is None or 'seconds' not in entry:
+            continue
+        ratio = entry['seconds'] / previous['seconds']
+        print('{bench:<20} {size:>6} {0:>8.2f}x'.format(ratio, **entry))
+        if ratio > 1 + threshold:
+            regressions.append(dict(entry, ratio=ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=lambda s: [int(n) for n in s.split(',')], default=DEFAULT_SIZES,
+                        help='comma separated object counts (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark, the best one is kept')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='slowdown ratio reported as a regression')
+    corpus.add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    report = run(args.sizes, args.repeat, corpus.profile_of(args))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_reports(json.load(f), report, args.threshold)
+        if regressions:
+            print('{} regression(s) above {:.0%}'.format(len(regressions), args.threshold))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+"""Generate synthetic libvirt definitions for scaling tests.
+
+Definitions are built in the dict form used by the modules and encoded with
+libvirt_utils, with configurable device counts, NUMA cells, vCPU pins and DHCP
+hosts. Large counts produce the long runs of sibling tags that hit the list
+collapsing path of from_xml. node_xml() wraps them into a custom test-driver
+node definition, so module-level runs can use test:///path/to/node.xml:
+
+    python tests/benchmarks/corpus.py --output /tmp/corpus --domains 1000 --disks 16 --dhcp-hosts 500
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'module_utils'))
+import libvirt_utils as util  # noqa: E402
+
+POOL_NAME = 'corpus'
+POOL_PATH = '/var/lib/libvirt/images'
+
+
+def disk_target(n):
+    # type: (int) -> str
+    """vda, vdb, ..., vdz, vdaa, vdab, ... as libvirt names them."""
+    name = ''
+    n += 1
+    while n:
+        n, r = divmod(n - 1, 26)
+        name = chr(ord('a') + r) + name
+    return 'vd' + name
+
+
+def mac_address(i, n=0):
+    # type: (int, int) -> str
+    value = (i << 8) | (n & 0xff)
+    return '52:54:00:{:02x}:{:02x}:{:02x}'.format((value >> 16) & 0xff, (value >> 8) & 0xff, value & 0xff)
+
+
+def domain(i, disks=2, interfaces=1, numa_cells=1, vcpus=2, memory_mib=1024, domain_type='test'):
+    # type: (int, int, int, int, int, int, str) -> dict
+    name = 'corpus-{}'.format(i)
+    numa_cells = max(1, min(numa_cells, vcpus))
+    per_cell = vcpus // numa_cells
+    cells = []
+    for cell in range(numa_cells):
+        first = cell * per_cell
+        last = vcpus - 1 if cell == numa_cells - 1 else first + per_cell - 1
+        cells.append({
+            '_id': cell,
+            '_cpus': '{}-{}'.format(first, last) if last > first else str(first),
+            '_memory': memory_mib // numa_cells,
+            '_unit': 'MiB',
+        })
+    return {
+        '_type': domain_type,
+        'name': name,
+        'memory': {'_unit': 'MiB', '__value': memory_mib},
+        'currentMemory': {'_unit': 'MiB', '__value': memory_mib},
+        'vcpu': {'_placement': 'static', '__value': vcpus},
+        'cputune': {
+            'vcpupin': [{'_vcpu': vcpu, '_cpuset': vcpu % 64} for vcpu in range(vcpus)],
+        },
+        'cpu': {
+            'numa': {
+                'cell': cells,
+            },
+        },
+        'os': {
+            'type': {'_arch': 'x86_64', '__value': 'hvm'},
+            'boot': {'_dev': 'hd'},
+        },
+        'devices': {
+            'disk': [{
+                '_type': 'file',
+                '_device': 'disk',
+                'driver': {'_name': 'qemu', '_type': 'qcow2'},
+                'source': {'_file': '{}/{}-{}.qcow2'.format(POOL_PATH, name, n)},
+                'target': {'_dev': disk_target(n), '_bus': 'virtio'},
+            } for n in range(disks)],
+            'controller': [
+                {'_type': 'virtio-serial', '_index': 0},
+                {'_type': 'usb', '_index': 0},
+            ],
+            'interface': [{
+                '_type': 'network',
+                'mac': {'_address': mac_address(i, n)},
+                'source': {'_network': 'corpus-{}'.format(n)},
+                'model': {'_type': 'virtio'},
+            } for n in range(interfaces)],
+            'graphics': {'_type': 'vnc', '_port': -1, '_autoport': 'yes'},
+        },
+    }
+
+
+def network(i, dhcp_hosts=0):
+    # type: (int, int) -> dict
+    subnet = '10.{}'.format(i % 256)
+    return {
+        'name': 'corpus-{}'.format(i),
+        'bridge': {'_name': 'virbr{}'.format(i)},
+        'forward': {'_mode': 'nat'},
+        'ip': {
+            '_address': '{}.0.1'.format(subnet),
+            '_netmask': '255.255.0.0',
+            'dhcp': {
+                'range': {'_start': '{}.255.1'.format(subnet), '_end': '{}.255.254'.format(subnet)},
+                'host': [{
+                    '_mac': mac_address(i, host),
+                    '_name': 'host-{}-{}'.format(i, host),
+                    '_ip': '{}.{}.{}'.format(subnet, (host + 2) >> 8, (host + 2) & 0xff),
+                } for host in range(dhcp_hosts)],
+            },
+        },
+    }
+
+
+def volume(i, capacity_gib=10, fmt='qcow2'):
+    # type: (int, int, str) -> dict
+    return {
+        'name': 'corpus-{}.{}'.format(i, fmt),
+        'capacity': {'_unit': 'G', '__value': capacity_gib},
+        'allocation': {'_unit': 'G', '__value': 0},
+        'target': {
+            'format': {'_type': fmt},
+        },
+    }
+
+
+def pool(volumes=(), name=POOL_NAME, path=POOL_PATH):
+    # type: (list, str, str) -> dict
+    """Directory pool, the volumes only being part of test-driver node definitions."""
+    return {
+        '_type': 'dir',
+        'name': name,
+        'capacity': {'_unit': 'bytes', '__value': 0},
+        'allocation': {'_unit': 'bytes', '__value': 0},
+        'available': {'_unit': 'bytes', '__value': 0},
+        'source': {},
+        'target': {
+            'path': path,
+            'permissions': {'mode': '0711', 'owner': 0, 'group': 0},
+        },
+        'volume': list(volumes),
+    }
+
+
+def encode(tag, obj):
+    # type: (str, dict) -> str
+    return util.to_xml_str({tag: obj})
+
+
+def node_xml(domains=(), networks=(), pools=()):
+    # type: (list, list, list) -> str
+    """Custom test-driver node definition holding the given dict definitions."""
+    return encode('node', {
+        'domain': list(domains),
+        'network': list(networks),
+        'pool': list(pools),
+    })
+
+
+def generate(count, disks=2, interfaces=1, numa_cells=1, vcpus=2, dhcp_hosts=0):
+    # type: (int, int, int, int, int, int) -> dict
+    return {
+        'domains': [domain(i, disks, interfaces, numa_cells, vcpus) for i in range(count)],
+        'networks': [network(i, dhcp_hosts) for i in range(count)],
+        'volumes': [volume(i) for i in range(count)],
+        'pools': [pool(name='corpus-{}'.format(i), path='{}/corpus-{}'.format(POOL_PATH, i)) for i in range(count)],
+    }
+
+
+def add_profile_arguments(parser):
+    # type: (argparse.ArgumentParser) -> None
+    parser.add_argument('--disks', type=int, default=2, help='disks per domain')
+    parser.add_argument('--interfaces', type=int, default=1, help='interfaces per domain')
+    parser.add_argument('--numa-cells', type=int, default=1, help='NUMA cells per domain')
+    parser.add_argument('--vcpus', type=int, default=2, help='vCPUs, and vcpupin entries, per domain')
+    parser.add_argument('--dhcp-hosts', type=int, default=0, help='DHCP hosts per network')
+
+
+def profile_of(args):
+    # type: (argparse.Namespace) -> dict
+    return dict(disks=args.disks, interfaces=args.interfaces, numa_cells=args.numa_cells, vcpus=args.vcpus,
+                dhcp_hosts=args.dhcp_hosts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', required=True, help='directory receiving the documents')
+    parser.add_argument('--domains', type=int, default=10, help='number of domains, networks, volumes and pools')
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    corpus = generate(args.domains, **profile_of(args))
+    for kind, tag in (('domains', 'domain'), ('networks', 'network'), ('volumes', 'volume'), ('pools', 'pool')):
+        directory = os.path.join(args.output, kind)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for obj in corpus[kind]:
+            with open(os.path.join(directory, obj['name'] + '.xml'), 'w') as f:
+                f.write(encode(tag, obj))
+    with open(os.path.join(args.output, 'node.xml'), 'w') as f:
+        f.write(node_xml(corpus['domains'], corpus['networks'], [pool(corpus['volumes'])] + corpus['pools']))
+
+
+if __name__ == '__main__':
+    main()